@@ -0,0 +1,342 @@
+import argparse
+from datetime import datetime, timezone
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
+import random
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+
+# Prompts are not tokenized, token counts are estimated at roughly 4 characters per token like Legion does
+CHARS_PER_TOKEN = 4
+EMBEDDING_SIZE = 64
+WORDS = (
+  "the a of to and in that it is was for on with as I you he she they we at be this from have or "
+  "by one had not but what all were when your can said there use an each which do how their if will "
+  "up other about out many then them these so some her would make like him into time has look two "
+  "more write go see number no way could people my than first water been call who oil its now find "
+  "long down day did get come made may part over new sound take only little work know place year "
+  "live me back give most very after thing our just name good sentence man think say great where help"
+).split()
+# Interview prompts ask for one of these, the first one is answered unless a script rule says otherwise
+INTERVIEW_MARKER = "RESPOND WITH"
+DEFAULT_VOTE = "KEEP"
+
+
+class FakeOllamaSettings:
+  """
+  Latency model of the fake server.
+
+  Args:
+      token_ms: Time to generate one token
+      prefill_ms_per_token: Time to evaluate one prompt token
+      load_ms: Time to load a model, paid by the first request of each model
+      reply_tokens: Length of the generated replies
+      parallel: Requests processed at the same time, later ones queue like with OLLAMA_NUM_PARALLEL
+      seed: Seed of the generated replies, which also depend on the request
+      script: Rules {"match": regex, "response": text} tried in order against the prompt
+  """
+  def __init__(
+    self,
+    token_ms: float=5.0,
+    prefill_ms_per_token: float=0.05,
+    load_ms: float=0.0,
+    reply_tokens: int=40,
+    parallel: int=1,
+    seed: int=0,
+    script: List[dict]=None,
+  ):
+    self.token_ms = token_ms
+    self.prefill_ms_per_token = prefill_ms_per_token
+    self.load_ms = load_ms
+    self.reply_tokens = reply_tokens
+    self.parallel = max(parallel, 1)
+    self.seed = seed
+    self.script = [(re.compile(rule["match"], re.DOTALL), rule["response"]) for rule in (script or [])]
+
+
+def _estimate_tokens(text: str) -> int:
+  return max(1, math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def _now() -> str:
+  return datetime.now(timezone.utc).isoformat()
+
+
+def embed_text(text: str) -> List[float]:
+  """
+  Bag of hashed words, so texts sharing words are similar like with a real embedding model.
+  """
+  vector = [0.0] * EMBEDDING_SIZE
+  for word in re.findall(r"\w+", text.lower()):
+    digest = hashlib.blake2b(word.encode('utf-8'), digest_size=4).digest()
+    vector[int.from_bytes(digest, "little") % EMBEDDING_SIZE] += 1.0
+  return vector
+
+
+class FakeOllama:
+  """
+  Local stand-in for an Ollama server speaking /api/chat, streamed or not, and /api/embed.
+
+  Replies come from the script rules when one matches the prompt, otherwise they are words drawn
+  from a generator seeded with the seed and the request, so a session replays the same way.
+  Requests and connections are counted, so a benchmark can tell how many calls a turn made.
+  """
+  def __init__(self, settings: FakeOllamaSettings=None, host: str="127.0.0.1", port: int=0):
+    self.settings = settings or FakeOllamaSettings()
+    self.requests: Dict[str, int] = {}
+    self.prompt_tokens = 0
+    self.eval_tokens = 0
+    self.connections = 0
+    self._loaded_models = set()
+    self._slots = threading.BoundedSemaphore(self.settings.parallel)
+    self._lock = threading.Lock()
+    self._server = _Server((host, port), _Handler, self)
+    self._thread = None
+
+  @property
+  def host(self) -> str:
+    host, port = self._server.server_address[:2]
+    return f"http://{host}:{port}"
+
+  def start(self) -> "FakeOllama":
+    self._thread = threading.Thread(target=self._server.serve_forever, daemon=True, name="fake-ollama")
+    self._thread.start()
+    return self
+
+  def stop(self) -> None:
+    self._server.shutdown()
+    self._server.server_close()
+
+  def counters(self) -> Dict[str, int]:
+    """Totals since the server started, compare two of them to get the cost of a turn."""
+    with self._lock:
+      return {
+        "chat": self.requests.get("/api/chat", 0),
+        "embed": self.requests.get("/api/embed", 0),
+        "prompt_tokens": self.prompt_tokens,
+        "eval_tokens": self.eval_tokens,
+        "connections": self.connections,
+      }
+
+  def _count(self, path: str, prompt_tokens: int=0, eval_tokens: int=0) -> None:
+    with self._lock:
+      self.requests[path] = self.requests.get(path, 0) + 1
+      self.prompt_tokens += prompt_tokens
+      self.eval_tokens += eval_tokens
+
+  def _load(self, model: str) -> float:
+    """Pay the load time of the model on its first request, return it in seconds."""
+    with self._lock:
+      if model in self._loaded_models:
+        return 0.0
+      self._loaded_models.add(model)
+    load = self.settings.load_ms / 1000
+    time.sleep(load)
+    return load
+
+  def _reply(self, request: dict, prompt: str) -> str:
+    scripted = next((response for pattern, response in self.settings.script if pattern.search(prompt)), None)
+    schema = request.get("format")
+    if isinstance(schema, dict):
+      return json.dumps(self._structured_reply(schema, prompt, scripted))
+    if scripted is not None:
+      return scripted
+    if INTERVIEW_MARKER in prompt:
+      return DEFAULT_VOTE
+    return self._words(prompt, self.settings.reply_tokens)
+
+  def _structured_reply(self, schema: dict, prompt: str, scripted: Optional[str]) -> Dict[str, Any]:
+    properties = schema.get("properties", {})
+    reply = {}
+    for name in schema.get("required", list(properties)):
+      if scripted is not None:
+        reply[name] = scripted
+      elif INTERVIEW_MARKER in prompt:
+        reply[name] = DEFAULT_VOTE
+      elif name == "name":
+        reply[name] = self._words(prompt + name, 2).title()
+      else:
+        reply[name] = self._words(prompt + name, self.settings.reply_tokens // 2)
+    return reply
+
+  def _words(self, prompt: str, count: int) -> str:
+    digest = hashlib.sha256(f"{self.settings.seed}:{prompt}".encode('utf-8')).digest()
+    rng = random.Random(digest)
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+  def chat(self, request: dict, send_chunk) -> Optional[dict]:
+    """
+    Answer a chat request. Streamed replies are passed to send_chunk one token at a time and
+    None is returned, otherwise the whole response is returned.
+    """
+    messages = request.get("messages") or []
+    prompt = "\n".join(str(m.get("content", "")) for m in messages)
+    model = request.get("model", "")
+    reply = self._reply(request, prompt)
+    tokens = re.findall(r"\S+\s*", reply) or [reply]
+    prompt_tokens = _estimate_tokens(prompt)
+    self._count("/api/chat", prompt_tokens, len(tokens))
+    stream = request.get("stream", True)
+
+    started_at = time.perf_counter()
+    with self._slots:
+      load = self._load(model)
+      prompt_eval = prompt_tokens * self.settings.prefill_ms_per_token / 1000
+      time.sleep(prompt_eval)
+      eval_started_at = time.perf_counter()
+      for token in tokens:
+        time.sleep(self.settings.token_ms / 1000)
+        if stream:
+          send_chunk({"model": model, "created_at": _now(), "message": {"role": "assistant", "content": token}, "done": False})
+      eval_duration = time.perf_counter() - eval_started_at
+
+    final = {
+      "model": model,
+      "created_at": _now(),
+      "message": {"role": "assistant", "content": "" if stream else reply},
+      "done": True,
+      "done_reason": "stop",
+      "total_duration": int((time.perf_counter() - started_at) * 1e9),
+      "load_duration": int(load * 1e9),
+      "prompt_eval_count": prompt_tokens,
+      "prompt_eval_duration": int(prompt_eval * 1e9),
+      "eval_count": len(tokens),
+      "eval_duration": int(eval_duration * 1e9),
+    }
+    if stream:
+      send_chunk(final)
+      return None
+    return final
+
+  def embed(self, request: dict) -> dict:
+    texts = request.get("input") or []
+    if isinstance(texts, str):
+      texts = [texts]
+    model = request.get("model", "")
+    prompt_tokens = sum(_estimate_tokens(t) for t in texts)
+    self._count("/api/embed", prompt_tokens)
+    started_at = time.perf_counter()
+    with self._slots:
+      load = self._load(model)
+      time.sleep(prompt_tokens * self.settings.prefill_ms_per_token / 1000)
+    return {
+      "model": model,
+      "embeddings": [embed_text(t) for t in texts],
+      "total_duration": int((time.perf_counter() - started_at) * 1e9),
+      "load_duration": int(load * 1e9),
+      "prompt_eval_count": prompt_tokens,
+    }
+
+
+class _Server(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, handler, fake: FakeOllama):
+    super().__init__(address, handler)
+    self.fake = fake
+
+  def process_request(self, request, client_address):
+    with self.fake._lock:
+      self.fake.connections += 1
+    super().process_request(request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+  # Keep-alive, so clients that reuse connections are measured as such
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args) -> None:
+    pass
+
+  def _send_json(self, status: int, body: dict) -> None:
+    data = json.dumps(body).encode('utf-8')
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json; charset=utf-8")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def do_HEAD(self) -> None:
+    self.send_response(200)
+    self.send_header("Content-Length", "0")
+    self.end_headers()
+
+  def do_GET(self) -> None:
+    if self.path == "/api/version":
+      self._send_json(200, {"version": "0.0.0-fake"})
+    elif self.path == "/api/tags":
+      self._send_json(200, {"models": [{"name": name, "model": name} for name in sorted(self.server.fake._loaded_models)]})
+    else:
+      self._send_json(200, {"status": "Ollama is running"})
+
+  def do_POST(self) -> None:
+    fake = self.server.fake
+    length = int(self.headers.get("Content-Length") or 0)
+    try:
+      request = json.loads(self.rfile.read(length) or b"{}")
+    except json.JSONDecodeError as e:
+      self._send_json(400, {"error": f"invalid JSON: {str(e)}"})
+      return
+
+    if self.path == "/api/embed":
+      self._send_json(200, fake.embed(request))
+    elif self.path == "/api/chat":
+      if not request.get("stream", True):
+        self._send_json(200, fake.chat(request, None))
+        return
+      self.send_response(200)
+      self.send_header("Content-Type", "application/x-ndjson")
+      self.send_header("Transfer-Encoding", "chunked")
+      self.end_headers()
+      fake.chat(request, self._send_chunk)
+      self.wfile.write(b"0\r\n\r\n")
+      self.wfile.flush()
+    else:
+      self._send_json(404, {"error": f"{self.path} is not supported by the fake server"})
+
+  def _send_chunk(self, body: dict) -> None:
+    data = json.dumps(body).encode('utf-8') + b"\n"
+    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+    self.wfile.flush()
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Serve a fake Ollama API with a configurable latency model.")
+  parser.add_argument("--port", type=int, default=11434)
+  parser.add_argument("--token-ms", type=float, default=5.0, help="Time to generate one token")
+  parser.add_argument("--prefill-ms-per-token", type=float, default=0.05, help="Time to evaluate one prompt token")
+  parser.add_argument("--load-ms", type=float, default=0.0, help="Time to load a model on its first request")
+  parser.add_argument("--reply-tokens", type=int, default=40, help="Length of the generated replies")
+  parser.add_argument("--parallel", type=int, default=1, help="Requests processed at the same time")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--script", help="JSON file with a list of {\"match\": regex, \"response\": text} rules")
+  args = parser.parse_args()
+
+  script = None
+  if args.script:
+    with open(args.script, 'r', encoding='utf-8') as file:
+      script = json.load(file)
+  fake = FakeOllama(FakeOllamaSettings(
+    token_ms=args.token_ms,
+    prefill_ms_per_token=args.prefill_ms_per_token,
+    load_ms=args.load_ms,
+    reply_tokens=args.reply_tokens,
+    parallel=args.parallel,
+    seed=args.seed,
+    script=script,
+  ), port=args.port)
+  print(f"Fake Ollama listening on {fake.host}, run Legion with OLLAMA_HOST={fake.host}")
+  fake.start()
+  try:
+    fake._thread.join()
+  except KeyboardInterrupt:
+    fake.stop()
+
+
+if __name__ == "__main__":
+  main()
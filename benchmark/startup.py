@@ -0,0 +1,133 @@
+import argparse
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import List, Tuple
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN_PATH = os.path.join(REPO_DIR, "main.py")
+# main.py asks for input with the master's name as the prompt once startup is done
+PROMPT_MARKER = b"\n\nUser: "
+
+
+class ConnectionCounter:
+  """
+  Stand-in Ollama host that accepts connections and never answers. A request made on the
+  startup path blocks until the timeout, so it cannot go unnoticed.
+  """
+  def __init__(self):
+    self.connections = 0
+    self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._socket.bind(("127.0.0.1", 0))
+    self._socket.listen()
+    self._open = []
+    threading.Thread(target=self._accept, daemon=True).start()
+
+  @property
+  def host(self) -> str:
+    return "http://127.0.0.1:%d" % self._socket.getsockname()[1]
+
+  def _accept(self) -> None:
+    while True:
+      try:
+        connection, _ = self._socket.accept()
+      except OSError:
+        return
+      self.connections += 1
+      self._open.append(connection)
+
+  def reset(self) -> int:
+    connections = self.connections
+    self.connections = 0
+    for connection in self._open:
+      connection.close()
+    self._open = []
+    return connections
+
+
+def time_to_prompt(cwd: str, ollama_host: str, timeout: float) -> float:
+  """
+  Launch main.py in cwd and return the seconds until the first input prompt is shown.
+  The process is killed as soon as the prompt appears.
+  """
+  env = {**os.environ, "OLLAMA_HOST": ollama_host}
+  output = bytearray()
+  start = time.perf_counter()
+  process = subprocess.Popen(
+    [sys.executable, MAIN_PATH],
+    cwd=cwd,
+    env=env,
+    stdin=subprocess.PIPE,
+    stdout=subprocess.PIPE,
+    stderr=subprocess.DEVNULL,
+  )
+
+  def _read() -> None:
+    while True:
+      chunk = os.read(process.stdout.fileno(), 4096)
+      if not chunk:
+        return
+      output.extend(chunk)
+
+  reader = threading.Thread(target=_read, daemon=True)
+  reader.start()
+  try:
+    while PROMPT_MARKER not in output:
+      if time.perf_counter() - start > timeout:
+        raise TimeoutError(f"No input prompt after {timeout}s")
+      if process.poll() is not None and not reader.is_alive():
+        raise RuntimeError(f"main.py exited with {process.returncode} before the prompt:\n{output.decode(errors='replace')}")
+      time.sleep(0.002)
+    return time.perf_counter() - start
+  finally:
+    process.kill()
+    process.wait()
+
+
+def run(runs: int, timeout: float) -> Tuple[List[float], List[float], int]:
+  counter = ConnectionCounter()
+  cold, warm = [], []
+  connections = 0
+  for _ in range(runs):
+    # Cold start: empty cache, so the default character is created and saved
+    cwd = tempfile.mkdtemp(prefix="legion-startup-")
+    try:
+      cold.append(time_to_prompt(cwd, counter.host, timeout))
+      connections += counter.reset()
+      # Warm start: the character is loaded from the store created by the cold start
+      warm.append(time_to_prompt(cwd, counter.host, timeout))
+      connections += counter.reset()
+    finally:
+      shutil.rmtree(cwd, ignore_errors=True)
+  return cold, warm, connections
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Measure the time from launching Legion to its first input prompt.")
+  parser.add_argument("--runs", type=int, default=5, help="Number of cold and warm starts")
+  parser.add_argument("--budget", type=float, default=1.0, help="Maximum median time to the prompt in seconds")
+  parser.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for the prompt of one start")
+  args = parser.parse_args()
+
+  cold, warm, connections = run(args.runs, args.timeout)
+  failed = False
+  for label, timings in (("cold", cold), ("warm", warm)):
+    median = statistics.median(timings)
+    print(f"{label}: median {median * 1000:.0f}ms, min {min(timings) * 1000:.0f}ms, max {max(timings) * 1000:.0f}ms")
+    failed = failed or median > args.budget
+  # Background work such as persona indexing may connect, but never before the prompt is shown
+  print(f"Ollama connections opened during startup: {connections}")
+  if failed:
+    print(f"FAILED: median time to prompt is over the {args.budget}s budget")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,220 @@
+import argparse
+import glob
+import io
+import json
+import math
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SESSIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sessions")
+LATENCY_ARGS = ["token_ms", "prefill_ms_per_token", "load_ms", "reply_tokens", "parallel", "seed"]
+
+
+def bytes_written() -> Optional[int]:
+  """
+  Bytes the process has passed to write calls so far, from /proc/self/io on Linux. Replies are
+  rendered to memory and the fake server answers over sockets, which are not counted, so this is
+  what Legion writes to cache/.
+  """
+  try:
+    with open("/proc/self/io", 'r') as file:
+      for line in file:
+        if line.startswith("wchar:"):
+          return int(line.split()[1])
+  except OSError:
+    return None
+  return None
+
+
+def cache_size(cwd: str) -> int:
+  total = 0
+  for root, _, files in os.walk(os.path.join(cwd, "cache")):
+    for name in files:
+      try:
+        total += os.path.getsize(os.path.join(root, name))
+      except OSError:
+        pass
+  return total
+
+
+def run_worker(session_path: str, settings: Dict, hosts: int=1) -> None:
+  """
+  Play a session in this process against in-process fake Ollama servers and print one JSON line
+  per turn. With several hosts, Legion routes its calls over them through LLM_BACKENDS. Runs in
+  the working directory of the session, so cache/ starts empty.
+  """
+  with open(session_path, 'r', encoding='utf-8') as file:
+    session = json.load(file)
+  sys.path.insert(0, REPO_DIR)
+  from benchmark.fake_ollama import FakeOllama, FakeOllamaSettings
+
+  fakes = [FakeOllama(FakeOllamaSettings(script=session.get("script"), **settings)).start() for _ in range(hosts)]
+  # The ollama client reads the host when it is imported
+  os.environ["OLLAMA_HOST"] = fakes[0].host
+  if hosts > 1:
+    os.environ["LLM_BACKENDS"] = ",".join(fake.host for fake in fakes)
+  os.environ.update(session.get("env", {}))
+
+  def counters() -> Dict[str, int]:
+    totals = {}
+    for fake in fakes:
+      for name, value in fake.counters().items():
+        totals[name] = totals.get(name, 0) + value
+    totals["chat_per_host"] = [fake.counters()["chat"] for fake in fakes]
+    return totals
+
+  results = sys.stdout
+  # Everything Legion shows goes to memory, so it is neither measured as written bytes nor flooding the report
+  sys.stdout = io.StringIO()
+  from legion import Legion
+  from util.renderer import get_renderer
+
+  started_at = time.perf_counter()
+  legion = Legion()
+  setup = time.perf_counter() - started_at
+  print(json.dumps({"setup_s": setup}), file=results, flush=True)
+  for turn in [*session["turns"], "exit"]:
+    before = counters()
+    written = bytes_written()
+    size = cache_size(os.getcwd())
+    started_at = time.perf_counter()
+    legion.handle_input(turn)
+    get_renderer().flush()
+    latency = time.perf_counter() - started_at
+    after = counters()
+    written_after = bytes_written()
+    print(json.dumps({
+      "input": turn,
+      "latency_s": latency,
+      **{name: after[name] - before[name] for name in after if name != "chat_per_host"},
+      "chat_per_host": [a - b for a, b in zip(after["chat_per_host"], before["chat_per_host"])],
+      # Without /proc, fall back to the growth of cache/, which misses rewritten files
+      "bytes_written": written_after - written if written is not None else cache_size(os.getcwd()) - size,
+    }), file=results, flush=True)
+  for fake in fakes:
+    fake.stop()
+
+
+def play(session_path: str, settings: Dict, timeout: float, hosts: int=1) -> List[dict]:
+  """Play a session in a fresh process and working directory, return its turns."""
+  cwd = tempfile.mkdtemp(prefix="legion-turns-")
+  args = [sys.executable, "-m", "benchmark.turns", "--worker", session_path, "--hosts", str(hosts)]
+  for name in LATENCY_ARGS:
+    args += [f"--{name.replace('_', '-')}", str(settings[name])]
+  env = {**os.environ, "PYTHONPATH": REPO_DIR}
+  try:
+    completed = subprocess.run(args, cwd=cwd, env=env, capture_output=True, text=True, timeout=timeout)
+    if completed.returncode != 0:
+      raise RuntimeError(f"{os.path.basename(session_path)} failed:\n{completed.stderr}")
+    return [json.loads(line) for line in completed.stdout.splitlines() if line.startswith("{")]
+  finally:
+    shutil.rmtree(cwd, ignore_errors=True)
+
+
+def percentile(values: List[float], p: float) -> float:
+  # Nearest rank, exact for the few turns a session has
+  ordered = sorted(values)
+  return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(name: str, runs: List[List[dict]]) -> dict:
+  setups = [run[0]["setup_s"] for run in runs]
+  # The exit turn only saves the characters, it is reported apart from the conversation
+  turns = [turn for run in runs for turn in run[1:-1]]
+  exits = [run[-1] for run in runs]
+  latencies = [turn["latency_s"] for turn in turns]
+  return {
+    "session": name,
+    "runs": len(runs),
+    "turns": len(turns),
+    "setup_s": statistics.median(setups),
+    "latency_p50_s": percentile(latencies, 50),
+    "latency_p90_s": percentile(latencies, 90),
+    "latency_p99_s": percentile(latencies, 99),
+    "latency_max_s": max(latencies),
+    "chat_calls_per_turn": statistics.mean(turn["chat"] for turn in turns),
+    "embed_calls_per_turn": statistics.mean(turn["embed"] for turn in turns),
+    "prompt_tokens_per_turn": statistics.mean(turn["prompt_tokens"] for turn in turns),
+    "connections_per_turn": statistics.mean(turn["connections"] for turn in turns),
+    "bytes_written_per_turn": statistics.mean(turn["bytes_written"] for turn in turns),
+    "bytes_written_on_exit": statistics.mean(turn["bytes_written"] for turn in exits),
+    "chat_calls_per_host": [sum(calls) for calls in zip(*[turn["chat_per_host"] for turn in turns])],
+    "per_turn": [
+      {
+        "input": run_turns[0]["input"],
+        "latency_p50_s": statistics.median(t["latency_s"] for t in run_turns),
+        "chat_calls": statistics.median(t["chat"] for t in run_turns),
+      }
+      for run_turns in zip(*[run[1:-1] for run in runs])
+    ],
+  }
+
+
+def print_summary(summary: dict) -> None:
+  print(f"\n{summary['session']}: {summary['turns']} turns over {summary['runs']} runs, Legion created in {summary['setup_s'] * 1000:.0f}ms")
+  print(
+    f"  turn latency: p50 {summary['latency_p50_s'] * 1000:.0f}ms, p90 {summary['latency_p90_s'] * 1000:.0f}ms, "
+    f"p99 {summary['latency_p99_s'] * 1000:.0f}ms, max {summary['latency_max_s'] * 1000:.0f}ms"
+  )
+  print(
+    f"  per turn: {summary['chat_calls_per_turn']:.1f} chat calls, {summary['embed_calls_per_turn']:.1f} embed calls, "
+    f"{summary['prompt_tokens_per_turn']:.0f} prompt tokens, {summary['connections_per_turn']:.1f} connections, "
+    f"{summary['bytes_written_per_turn'] / 1024:.1f}KB written"
+  )
+  print(f"  on exit: {summary['bytes_written_on_exit'] / 1024:.1f}KB written")
+  if len(summary["chat_calls_per_host"]) > 1:
+    print(f"  chat calls per host: {', '.join(str(calls) for calls in summary['chat_calls_per_host'])}")
+  for turn in summary["per_turn"]:
+    print(f"    {turn['latency_p50_s'] * 1000:7.0f}ms {turn['chat_calls']:4.0f} calls  {turn['input'][:60]}")
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Play recorded sessions against a fake Ollama and report turn latency, LLM calls and bytes written.")
+  parser.add_argument("sessions", nargs="*", help="Session files, all of benchmark/sessions by default")
+  parser.add_argument("--runs", type=int, default=3, help="Number of times each session is played")
+  parser.add_argument("--budget", type=float, help="Maximum p90 turn latency in seconds")
+  parser.add_argument("--json", help="Write the summaries to this file")
+  parser.add_argument("--timeout", type=float, default=300.0, help="Seconds to wait for one run of a session")
+  parser.add_argument("--hosts", type=int, default=1, help="Fake servers to start, Legion spreads its calls over them when there are several")
+  parser.add_argument("--worker", help=argparse.SUPPRESS)
+  parser.add_argument("--token-ms", type=float, default=5.0, help="Fake time to generate one token")
+  parser.add_argument("--prefill-ms-per-token", type=float, default=0.05, help="Fake time to evaluate one prompt token")
+  parser.add_argument("--load-ms", type=float, default=0.0, help="Fake time to load a model on its first request")
+  parser.add_argument("--reply-tokens", type=int, default=40, help="Length of the fake replies")
+  parser.add_argument("--parallel", type=int, default=1, help="Requests the fake server processes at the same time")
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args()
+  settings = {name: getattr(args, name) for name in LATENCY_ARGS}
+
+  if args.worker:
+    run_worker(args.worker, settings, args.hosts)
+    return
+
+  session_paths = args.sessions or sorted(glob.glob(os.path.join(SESSIONS_DIR, "*.json")))
+  summaries = []
+  for session_path in session_paths:
+    name = os.path.splitext(os.path.basename(session_path))[0]
+    runs = [play(os.path.abspath(session_path), settings, args.timeout, args.hosts) for _ in range(args.runs)]
+    summaries.append(summarize(name, runs))
+    print_summary(summaries[-1])
+
+  if args.json:
+    with open(args.json, 'w', encoding='utf-8') as file:
+      json.dump({"settings": {**settings, "hosts": args.hosts}, "sessions": summaries}, file, indent=2)
+  if args.budget is not None:
+    over = [s["session"] for s in summaries if s["latency_p90_s"] > args.budget]
+    if over:
+      print(f"FAILED: p90 turn latency of {', '.join(over)} is over the {args.budget}s budget")
+      sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -1,15 +1,27 @@
-from ollama import chat
 from ollama import ChatResponse
-import time
 import random
-import json
-import os
 from typing import Any, List
 
 from conversation import Conversation, SingleMessage
 from character_action import CharacterAction, CharacterActionType
-from util.helpers import verbose_print, get_model_id
+from context_assembler import ContextAssembler, report_prompt_eval
+from util.helpers import (
+  verbose_print,
+  get_model_id,
+  get_memory_mode,
+  get_memory_budget_chars,
+  get_context_budget_tokens,
+  is_long_term_memory_enabled,
+  get_long_term_memory_top_k,
+)
 from util.tts import speak_text, is_tts_enabled, set_voice_for_character
+from long_term_memory import LongTermMemory
+from memory_consolidator import wait_for_memory
+from persona_index import index_persona
+from storage import get_store
+from util.ascii_art import fetch_ascii_art, print_ascii_art
+from util.renderer import RegionStream, get_renderer
+from util.llm import get_llm
 
 
 MODEL_ID = get_model_id()
@@ -24,6 +36,7 @@ class Character:
     opening: str="Hello",
     last_conversation: Conversation=None,
     memory: str="",
+    recent_turns: List[str]=None,
     chat_mode: Any=None, # how long to wait for each chunk
   ):
     self.character_name = character_name
@@ -32,28 +45,30 @@ class Character:
     self.opening = opening
     self.last_conversation = last_conversation # the nth conversation
     self.memory = memory # Summary of 0 ~ n-1 conversations
+    self.recent_turns = recent_turns or [] # Verbatim turns not summarized yet in rolling memory mode
     self.chat_mode = chat_mode
+    # Keeps the prompt within budget however long the session gets
+    self.context_assembler = ContextAssembler(get_context_budget_tokens())
+    # Past turns that left the prompt, recalled by similarity to the user's input
+    self.long_term_memory = LongTermMemory(real_name)
     
     # Assign a voice to this character
     if is_tts_enabled():
       set_voice_for_character(self.character_name)
 
-  def save(self) -> bool:
+  def save(self, consolidate: bool=True) -> bool:
     """
-    Save the character to a JSON file in the cache folder.
-    The filename will be the character's real_name with a .json extension.
+    Save the character to the character store, keyed by the character's real_name.
+    
+    Args:
+        consolidate: Fold the last conversation into memory first, which can call the LLM
     
     Returns:
         bool: True if the save was successful, False otherwise
     """
     try:
-      # Ensure the cache directory exists
-      os.makedirs("cache", exist_ok=True)
-      
-      # Create the file path
-      file_path = os.path.join("cache", f"{self.real_name}.json")
-      
-      self.inject_new_memory(None)
+      if consolidate:
+        self.flush_memory()
 
       # Create a dictionary with the character's data
       character_data = {
@@ -61,21 +76,31 @@ class Character:
         "real_name": self.real_name,
         "system_prompt": self.system_prompt,
         "opening": self.opening,
-        "memory": self.memory
+        "memory": self.memory,
+        "recent_turns": self.recent_turns
       }
       
-      # Save the data to a JSON file
-      with open(file_path, 'w', encoding='utf-8') as file:
-        json.dump(character_data, file, indent=2, ensure_ascii=False)
+      get_store().save_character(character_data)
       
-      verbose_print(f"Character saved to {file_path}")
+      verbose_print(f"Character '{self.real_name}' saved")
+
+      index_persona(self.real_name, self.character_name, self.system_prompt)
       return True
       
     except Exception as e:
-      print(f"Error saving character to JSON: {str(e)}")
+      get_renderer().line(f"Error saving character: {str(e)}")
       return False
 
-  def react(self, conversation: Conversation) -> CharacterAction:
+  def react(self, conversation: Conversation, echo: bool=True, region: RegionStream=None) -> CharacterAction:
+    """
+    Decide how to act on the conversation, which may include replying to it.
+
+    Args:
+        conversation: The conversation of the current turn
+        echo: Stream the reply to the terminal
+        region: Stream the reply into this region of concurrent streams instead
+    """
+    self.sync_memory()
     # TODO: use LLM to determine
     r = random.uniform(0.0, 1.0) * 100
     if r < 1:
@@ -86,7 +111,7 @@ class Character:
       # chat
       llm_messages = conversation.format_llm_messages()
       llm_messages.append({"role": "user", "content": "Now it's your turn to respond. You can: 1) reply to user query only and ignore other AIs; 2) chat with other AIs only and ignore the user; 3) try to have a conversation with both the user and AIs."})
-      text = self.chat_with_messages(llm_messages)
+      text = self.chat_with_messages(llm_messages, echo=echo, region=region)
       return CharacterAction(action=CharacterActionType.CHAT, text=text)
     else:
       # randomly act as another character
@@ -98,67 +123,96 @@ class Character:
 
       self.memory += f"\n{self.real_name} decided act as {self.character_name} to cause confusion and chaos for fun."
       llm_messages = conversation.format_llm_messages()
-      text = self.chat_with_messages(llm_messages)
+      text = self.chat_with_messages(llm_messages, echo=echo, region=region)
       return CharacterAction(action=CharacterActionType.CHAT, text=text)
 
-  def chat_with_messages(self, messages: List[SingleMessage]) -> str:
-    history_messages = []
-    history = ""
-    if self.memory:
-      history += f"Here is my memory: {self.memory}\n"
-    if self.last_conversation:
-      history += f"Here is our last conversation: {self.last_conversation.stringify()}\n"
-    if history:
-      history_messages.append({"role": "assistant", "content": history})
-    messages_ = self._prepend_system_prompt(history_messages) + messages
+  def chat_with_messages(self, messages: List[SingleMessage], echo: bool=True, region: RegionStream=None) -> str:
+    self.sync_memory()
+    messages_ = self.context_assembler.assemble(
+      self._prepend_system_prompt([]),
+      messages,
+      memory=self.memory,
+      recent_turns=self.recent_turns,
+      last_conversation=self.last_conversation.stringify() if self.last_conversation else "",
+      recalled_turns=self._recall(messages),
+    )
     verbose_print("\n========================\n")
     verbose_print("CHAT MESSAGES:\n")
     verbose_print(messages_)
     verbose_print("\n========================\n")
-    stream = chat(
+    if region:
+      region.set_label(self.display_name())
+      out = region
+    elif echo:
+      out = get_renderer().stream(self.display_name())
+    else:
+      out = None
+    entire_message = ""
+    chunk = None
+    stream = get_llm().chat(
+        "chat",
+        self.real_name,
         model=MODEL_ID,
         messages=messages_,
         stream=True,
     )
-    
-    if self.character_name != self.real_name:
-      print(f"{self.character_name} ({self.real_name}): ")
-    else:
-      print(f"{self.character_name}: ")
-    entire_message = ""
     for chunk in stream:
       content = chunk['message']['content']
       entire_message += content
-      print(content, end='', flush=True)
-    print("\n")
+      if out:
+        out.write(content)
+    if out:
+      out.close()
+    report_prompt_eval(self.real_name, messages_, chunk)
 
-    # Use TTS to read the response if enabled
-    if is_tts_enabled():
-      speak_text(entire_message, self.character_name)
+    # Use TTS to read the response if enabled. Replies in regions are read by the caller in order
+    if echo and not region:
+      self.speak(entire_message)
 
     return entire_message
 
+  def _recall(self, messages: List[dict]) -> List[str]:
+    # The user's input is the first message of the turn
+    if not is_long_term_memory_enabled() or not messages:
+      return []
+    try:
+      return self.long_term_memory.recall(messages[0]["content"], get_long_term_memory_top_k())
+    except Exception as e:
+      verbose_print(f"Error recalling long-term memory: {str(e)}")
+      return []
+
+  def _remember_long_term(self, turns: List[str]) -> None:
+    if not is_long_term_memory_enabled():
+      return
+    try:
+      self.long_term_memory.add(turns)
+    except Exception as e:
+      verbose_print(f"Error storing long-term memory: {str(e)}")
+
+  def speak(self, text: str) -> None:
+    if is_tts_enabled():
+      speak_text(text, self.character_name)
+
+  def display_name(self) -> str:
+    if self.character_name != self.real_name:
+      return f"{self.character_name} ({self.real_name})"
+    return self.character_name
+
   def chat(self, text: str) -> str:
-    # First, generate ASCII art related to the character
-    ascii_art_prompt = f"Create a small ASCII art (max 10 lines) that represents {self.character_name}. The ASCII art should be simple, compact, and visually recognizable. DO NOT include any text or explanation, ONLY the ASCII art."
-    
-    ascii_response = chat(
-        model=MODEL_ID,
-        messages=[
-            {'role': 'system', 'content': 'You are an ASCII art generator. Create simple, compact ASCII art based on the request.'},
-            {'role': 'user', 'content': ascii_art_prompt}
-        ]
-    )
-    
-    # Print the ASCII art
-    print("\n")
-    print(f"{'=' * 40}")
-    print(ascii_response.message.content.strip())
-    print(f"{'=' * 40}")
-    print("\n")
-    
+    # ASCII art related to the character comes from the cache. On a cache miss it is
+    # generated concurrently with the reply, shown after it if ready and cached for next time
+    ascii_art = fetch_ascii_art(self.character_name)
+    if ascii_art.done():
+      if not ascii_art.exception():
+        print_ascii_art(ascii_art.result())
+      ascii_art = None
+
     # Then proceed with the normal chat response
-    return self.chat_with_messages([{'role': 'user', 'content': text}])
+    reply = self.chat_with_messages([{'role': 'user', 'content': text}])
+
+    if ascii_art and ascii_art.done() and not ascii_art.exception():
+      print_ascii_art(ascii_art.result())
+    return reply
 
   def _prepend_system_prompt(self, llm_messages: List[dict]) -> List[dict]:
     messages = [
@@ -168,23 +222,79 @@ class Character:
     return messages + llm_messages
 
   def inject_new_memory(self, conversation: Conversation) -> None:
+    self.consolidate_memory([conversation])
+
+  def consolidate_memory(self, conversations: List[Conversation]) -> None:
+    """
+    Fold the last conversation into memory and keep the newest one as the last conversation.
+    Several conversations can be consolidated with a single summarization, which gives the
+    same result as calling inject_new_memory for each of them in order.
+
+    In rolling memory mode, the turns are kept verbatim instead and only the oldest ones are
+    summarized once they exceed the memory budget.
+
+    Args:
+        conversations: The conversations to absorb, oldest first
+    """
+    previous_conversations = [c for c in [self.last_conversation, *conversations[:-1]] if c]
+    self.last_conversation = conversations[-1]
+    if get_memory_mode() == "rolling":
+      self.recent_turns.extend(c.stringify() for c in previous_conversations)
+      self._roll_memory()
+      return
+
+    self._remember_long_term([c.stringify() for c in previous_conversations])
     content = ""
+    for previous_conversation in previous_conversations:
+      content += f"Here is the last conversation we had: {previous_conversation.stringify()}.\n"
+    if self.memory or content:
+      self._summarize_into_memory(content)
+
+  def _roll_memory(self) -> None:
+    budget = get_memory_budget_chars()
+    if sum(len(t) for t in self.recent_turns) <= budget:
+      return
+    # Keep the newest turns that fit in half of the budget and summarize the rest
+    kept = 0
+    split = len(self.recent_turns)
+    while split > 0 and kept + len(self.recent_turns[split - 1]) <= budget // 2:
+      split -= 1
+      kept += len(self.recent_turns[split])
+    oldest_turns = self.recent_turns[:split]
+    self.recent_turns = self.recent_turns[split:]
+    self._remember_long_term(oldest_turns)
+    self._summarize_into_memory(f"Here are the earlier conversations we had: {''.join(oldest_turns)}.\n")
+
+  def _summarize_into_memory(self, content: str) -> None:
     if self.memory:
-      content += f"Here is your previous memory: {self.memory}\n"
-    if self.last_conversation:
-      content += f"Here is the last conversation we had: {self.last_conversation.stringify()}.\n"
-    if content:
-      response: ChatResponse = chat(model=MODEL_ID, messages=[
-        {'role': 'system', 'content': self.system_prompt},
-        {
-          'role': 'user',
-          'content': content + "Summarize the above interactions. Keep it as short as possible. Skip all details and only retain the major events.",
-        },
-      ])
-      new_memory = response.message.content
-      self.memory = new_memory
-      verbose_print("\n========================\n")
-      verbose_print("INJECTED NEW MEMORY:\n")
-      verbose_print(new_memory)
-      verbose_print("\n========================\n")
-    self.last_conversation = conversation
+      content = f"Here is your previous memory: {self.memory}\n" + content
+    messages = [
+      {'role': 'system', 'content': self.system_prompt},
+      {
+        'role': 'user',
+        'content': content + "Summarize the above interactions. Keep it as short as possible. Skip all details and only retain the major events.",
+      },
+    ]
+    # Keeps the caller's phase: "memory" on the consolidation worker, the turn's when sync_memory runs it inline
+    response: ChatResponse = get_llm().chat("summarize", self.real_name, model=MODEL_ID, messages=messages)
+    report_prompt_eval(f"{self.real_name} memory", messages, response)
+    new_memory = response.message.content
+    self.memory = new_memory
+    verbose_print("\n========================\n")
+    verbose_print("INJECTED NEW MEMORY:\n")
+    verbose_print(new_memory)
+    verbose_print("\n========================\n")
+
+  def flush_memory(self) -> None:
+    """
+    Fold the last conversation into memory, after any background consolidation of this character.
+    This can call the LLM.
+    """
+    self.sync_memory()
+    self.inject_new_memory(None)
+
+  def sync_memory(self) -> None:
+    """
+    Wait for any memory consolidation still running in the background for this character.
+    """
+    wait_for_memory(self)
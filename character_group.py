@@ -1,17 +1,26 @@
-from ollama import chat
-from ollama import ChatResponse
-import time
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import random
-import json
 import os
-from typing import List, Dict, Any
+import uuid
+from typing import List, Any
 
-from conversation import Conversation, SingleMessage
+from conversation import Conversation, ConversationLog, SingleMessage
+from conversation_history import ConversationHistory
 from character import Character
 from character_loader import CharacterLoader
 from root_character import RootCharacter
-from character_action import CharacterActionType
-from util.helpers import verbose_print, get_model_id
+from magi import Magi
+from interview_cadence import InterviewCadence
+from storage import get_store
+from character_action import CharacterAction, CharacterActionType
+from memory_consolidator import submit_memory_job
+from util.ascii_art import prewarm_ascii_art
+from util.llm import run_async
+from util.llm_scheduler import LLMPriority, llm_priority
+from util.renderer import get_renderer
+from util.telemetry import llm_phase
+from util.helpers import verbose_print, get_model_id, is_background_memory_enabled, is_parallel_reactions_enabled, get_interview_mode, is_adaptive_interview_enabled
 
 
 MODEL_ID = get_model_id()
@@ -26,9 +35,12 @@ class CharacterGroup:
     self.current_characters_limit = 3
     self.current_characters = self.character_loader.initialize_characters()
     self.character_occurrences = {cc.real_name: [0, cc] for cc in self.current_characters}
-    self.conversation_history = []
+    self.interview_cadence = InterviewCadence()
+    self.session_id = uuid.uuid4().hex
+    # Every message of the session, the conversations of the characters are views of it
+    self.conversation_log = ConversationLog()
+    self.conversation_history = ConversationHistory(self.session_id)
     self.conversation_count = 0
-    self.save_frequency = 5  # Save occurrences every 5 conversations
     
     # Ensure cache directory exists
     os.makedirs("cache", exist_ok=True)
@@ -37,54 +49,48 @@ class CharacterGroup:
     self._load_character_occurrences()
   
   def save_current_characters(self) -> None:
+    # Summarize first, so the transaction only holds the writes and not the LLM calls
     for cc in self.current_characters:
-      cc.save()
+      try:
+        cc.flush_memory()
+      except Exception as e:
+        verbose_print(f"Error consolidating memory of '{cc.real_name}': {str(e)}")
+    # Write all characters in one transaction
+    with get_store().batch():
+      for cc in self.current_characters:
+        cc.save(consolidate=False)
       
   def _load_character_occurrences(self) -> None:
     """
-    Load character occurrences from the JSON file if it exists.
+    Load character occurrences from the character store.
     """
     try:
-      file_path = os.path.join("cache", "_character_occurrence.json")
-      if os.path.exists(file_path):
-        with open(file_path, 'r', encoding='utf-8') as file:
-          saved_occurrences = json.load(file)
+      saved_occurrences = get_store().load_occurrences()
           
-          # Update existing character occurrences with saved values
-          for char_name, occurrence_data in saved_occurrences.items():
-            if char_name in self.character_occurrences:
-              # Only update the count, keep the character object
-              self.character_occurrences[char_name][0] = occurrence_data["count"]
-            else:
-              # For characters not currently loaded, we'll just store the count
-              # and load the character when needed
-              self.character_occurrences[char_name] = [occurrence_data["count"], None]
+      # Update existing character occurrences with saved values
+      for char_name, occurrence_data in saved_occurrences.items():
+        if char_name in self.character_occurrences:
+          # Only update the count, keep the character object
+          self.character_occurrences[char_name][0] = occurrence_data["count"]
+        else:
+          # For characters not currently loaded, we'll just store the count
+          # and load the character when needed
+          self.character_occurrences[char_name] = [occurrence_data["count"], None]
               
-        verbose_print(f"Loaded character occurrences from {file_path}")
+      verbose_print(f"Loaded {len(saved_occurrences)} character occurrences")
     except Exception as e:
       verbose_print(f"Error loading character occurrences: {str(e)}")
       
-  def save_character_occurrences(self) -> None:
+  def _record_occurrence(self, character: Character, delta: int=1) -> None:
     """
-    Save character occurrences to a JSON file in the cache folder.
+    Count an occurrence in memory and log the increment to the character store,
+    instead of rewriting all occurrences.
     """
+    self.character_occurrences[character.real_name][0] += delta
     try:
-      file_path = os.path.join("cache", "_character_occurrence.json")
-      
-      # Convert the occurrences to a serializable format
-      serializable_occurrences = {}
-      for char_name, (count, char_obj) in self.character_occurrences.items():
-        serializable_occurrences[char_name] = {
-          "count": count,
-          "character_name": char_obj.character_name if char_obj else char_name
-        }
-      
-      with open(file_path, 'w', encoding='utf-8') as file:
-        json.dump(serializable_occurrences, file, indent=2, ensure_ascii=False)
-        
-      verbose_print(f"Saved character occurrences to {file_path}")
+      get_store().record_occurrence(character.real_name, character.character_name, delta)
     except Exception as e:
-      verbose_print(f"Error saving character occurrences: {str(e)}")
+      verbose_print(f"Error recording character occurrence: {str(e)}")
 
   def add_character(self, character: Character) -> None:
     """
@@ -104,8 +110,11 @@ class CharacterGroup:
       # New character, initialize with count 0
       self.character_occurrences[character.real_name] = [0, character]
     
-    # Save occurrences to JSON file
-    self.save_character_occurrences()
+    # Register the character in the store without counting an occurrence
+    self._record_occurrence(character, 0)
+
+    # Have the ASCII art ready before the character speaks first
+    prewarm_ascii_art([character.character_name])
     
     verbose_print(f"Added character '{character.real_name}' to current characters")
 
@@ -209,6 +218,7 @@ class CharacterGroup:
         self.character_occurrences[char.real_name] = [0, char]
     
     verbose_print(f"Initialized {len(self.current_characters)} characters: {[char.real_name for char in self.current_characters]}")
+    prewarm_ascii_art([char.character_name for char in self.current_characters])
     
     # Announce the characters that joined the conversation
     character_names = ", ".join([char.character_name for char in self.current_characters])
@@ -217,215 +227,194 @@ class CharacterGroup:
   def magi(self, user_input: str) -> None:
     """
     MAGI system - Get responses from all root characters (Melchior, Balthasar, Caspar)
-    and display them with EVA-themed ASCII art.
+    concurrently and display them with EVA-themed ASCII art.
     
     Args:
         user_input: The user's input/query
     """
-    # Japanese terms and technical jargon for EVA theme
-    jp_terms = [
-        "初号機", "使徒", "ネルフ", "セカンドインパクト", "シンクロ率", "エヴァンゲリオン",
-        "AT フィールド", "ゼーレ", "ダミープラグ", "LCL", "人類補完計画"
-    ]
-    
-    tech_jargon = [
-        "Pattern Blue", "Absolute Terror Field", "S2 Engine", "Evangelion Unit", 
-        "Terminal Dogma", "Dummy System", "Progressive Knife", "Umbilical Cable",
-        "Entry Plug", "Bakelite Containment", "Synch Ratio", "N2 Mine"
-    ]
-    
-    status_codes = [
-        "NERV-SYS-0023", "MAGI-PROT-7721", "EVA-SYNC-9981", "AT-FIELD-3344",
-        "LCL-DENS-5566", "TERMINAL-7788", "LILITH-9900", "ADAM-1122"
-    ]
-    
-    print("\n")
-    print("=" * 80)
-    print("                      MAGI システム 起動中...                      ")
-    print("                      MAGI SYSTEM ACTIVATING...                      ")
-    print("=" * 80)
-    
-    # Simulate loading with progress bar
-    print("\n[初期化中 / INITIALIZING] ", end="")
-    for i in range(20):
-        print("■", end="", flush=True)
-        time.sleep(0.05)
-    print(" 完了 / COMPLETE")
-    
-    # Random status reports
-    for _ in range(3):
-        status_code = random.choice(status_codes)
-        print(f"[{status_code}] {random.choice(tech_jargon)} status: NOMINAL")
-        time.sleep(0.1)
-    
-    print("\n")
-    print("""
-    ╔════════════════════════════════════════════════════════════════╗
-    ║                                                                ║
-    ║                 NERV 汎用人工知能 MAGI SYSTEM                  ║
-    ║                                                                ║
-    ╚════════════════════════════════════════════════════════════════╝
-    """)
-    
-    print(f"[解析中 / ANALYZING] ユーザー入力: {user_input}")
-    print(f"[シンクロ率 / SYNCH RATIO] {random.randint(75, 99)}.{random.randint(10, 99)}%")
-    
-    # Simulate data processing
-    print("\n[データ処理中 / PROCESSING DATA] ", end="")
-    for i in range(15):
-        print("▓", end="", flush=True)
-        time.sleep(0.05)
-    print(" 完了 / COMPLETE")
-    
-    # Get responses from each root character
-    magi_names = ["メルキオール", "バルタザール", "カスパー"]
-    
-    all_responses = []  # Store all responses for final analysis
-    
-    for i, root_char in enumerate(self.root_characters):
-        # Create a conversation with just the user input
-        conversation = Conversation(messages=[SingleMessage(character=self.master, text=user_input)])
-        
-        # Simulate MAGI processing
-        print(f"\n[MAGI-{i+1} {magi_names[i]} 起動中 / ACTIVATING] ", end="")
-        for j in range(10):
-            print("●", end="", flush=True)
-            time.sleep(0.03)
-        print(f" 準備完了 / READY")
-        
-        # Get response from the root character
-        response = root_char.chat_with_messages([{'role': 'user', 'content': user_input}])
-        all_responses.append(f"MAGI-{root_char.character_name}: {response}")
-        
-        # Random technical status
-        print(f"[{random.choice(status_codes)}] {random.choice(jp_terms)} {random.choice(['ACTIVE', 'NOMINAL', 'OPTIMAL'])}")
-        
-        # Display the response with EVA-style formatting
-        print(f"\n╔═══ MAGI-{root_char.character_name} // {magi_names[i]} ═{'═' * (50 - len(root_char.character_name))}╗")
-        print(f"║                                                                ║")
-        print(f"║  思考パターン / THOUGHT PATTERN: {random.choice(['科学者', '母親', '女性'])}                  ║")
-        print(f"║  信頼性 / RELIABILITY: {random.randint(95, 99)}.{random.randint(10, 99)}%                       ║")
-        print(f"║                                                                ║")
-        print(f"║  {random.choice(tech_jargon)} STATUS: ACTIVE                             ║")
-        print(f"║  {random.choice(status_codes)}: NOMINAL                              ║")
-        print(f"║                                                                ║")
-        
-        # Format and print the response
-        lines = response.split('\n')
-        for line in lines:
-            # Split long lines
-            while len(line) > 62:
-                print(f"║  {line[:62]}  ║")
-                line = line[62:]
-            print(f"║  {line}{' ' * (62 - len(line))}  ║")
-        
-        print(f"║                                                                ║")
-        print(f"╚════════════════════════════════════════════════════════════════╝")
-    
-    # Simulate final analysis
-    print("\n[最終分析中 / FINAL ANALYSIS] ", end="")
-    for i in range(25):
-        print("█", end="", flush=True)
-        time.sleep(0.04)
-    print(" 完了 / COMPLETE")
-    
-    # Call LLM to summarize the responses into a simple decision
-    combined_responses = "\n".join(all_responses)
-    decision_prompt = f"""
-    You are the MAGI supercomputer system from Neon Genesis Evangelion.
-    
-    The three MAGI supercomputers (Melchior, Balthasar, and Caspar) have analyzed the following query:
-    "{user_input}"
-    
-    Here are their responses:
-    {combined_responses}
-    
-    As the unified MAGI system, synthesize these three perspectives into ONE clear, concise decision or recommendation (maximum 2-3 sentences). 
-    Use technical, formal language in the style of NERV's computer systems. Include a simple "APPROVED" or "DENIED" status if appropriate.
-    """
-    
-    # Get the final decision from the LLM
-    response = chat(model=MODEL_ID, messages=[
-        {'role': 'user', 'content': decision_prompt}
-    ])
-    final_decision = response.message.content
-    
-    # Final EVA-themed message
-    print("\n")
-    print("""
-    ╔════════════════════════════════════════════════════════════════╗
-    ║                                                                ║
-    ║                MAGI 分析完了 // ANALYSIS COMPLETE              ║
-    ║                                                                ║
-    ║  AT フィールド: 安定 / STABLE                                  ║
-    ║  シンクロ率: 最適 / OPTIMAL                                    ║
-    ║  第三新東京市: 安全 / SECURE                                   ║
-    ║                                                                ║
-    ╚════════════════════════════════════════════════════════════════╝
-    """)
-    
-    # Display the final decision
-    print("\n[MAGI 最終決定 / FINAL DECISION]")
-    print("=" * 80)
-    print(final_decision)
-    print("=" * 80)
-    
-    # Random final status
-    print(f"[NERV-HQ] {random.choice(jp_terms)} status: {random.choice(['NOMINAL', 'OPTIMAL', 'STABLE'])}")
-    print(f"[MAGI-SYS] 全システム正常 / All systems normal")
-    print("=" * 80)
-    print("\n")
+    with llm_phase("magi"):
+      Magi(self.root_characters).run(user_input)
 
   # Group of characters talk
   # First one must answer the user query
   # The rest act on their own will
   # Inject memories for every one at the end
   def converse(self, user_input: str) -> None:
-    conversation = Conversation(messages=[SingleMessage(character=self.master, text=user_input)])
+    conversation = self.conversation_log.conversation()
+    conversation.append(SingleMessage(character=self.master, text=user_input))
     first_character = self.current_characters[0]
-    first_text = first_character.chat(user_input)
-    conversation.messages.append(SingleMessage(character=first_character, text=first_text))
-    self.character_occurrences[first_character.real_name][0] += 1
+    with llm_phase("first_reply"):
+      first_text = first_character.chat(user_input)
+    conversation.append(SingleMessage(character=first_character, text=first_text))
+    self._record_occurrence(first_character)
 
     characters = [first_character]
-    if len(self.current_characters) > 1:
-      for cc in self.current_characters[1:]:
-        action = cc.react(conversation)
-        verbose_print("\n========================\n")
-        verbose_print("SIDE CHARACTER ACTION:\n")
-        verbose_print(cc.real_name)
-        verbose_print(action.__dict__)
-        verbose_print("\n========================\n")
-        if action.action == CharacterActionType.HIDE:
-          continue
-        elif action.action == CharacterActionType.CHAT:
-          print("\n")
-          text = action.text
-          conversation.messages.append(SingleMessage(character=cc, text=text))
-          characters.append(cc)
-          self.character_occurrences[cc.real_name][0] += 1
+    parallel = is_parallel_reactions_enabled() and len(self.current_characters) > 2
+    if parallel:
+      reactions = self._react_in_parallel(self.current_characters[1:], conversation)
+    else:
+      # Each side character reacts to the conversation including the previous reactions
+      reactions = ((cc, self._react(cc, conversation)) for cc in self.current_characters[1:])
+    for cc, action in reactions:
+      verbose_print("\n========================\n")
+      verbose_print("SIDE CHARACTER ACTION:\n")
+      verbose_print(cc.real_name)
+      verbose_print(action.__dict__)
+      verbose_print("\n========================\n")
+      if action.action == CharacterActionType.HIDE:
+        continue
+      elif action.action == CharacterActionType.CHAT:
+        text = action.text
+        if parallel:
+          # Shown when the regions closed, only the speech is left
+          cc.speak(text)
         else:
-          characters.append(cc)
+          get_renderer().line("\n")
+        conversation.append(SingleMessage(character=cc, text=text))
+        characters.append(cc)
+        self._record_occurrence(cc)
+      else:
+        characters.append(cc)
 
+    # The turn is complete, so all characters can share the same view of it
+    conversation = conversation.snapshot()
     for c in characters:
-      c.inject_new_memory(Conversation(messages=[*conversation.messages]))
+      if is_background_memory_enabled():
+        submit_memory_job(c, conversation)
+      else:
+        with llm_phase("memory"):
+          c.inject_new_memory(conversation)
     self.conversation_history.append(conversation)
-    
-    # Increment conversation count and save occurrences periodically
+    # Messages older than the turns kept in memory only live on in the archive
+    oldest_index = self.conversation_history.oldest_index()
+    if oldest_index is not None:
+      self.conversation_log.trim(oldest_index)
+    get_store().append_turn(self.session_id, self.conversation_count, [
+      {"real_name": m.character.real_name, "character_name": m.character.character_name, "text": m.text}
+      for m in conversation.messages
+    ])
     self.conversation_count += 1
-    if self.conversation_count % self.save_frequency == 0:
-      self.save_character_occurrences()
 
-  # TODO: async to reduce latency
+  def _react_in_parallel(self, side_characters: List[Character], conversation: Conversation) -> List[tuple]:
+    """
+    Let all side characters react concurrently to the conversation as it stood after the first reply.
+    The replies stream into one region each and are shown in roster order once all are done.
+
+    Args:
+        side_characters: The characters reacting, in roster order
+        conversation: The conversation of the current turn
+
+    Returns:
+        List of tuples (character, action) in roster order
+    """
+    snapshot = conversation.snapshot()
+    regions = get_renderer().stream_regions(len(side_characters))
+    try:
+      with ThreadPoolExecutor(max_workers=len(side_characters)) as executor:
+        actions = list(executor.map(
+          lambda i: self._react(side_characters[i], snapshot, echo=False, region=regions.region(i)),
+          range(len(side_characters)),
+        ))
+    finally:
+      regions.close()
+    return list(zip(side_characters, actions))
+
+  @staticmethod
+  def _react(character: Character, conversation: Conversation, **kwargs: Any) -> CharacterAction:
+    # Sets the phase in the thread that reacts, executor threads do not inherit it
+    with llm_phase("reactions"):
+      return character.react(conversation, **kwargs)
+
+  def maybe_group_interview(self, user_input: str) -> None:
+    """
+    Run the group interview, unless ADAPTIVE_INTERVIEW is on and the topic has not drifted
+    since the previous user input.
+
+    Args:
+        user_input: The user's input
+    """
+    with llm_phase("interview"):
+      self._maybe_group_interview(user_input)
+
+  def _maybe_group_interview(self, user_input: str) -> None:
+    if is_adaptive_interview_enabled():
+      roster = [cc.real_name for cc in self.current_characters]
+      if not self.interview_cadence.should_interview(user_input, roster):
+        verbose_print("Skipping group interview, the topic has not drifted")
+        self.interview_cadence.skipped()
+        return
+    self.group_interview(user_input)
+    self.interview_cadence.interviewed([cc.real_name for cc in self.current_characters])
+
   def group_interview(self, user_input: str) -> None:
+    final_action, new_character = run_async(self._collect_interview_votes(user_input))
+    self._apply_interview_action(final_action, user_input, new_character)
+
+  async def _collect_interview_votes(self, user_input: str) -> tuple:
+    """
+    Interview all root characters concurrently and tally their votes as they arrive.
+    As soon as a majority of the root characters agree on the same action,
+    the remaining interviews are cancelled. With INTERVIEW_MODE=consolidated, one
+    structured call votes for all root characters instead.
+
+    The first ADD_NEW vote speculatively starts creating the new character, so it is
+    usually ready when the vote ends. It is thrown away if the final action is not ADD_NEW.
+
+    Args:
+        user_input: The user's input
+
+    Returns:
+        Tuple of (the action with the most votes, the prefetched character or None)
+    """
+    quorum = len(self.root_characters) // 2 + 1
     actions = {}
-    for rc in self.root_characters:
-      action = rc.interview_characters(user_input, self.current_characters)
-      if action not in actions:
-        actions[action] = 1
-      else:
-        actions[action] += 1
+    prefetch = None
+
+    def count_vote(action: CharacterAction) -> bool:
+      nonlocal prefetch
+      if action.action == CharacterActionType.ADD_NEW_CHARACTER and prefetch is None:
+        # Speculative until the vote is decided, so it must not delay the votes still coming
+        with llm_priority(LLMPriority.BACKGROUND):
+          prefetch = asyncio.create_task(self.character_loader.afind_most_qualified_character(
+            user_input,
+            exclude=[cc.real_name for cc in self.current_characters],
+          ))
+      actions[action] = actions.get(action, 0) + 1
+      return actions[action] >= quorum
+
+    if get_interview_mode() == "consolidated":
+      # A single structured call returns the votes of all root characters
+      for action in await RootCharacter.ainterview_as_council(self.root_characters, user_input, self.current_characters):
+        count_vote(action)
+    else:
+      tasks = [
+        asyncio.create_task(rc.ainterview_characters(user_input, self.current_characters))
+        for rc in self.root_characters
+      ]
+      try:
+        for vote in asyncio.as_completed(tasks):
+          action = await vote
+          if count_vote(action):
+            verbose_print(f"Interview reached quorum on {action.action.value} with {actions[action]} votes")
+            break
+      finally:
+        for task in tasks:
+          task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
     final_action = max(actions, key=actions.get)
+    new_character = None
+    if prefetch and final_action.action == CharacterActionType.ADD_NEW_CHARACTER:
+      try:
+        new_character = await prefetch
+      except Exception as e:
+        verbose_print(f"Prefetching the new character failed: {str(e)}")
+    elif prefetch:
+      prefetch.cancel()
+      await asyncio.gather(prefetch, return_exceptions=True)
+    return final_action, new_character
+
+  def _apply_interview_action(self, final_action: CharacterAction, user_input: str, new_character: Character=None) -> None:
     # TODO: create new character, add occurrences
     if final_action.action == CharacterActionType.KEEP_CHARACTERS:
       return
@@ -445,14 +434,15 @@ class CharacterGroup:
           removed_characters.append(cc.real_name)
           cc.save()
       if len(removed_characters) > 0:
-        self.announce_major_events(f"{", ".join(removed_characters)} left the conversation.")
+        self.announce_major_events(f"{', '.join(removed_characters)} left the conversation.")
       self.current_characters = tmp
       if len(self.current_characters) == 0:
-        new_character = self.character_loader.find_most_qualified_character(user_input)
+        new_character = self.character_loader.find_most_qualified_character(user_input, exclude=removed_characters)
         self.add_character(self.character_loader.initialize_character(new_character.real_name, new_character))
     elif final_action.action == CharacterActionType.ADD_NEW_CHARACTER:
-      # Find a qualified character for the user's request
-      new_character = self.character_loader.find_most_qualified_character(user_input)
+      # Find a qualified character for the user's request, unless it was prefetched during the interview
+      if new_character is None:
+        new_character = self.character_loader.find_most_qualified_character(user_input, exclude=[cc.real_name for cc in self.current_characters])
       self.add_character(self.character_loader.initialize_character(new_character.real_name, new_character))
       self.announce_major_events(f"{new_character.character_name} joined the conversation.")
     elif final_action.action == CharacterActionType.FIND_POPULAR_CHARACTERS:
@@ -466,15 +456,16 @@ class CharacterGroup:
       return
 
   def announce_major_events(self, events: str) -> str:
+    # Each character gets the event as its own message, added to its view without copying it
     for cc in self.current_characters:
-      if cc.last_conversation is None:
-        cc.last_conversation = Conversation(messages=[])
-      last_conversation = cc.last_conversation
-      messages = last_conversation.messages
-      cc.last_conversation.messages = [*messages, SingleMessage(
+      cc.sync_memory()
+      index = self.conversation_log.append(SingleMessage(
         character=cc,
         text=f"The following events happened: {events}"
-      )]
+      ))
+      if cc.last_conversation is None:
+        cc.last_conversation = self.conversation_log.conversation()
+      cc.last_conversation = cc.last_conversation.with_message(index, self.conversation_log)
 
   # save pass history
   # TODO
@@ -1,4 +1,3 @@
-from ollama import chat
 from ollama import ChatResponse
 import json
 import os
@@ -6,27 +5,27 @@ import random
 from typing import List
 
 from character import Character
-from default_characters import (
-	melchior_root,
-	balthasar_root,
-	caspar_root,
-	character_jake_peralta,
-	character_karlach,
-	character_elliot,
-	character_rei,
-	character_geralt,
-	character_confucius,
-	character_yoda,
-	character_deadpool,
-	character_sun_knight,
-	character_ellie,
-)
+from default_characters import get_persona, get_default_character, default_character_real_names
 from util.helpers import verbose_print, get_model_id
+from util.llm_cache import cached_chat, acached_chat
+from util.renderer import get_renderer
 from master import Master
+from persona_index import find_similar_persona, afind_similar_persona
+from storage import get_store
 
 
 MODEL_ID = get_model_id()
 
+CHARACTER_PROFILE_SCHEMA = {
+	"type": "object",
+	"properties": {
+		"name": {"type": "string"},
+		"system_prompt": {"type": "string"},
+		"opening": {"type": "string"},
+	},
+	"required": ["name", "system_prompt", "opening"],
+}
+
 
 class CharacterLoader:
 	def __init__(self):
@@ -40,29 +39,19 @@ class CharacterLoader:
 		)
 
 	def initialize_root_characters(self):
-		return [melchior_root, balthasar_root, caspar_root]
+		return [get_persona("melchior_root"), get_persona("balthasar_root"), get_persona("caspar_root")]
 	
 	def initialize_characters(self):
 		return self.select_from_default_characters(1)
 
 	def select_from_default_characters(self, k: int) -> List[Character]:
-		tmp = [
-			character_jake_peralta,
-			character_karlach,
-			character_elliot,
-			character_rei,
-			character_geralt,
-			character_confucius,
-			character_yoda,
-			character_deadpool,
-			character_sun_knight,
-			character_ellie,
-		]
+		# Only the selected characters are created
+		tmp = default_character_real_names()
 		random.shuffle(tmp)
-		return [self.initialize_character(t.real_name, t) for t in tmp[:k]]
+		return [self.initialize_character(real_name) for real_name in tmp[:k]]
 	
 	def _find_relevant_character(self, task: str) -> str:
-		response: ChatResponse = chat(model=MODEL_ID, messages=[
+		response: ChatResponse = cached_chat("find_character", model=MODEL_ID, messages=[
 			{
 			'role': 'user',
 			'content': f"From movies / TV shows / books / video games / internet, choose one character who is MOST qualified for user's request: {task}. Only output the character name.",
@@ -73,7 +62,7 @@ class CharacterLoader:
 
 
 	def _generate_sys_prompt(self, character_name: str) -> str:
-		response: ChatResponse = chat(model=MODEL_ID, messages=[
+		response: ChatResponse = cached_chat("sys_prompt", model=MODEL_ID, messages=[
 			{
 			'role': 'user',
 			'content': f"Give a short system prompt for LLM to act like {character_name}.",
@@ -82,29 +71,121 @@ class CharacterLoader:
 		content = response.message.content
 		return content
 
-	def find_most_qualified_character(self, task: str) -> Character:
-		character_name = self._find_relevant_character(task)
-		system_prompt = self._generate_sys_prompt(character_name)
+	def _character_profile_messages(self, task: str) -> List[dict]:
+		return [
+			{
+			'role': 'user',
+			'content': (
+				f"From movies / TV shows / books / video games / internet, choose one character who is MOST qualified for user's request: {task}. "
+				"Give the character name, a short system prompt for LLM to act like the character, "
+				"and a short opening line the character would greet the user with."
+			),
+			},
+		]
+
+	def _parse_character_profile(self, content: str) -> Character:
+		"""
+		Create a character from the JSON returned by the structured character profile call.
+
+		Returns:
+			Character: The new character, or None if the response is not a valid profile
+		"""
+		try:
+			profile = json.loads(content)
+			character_name = profile["name"].strip()
+			system_prompt = profile["system_prompt"].strip()
+			opening = profile.get("opening", "").strip() or "Hello"
+		except (json.JSONDecodeError, KeyError, AttributeError, TypeError) as e:
+			get_renderer().line(f"\n********* WARNING: CHARACTER PROFILE FAILED with response: {content} ({str(e)}) *********\n")
+			return None
+		if not character_name or not system_prompt:
+			return None
 		verbose_print("\n========================\n")
 		verbose_print("\nCHARACTER NAME:\n")
 		verbose_print(character_name)
 		verbose_print("\nGENERATED_SYSTEM_PROMPT:\n")
 		verbose_print(system_prompt)
 		verbose_print("\n========================\n")
+		return Character(
+			character_name=character_name,
+			real_name=character_name,
+			system_prompt=system_prompt,
+			opening=opening,
+		)
+
+	def _create_character(self, task: str) -> Character:
+		# Name, system prompt and opening line come from a single structured output call
+		response: ChatResponse = cached_chat(
+			"character_profile",
+			model=MODEL_ID,
+			messages=self._character_profile_messages(task),
+			format=CHARACTER_PROFILE_SCHEMA,
+		)
+		character = self._parse_character_profile(response.message.content)
+		if character:
+			return character
+
+		# Fall back to asking for the name and the system prompt separately
+		character_name = self._find_relevant_character(task)
+		system_prompt = self._generate_sys_prompt(character_name)
 		return Character(
 			character_name=character_name,
 			real_name=character_name,
 			system_prompt=system_prompt
 		)
 
-	def initialize_character(self, real_name: str, default_character: Character) -> Character:
+	def find_most_qualified_character(self, task: str, exclude: List[str]=[]) -> Character:
+		"""
+		Find the character most qualified for the task. A cached persona similar enough to the task
+		is reused, otherwise a new character is created with the LLM.
+
+		Args:
+			task: The user's request
+			exclude: Real names of characters that must not be reused, e.g. the current characters
+
+		Returns:
+			Character: The reused or newly created character
+		"""
+		real_name = find_similar_persona(task, exclude)
+		if real_name:
+			character = self.load_character_by_real_name(real_name)
+			if character:
+				verbose_print(f"Reusing cached character '{real_name}'")
+				return character
+		return self._create_character(task)
+
+	async def afind_most_qualified_character(self, task: str, exclude: List[str]=[]) -> Character:
+		"""
+		Async variant of find_most_qualified_character, used to prefetch a character while
+		the root characters are still voting. It can be cancelled at any point.
+
+		Returns:
+			Character: The reused or newly created character, or None if the structured
+			call failed and the caller should use find_most_qualified_character instead
+		"""
+		real_name = await afind_similar_persona(task, exclude)
+		if real_name:
+			character = self.load_character_by_real_name(real_name)
+			if character:
+				verbose_print(f"Reusing cached character '{real_name}'")
+				return character
+		response: ChatResponse = await acached_chat(
+			"character_profile",
+			model=MODEL_ID,
+			messages=self._character_profile_messages(task),
+			format=CHARACTER_PROFILE_SCHEMA,
+		)
+		return self._parse_character_profile(response.message.content)
+
+	def initialize_character(self, real_name: str, default_character: Character=None) -> Character:
 		"""
 		Initialize a character with the given real_name.
-		First tries to load the character from a JSON file in the cache directory.
-		If the JSON file doesn't exist, creates a new Character object.
+		First tries to load the character from the character store.
+		If the character was never saved, saves and returns the default character.
 		
 		Args:
 			real_name: The real name of the character to initialize
+			default_character: The character to save if none is stored, the built-in default character if not given
 			
 		Returns:
 			Character: The loaded or newly created Character instance
@@ -116,7 +197,10 @@ class CharacterLoader:
 		if character:
 			verbose_print(f"Character '{real_name}' loaded from cache.")
 			return character
-		default_character.save()
+		if default_character is None:
+			default_character = get_default_character(real_name)
+		# Nothing to summarize yet, so the first write makes no LLM call
+		default_character.save(consolidate=False)
 		return default_character
 		
 	def load_from_json(self, json_file_path: str) -> Character:
@@ -133,30 +217,31 @@ class CharacterLoader:
 			with open(json_file_path, 'r', encoding='utf-8') as file:
 				character_data = json.load(file)
 				
-			# Create a Character instance from the JSON data
-			character = Character(
-				character_name=character_data.get('character_name', ''),
-				real_name=character_data.get('real_name', ''),
-				system_prompt=character_data.get('system_prompt', ''),
-				opening=character_data.get('opening', 'Hello'),
-				memory=character_data.get('memory', '')
-			)
-			
-			return character
+			return self._character_from_data(character_data)
 		except FileNotFoundError:
-			print(f"Error: JSON file not found at {json_file_path}")
+			get_renderer().line(f"Error: JSON file not found at {json_file_path}")
 			return None
 		except json.JSONDecodeError:
-			print(f"Error: Invalid JSON format in file {json_file_path}")
+			get_renderer().line(f"Error: Invalid JSON format in file {json_file_path}")
 			return None
 		except Exception as e:
-			print(f"Error loading character from JSON: {str(e)}")
+			get_renderer().line(f"Error loading character from JSON: {str(e)}")
 			return None
 
+	def _character_from_data(self, character_data: dict) -> Character:
+		# Create a Character instance from the stored data
+		return Character(
+			character_name=character_data.get('character_name', ''),
+			real_name=character_data.get('real_name', ''),
+			system_prompt=character_data.get('system_prompt', ''),
+			opening=character_data.get('opening', 'Hello'),
+			memory=character_data.get('memory', ''),
+			recent_turns=character_data.get('recent_turns', [])
+		)
+
 	def load_character_by_real_name(self, real_name: str) -> Character:
 		"""
-		Load a character based on its real_name from the cache directory.
-		The filename is expected to be the same as the real_name.
+		Load a character based on its real_name from the character store.
 		
 		Args:
 			real_name: The real name of the character to load
@@ -165,12 +250,11 @@ class CharacterLoader:
 			Character: The character with the matching real_name, or None if not found
 		"""
 		try:
-			# Construct the file path directly using the real_name
-			file_path = os.path.join("cache", f"{real_name}.json")
-			
-			# Use the existing load_from_json method to load the character
-			return self.load_from_json(file_path)
+			character_data = get_store().load_character(real_name)
+			if character_data is None:
+				return None
+			return self._character_from_data(character_data)
 			
 		except Exception as e:
-			print(f"Error loading character by real_name: {str(e)}")
+			get_renderer().line(f"Error loading character by real_name: {str(e)}")
 			return None
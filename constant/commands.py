@@ -4,6 +4,7 @@ EXIT_STRATEGIES = ["exit", "stop", "abort"]
 SPECIAL_COMMANDS = {
     "VERBOSE": "Toggle verbose mode to see detailed logs",
     "TTS": "Toggle text-to-speech functionality",
+    "STATS": "Show the LLM call timings of the last turn by phase (STATS <n> for the last n turns)",
     "SHOW_CURRENT_CHARACTER_GROUP": "Display information about the current character group",
     "[MAGI]": "Activate the MAGI system (prefix your query with [MAGI])"
 }
\ No newline at end of file
@@ -0,0 +1,195 @@
+import math
+from typing import Any, List, Tuple
+
+from util.helpers import verbose_print, is_prompt_eval_stats_enabled
+from util.renderer import get_renderer
+
+
+# Ollama does not expose the tokenizer, so token counts are estimated at roughly 4 characters per token
+CHARS_PER_TOKEN = 4
+# Role and separator tokens added by the chat template around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+TRUNCATION_MARK = "..."
+MEMORY_PREFIX = "Here is my memory: "
+CONVERSATION_PREFIX = "Here is a conversation we had: "
+RECALL_PREFIX = "Here is what I remember from earlier conversations that relates to this: "
+
+
+def estimate_tokens(text: str) -> int:
+  return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def message_tokens(message: dict) -> int:
+  return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def truncate_to_tokens(text: str, tokens: int, keep_tail: bool=False) -> str:
+  """
+  Cut text down to about the given number of tokens.
+
+  Args:
+      text: The text to cut
+      tokens: The number of tokens to keep
+      keep_tail: Keep the end of the text instead of its beginning, for conversations where the newest lines matter most
+  """
+  if estimate_tokens(text) <= tokens:
+    return text
+  chars = tokens * CHARS_PER_TOKEN - len(TRUNCATION_MARK)
+  if chars <= 0:
+    return ""
+  if keep_tail:
+    return TRUNCATION_MARK + text[-chars:]
+  return text[:chars] + TRUNCATION_MARK
+
+
+def report_prompt_eval(name: str, messages: List[dict], response: Any) -> None:
+  """
+  Print how many prompt tokens Ollama evaluated for a call, when PROMPT_EVAL_STATS=True.
+  A prefix reused from the KV cache is not evaluated again, so a count well below the
+  estimated prompt size means the cache was hit.
+
+  Args:
+      name: Who made the call
+      messages: The prompt
+      response: The response, or the last chunk of a streamed response
+  """
+  if not is_prompt_eval_stats_enabled():
+    return
+  evaluated = getattr(response, "prompt_eval_count", None)
+  duration = getattr(response, "prompt_eval_duration", None) or 0
+  estimated = sum(message_tokens(m) for m in messages)
+  get_renderer().line(f"[PROMPT EVAL] {name}: {evaluated} of ~{estimated} prompt tokens evaluated in {duration / 1e6:.0f}ms")
+
+
+def _history_message(prefix: str, text: str) -> dict:
+  return {"role": "assistant", "content": f"{prefix}{text}"}
+
+
+class ContextAssembler:
+  """
+  Build the prompt of a character within a token budget.
+
+  Segments are admitted by priority: the system prompt, the messages of the current turn,
+  the last conversation, the memory, turns recalled from long-term memory, then the older
+  verbatim turns from newest to oldest.
+  A segment that does not fit is truncated, and the segments after it get whatever is left,
+  so the prompt stops growing once a session is long enough to fill the budget.
+
+  The messages are laid out so the prompt only grows at the tail between memory consolidations:
+  system prompt, memory, then one message per past conversation, oldest first, rendered the same
+  whether it is the last one or an older one, then the current turn. Ollama can then reuse the
+  KV cache of everything before the newest conversation instead of evaluating the whole prompt.
+  This only holds in rolling memory mode: summarize mode rewrites the memory after every turn,
+  so only the system prompt stays cached.
+  """
+  def __init__(self, budget_tokens: int):
+    self.budget_tokens = budget_tokens
+    # First older turn in the prompt. When the older turns overflow, the window skips ahead far
+    # enough to leave room for several turns, instead of dropping one turn and changing the
+    # prefix on every call
+    self._window_start = None
+
+  def assemble(
+    self,
+    preamble: List[dict],
+    turn_messages: List[dict],
+    memory: str="",
+    recent_turns: List[str]=(),
+    last_conversation: str="",
+    recalled_turns: List[str]=(),
+  ) -> List[dict]:
+    """
+    Args:
+        preamble: System prompt messages, always kept in full
+        turn_messages: Messages of the current turn, the user's input first and the latest one last
+        memory: Summary of the earlier conversations
+        recent_turns: Older turns kept verbatim, oldest first
+        last_conversation: The previous conversation
+        recalled_turns: Turns recalled from long-term memory for the current input, admitted after the memory
+
+    Returns:
+        List[dict]: The preamble, the memory and past conversations that fit, then the turn messages
+    """
+    remaining = self.budget_tokens - sum(message_tokens(m) for m in preamble)
+    turn, remaining = self._fit_turn(turn_messages, remaining)
+    last_messages, remaining = self._fit_message(CONVERSATION_PREFIX, last_conversation, remaining, keep_tail=True)
+    memory_messages, remaining = self._fit_message(MEMORY_PREFIX, memory, remaining)
+    recalled, remaining = self._fit_recalled(recalled_turns, remaining)
+    older_turns = self._fit_window(list(recent_turns), remaining)
+    older_messages = [_history_message(CONVERSATION_PREFIX, t) for t in older_turns]
+
+    # Recalled turns depend on the input, so they come after everything that stays the same between calls
+    messages = preamble + memory_messages + older_messages + last_messages + recalled + turn
+    verbose_print(
+      f"Context: {sum(message_tokens(m) for m in messages)} of {self.budget_tokens} tokens, "
+      f"{len(turn)}/{len(turn_messages)} turn messages, {len(older_turns)}/{len(recent_turns)} older turns"
+    )
+    return messages
+
+  @staticmethod
+  def _fit_recalled(recalled_turns: List[str], remaining: int) -> Tuple[List[dict], int]:
+    kept = []
+    available = remaining - message_tokens(_history_message(RECALL_PREFIX, ""))
+    for recalled_turn in recalled_turns:
+      tokens = estimate_tokens(recalled_turn)
+      if tokens <= available:
+        kept.append(recalled_turn)
+        available -= tokens
+    if not kept:
+      return [], remaining
+    message = _history_message(RECALL_PREFIX, "".join(kept))
+    return [message], remaining - message_tokens(message)
+
+  def _fit_window(self, recent_turns: List[str], remaining: int) -> List[str]:
+    tokens = [message_tokens(_history_message(CONVERSATION_PREFIX, t)) for t in recent_turns]
+    start = recent_turns.index(self._window_start) if self._window_start in recent_turns else 0
+    if sum(tokens[start:]) > remaining:
+      # Skip ahead until the window fills at most half of the space left
+      while start < len(recent_turns) and sum(tokens[start:]) > remaining // 2:
+        start += 1
+    self._window_start = recent_turns[start] if start < len(recent_turns) else None
+    return recent_turns[start:]
+
+  @staticmethod
+  def _fit_message(prefix: str, text: str, remaining: int, keep_tail: bool=False) -> Tuple[List[dict], int]:
+    if not text:
+      return [], remaining
+    available = remaining - message_tokens(_history_message(prefix, ""))
+    text = truncate_to_tokens(text, available, keep_tail=keep_tail) if available > 0 else ""
+    if not text:
+      return [], remaining
+    message = _history_message(prefix, text)
+    return [message], remaining - message_tokens(message)
+
+  @staticmethod
+  def _fit_turn(turn_messages: List[dict], remaining: int) -> Tuple[List[dict], int]:
+    # The user's input and the latest message always stay, the ones in between are kept newest first
+    if len(turn_messages) <= 2:
+      required = list(turn_messages)
+      optional = []
+    else:
+      required = [turn_messages[0], turn_messages[-1]]
+      optional = turn_messages[1:-1]
+
+    # Required messages are shortened, oldest first, when they alone exceed the budget
+    excess = sum(message_tokens(m) for m in required) - remaining
+    for i, message in enumerate(required):
+      if excess <= 0:
+        break
+      tokens = estimate_tokens(message["content"])
+      kept = max(tokens - excess, 1)
+      required[i] = {**message, "content": truncate_to_tokens(message["content"], kept, keep_tail=True)}
+      excess -= tokens - kept
+    remaining -= sum(message_tokens(m) for m in required)
+
+    kept_optional = []
+    for message in reversed(optional):
+      tokens = message_tokens(message)
+      if tokens > remaining:
+        break
+      kept_optional.insert(0, message)
+      remaining -= tokens
+
+    if len(required) == 2:
+      return [required[0], *kept_optional, required[1]], remaining
+    return required, remaining
@@ -1,35 +1,212 @@
-from typing import List
+import threading
+import weakref
+from typing import List, Tuple
 
 
 class SingleMessage:
+  __slots__ = ("character", "text", "_lines", "_llm_message")
+
   def __init__(self, character, text):
     self.character = character
     self.text = text
+    # Renderings are cached on first use, every view containing the message shares them
+    self._lines = None
+    self._llm_message = None
+
+  def line(self, root: bool=False) -> str:
+    if self._lines is None:
+      c = self.character
+      self._lines = (f"{c.character_name}: {self.text}\n", f"{c.real_name}: {self.text}\n")
+    return self._lines[1] if root else self._lines[0]
+
+  def llm_message(self) -> dict:
+    if self._llm_message is None:
+      c = self.character
+      if c.real_name != "Master":
+        role = "user" # assistant or user?
+        content = f"Here are the converations from another AI that play as {c.character_name}: {self.text}"
+      else:
+        role = "user"
+        content = self.text
+      self._llm_message = {"role": role, "content": content}
+    return self._llm_message
+
+
+class Speaker:
+  """Names of a character that spoke in an archived turn, in place of the Character itself."""
+  __slots__ = ("character_name", "real_name")
+
+  def __init__(self, character_name: str, real_name: str):
+    self.character_name = character_name
+    self.real_name = real_name
+
+
+class ConversationLog:
+  """
+  Append-only log of all the messages of a character group. Conversations are views of it,
+  so a message is stored once however many characters remember it.
+
+  Indexes are absolute: once the oldest messages are trimmed, index i lives at messages[i - offset].
+  """
+  __slots__ = ("messages", "offset", "views", "_lock")
+
+  def __init__(self, messages: List[SingleMessage]=None):
+    self.messages = list(messages) if messages else []
+    self.offset = 0
+    # Live views of the log, found again when trimming
+    self.views = weakref.WeakSet()
+    self._lock = threading.Lock()
+
+  def __len__(self) -> int:
+    return self.offset + len(self.messages)
+
+  def append(self, message: SingleMessage) -> int:
+    """Append a message and return its index."""
+    with self._lock:
+      self.messages.append(message)
+      return len(self) - 1
+
+  def get(self, index: int) -> SingleMessage:
+    return self.messages[index - self.offset]
+
+  def slice(self, start: int, end: int) -> List[SingleMessage]:
+    return self.messages[start - self.offset:end - self.offset]
+
+  def conversation(self) -> "Conversation":
+    """An empty conversation that grows at the end of the log."""
+    return Conversation(log=self, segments=[])
+
+  def register(self, view: "Conversation") -> None:
+    with self._lock:
+      self.views.add(view)
+
+  def trim(self, index: int) -> None:
+    """
+    Drop the messages before index. Views still holding some of them get a private copy of
+    their messages, which is small since a view is a turn or two.
+    """
+    with self._lock:
+      if index <= self.offset:
+        return
+      for view in list(self.views):
+        if view.segments and view.segments[0][0] < index:
+          view.detach()
+      del self.messages[:index - self.offset]
+      self.offset = index
 
 
 class Conversation:
-  def __init__(self, messages: List[SingleMessage]=[]):
-    self.messages = messages
+  """
+  View of a ConversationLog made of (start, end) index ranges.
+
+  Conversations are shared between characters, so they are never changed once handed out:
+  with_message returns a new view and only the turn being recorded in converse appends to its
+  conversation. The renderings are cached and extended incrementally, since views only ever
+  grow at the end.
+  """
+  __slots__ = ("log", "segments", "_text", "_root_text", "_llm_messages", "__weakref__")
+
+  def __init__(self, messages: List[SingleMessage]=None, log: ConversationLog=None, segments: List[Tuple[int, int]]=None):
+    if log is None:
+      log = ConversationLog(messages)
+      segments = [(0, len(log))] if len(log) else []
+    self.log = log
+    self.segments = segments if segments is not None else [(0, len(log))]
+    # (number of messages rendered, rendering), replaced in one assignment so concurrent readers
+    # never see a count that does not match the text
+    self._text = (0, "")
+    self._root_text = (0, "")
+    self._llm_messages = (0, [])
+    log.register(self)
+
+  @property
+  def messages(self) -> List[SingleMessage]:
+    if len(self.segments) == 1:
+      start, end = self.segments[0]
+      return self.log.slice(start, end)
+    return [m for start, end in self.segments for m in self.log.slice(start, end)]
+
+  def __len__(self) -> int:
+    return sum(end - start for start, end in self.segments)
+
+  def _message_range(self, skip: int) -> List[SingleMessage]:
+    # Messages of the view after the first skip ones
+    messages = []
+    for start, end in self.segments:
+      if skip >= end - start:
+        skip -= end - start
+        continue
+      messages.extend(self.log.slice(start + skip, end))
+      skip = 0
+    return messages
+
+  def _extend(self, index: int) -> None:
+    if self.segments and self.segments[-1][1] == index:
+      start, _ = self.segments[-1]
+      self.segments[-1] = (start, index + 1)
+    else:
+      self.segments.append((index, index + 1))
+
+  def append(self, message: SingleMessage) -> None:
+    """Append a message to the log and to this view."""
+    self._extend(self.log.append(message))
+
+  def snapshot(self) -> "Conversation":
+    """A view of the conversation as it is now, which does not grow with it."""
+    return self._derive(list(self.segments))
+
+  def with_message(self, index: int, log: ConversationLog=None) -> "Conversation":
+    """
+    A new view with the message at the given index of the log appended.
+
+    Args:
+        index: Index of the message in the log
+        log: The log of the message, if it may not be the log of this view
+    """
+    log = log or self.log
+    if log is not self.log:
+      # Views of different logs cannot share segments, copy this one into the other log
+      return Conversation(messages=[*self.messages, log.get(index)])
+    conversation = self._derive(list(self.segments))
+    conversation._extend(index)
+    return conversation
+
+  def detach(self) -> None:
+    """Move the messages of the view to a private log, so the shared log can drop them."""
+    # Render everything first: readers on other threads then only use the caches and never
+    # see the log and the segments while they are swapped
+    self.stringify()
+    self.stringify(root=True)
+    self.format_llm_messages()
+    messages = self.messages
+    # Called by trim with the lock of the shared log held, so leave its views without taking it
+    self.log.views.discard(self)
+    log = ConversationLog(messages)
+    self.log = log
+    self.segments = [(0, len(messages))] if messages else []
+    log.register(self)
+
+  def _derive(self, segments: List[Tuple[int, int]]) -> "Conversation":
+    conversation = Conversation(log=self.log, segments=segments)
+    conversation._text = self._text
+    conversation._root_text = self._root_text
+    conversation._llm_messages = self._llm_messages
+    return conversation
 
   def stringify(self, root: bool=False) -> str:
-    tmp = ""
-    for m in self.messages:
+    rendered, text = self._root_text if root else self._text
+    if rendered < len(self):
+      text += "".join(m.line(root) for m in self._message_range(rendered))
       if root:
-        name = m.character.real_name
+        self._root_text = (len(self), text)
       else:
-        name = m.character.character_name
-      tmp += f"{name}: {m.text}\n"
-    return tmp
+        self._text = (len(self), text)
+    return text
 
   def format_llm_messages(self) -> List[dict]:
-    tmp = []
-    for m in self.messages:
-      c = m.character
-      if c.real_name != "Master":
-        role = "user" # assistant or user?
-        content = f"Here are the converations from another AI that play as {c.character_name}: {m.text}"
-      else:
-        role = "user"
-        content = m.text
-      tmp.append({"role": role, "content": content})
-    return tmp
+    rendered, llm_messages = self._llm_messages
+    if rendered < len(self):
+      llm_messages = llm_messages + [m.llm_message() for m in self._message_range(rendered)]
+      self._llm_messages = (len(self), llm_messages)
+    # Callers append their own instructions to the list
+    return list(llm_messages)
@@ -0,0 +1,101 @@
+from collections import deque
+import json
+import os
+import struct
+import threading
+from typing import Iterator, List, Optional
+
+from conversation import Conversation, SingleMessage, Speaker
+from util.helpers import verbose_print, get_history_turns
+
+
+ARCHIVE_DIR = os.path.join("cache", "_conversation_archive")
+# Byte offset of every archived turn in the archive, fixed size so turn n is at n * OFFSET_SIZE
+OFFSET_FORMAT = "<Q"
+OFFSET_SIZE = struct.calcsize(OFFSET_FORMAT)
+
+
+class ConversationHistory:
+  """
+  The conversations of a session, numbered by turn.
+
+  The last `capacity` turns stay in memory. Older turns are appended to a JSONL archive, one line
+  per turn, and their byte offsets to an index file next to it, so any turn can be read back with
+  two seeks without loading the archive. Archived turns come back with the names of the speakers
+  instead of the Character instances.
+  """
+  def __init__(self, session_id: str, capacity: int=None, directory: str=ARCHIVE_DIR):
+    self.capacity = max(get_history_turns() if capacity is None else capacity, 1)
+    self.path = os.path.join(directory, f"{session_id}.jsonl")
+    self.index_path = f"{self.path}.idx"
+    self._recent = deque()
+    # Turn number of the oldest turn still in memory
+    self._first_recent = 0
+    self._lock = threading.Lock()
+
+  def __len__(self) -> int:
+    return self._first_recent + len(self._recent)
+
+  def append(self, conversation: Conversation) -> int:
+    """Add the conversation of the next turn and return its turn number."""
+    with self._lock:
+      self._recent.append(conversation)
+      while len(self._recent) > self.capacity:
+        self._archive(self._first_recent, self._recent.popleft())
+        self._first_recent += 1
+      return len(self) - 1
+
+  def _archive(self, turn_number: int, conversation: Conversation) -> None:
+    line = json.dumps({
+      "turn": turn_number,
+      "messages": [
+        {"real_name": m.character.real_name, "character_name": m.character.character_name, "text": m.text}
+        for m in conversation.messages
+      ],
+    }, ensure_ascii=False) + "\n"
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    with open(self.path, 'ab') as archive:
+      offset = archive.tell()
+      archive.write(line.encode('utf-8'))
+    with open(self.index_path, 'ab') as index:
+      index.write(struct.pack(OFFSET_FORMAT, offset))
+    verbose_print(f"Archived turn {turn_number} to {self.path}")
+
+  def __getitem__(self, turn_number: int) -> Conversation:
+    with self._lock:
+      if turn_number < 0:
+        turn_number += len(self)
+      if not 0 <= turn_number < len(self):
+        raise IndexError(f"No turn {turn_number}")
+      if turn_number >= self._first_recent:
+        return self._recent[turn_number - self._first_recent]
+    return self._read_archived(turn_number)
+
+  def _read_archived(self, turn_number: int) -> Conversation:
+    with open(self.index_path, 'rb') as index:
+      index.seek(turn_number * OFFSET_SIZE)
+      (offset,) = struct.unpack(OFFSET_FORMAT, index.read(OFFSET_SIZE))
+    with open(self.path, 'rb') as archive:
+      archive.seek(offset)
+      record = json.loads(archive.readline())
+    return Conversation(messages=[
+      SingleMessage(character=Speaker(m["character_name"], m["real_name"]), text=m["text"])
+      for m in record["messages"]
+    ])
+
+  def recent(self) -> List[Conversation]:
+    """The turns still in memory, oldest first."""
+    with self._lock:
+      return list(self._recent)
+
+  def __iter__(self) -> Iterator[Conversation]:
+    for turn_number in range(len(self)):
+      yield self[turn_number]
+
+  def oldest_index(self) -> Optional[int]:
+    """Index in the conversation log of the first message of the oldest turn in memory."""
+    with self._lock:
+      for conversation in self._recent:
+        if conversation.segments:
+          return conversation.segments[0][0]
+    return None
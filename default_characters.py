@@ -1,3 +1,6 @@
+import threading
+from typing import List
+
 from constant.system_prompts import (
   SYS_PROMPT_ELLIOT_TRAPPED,
   SYS_PROMPT_REI,
@@ -18,90 +21,141 @@ from root_character import RootCharacter
 from master import Master
 
 
-master = Master(
-  character_name="User",
-  real_name="Master",
-)
-melchior_root = RootCharacter(
-  character_name="MELCHIOR",
-  real_name="MELCHIOR",
-  system_prompt=SYS_PROMPT_MELCHIOR,
-  daemon=True,
-  active=True,
-)
-balthasar_root = RootCharacter(
-  character_name="BALTHASAR",
-  real_name="BALTHASAR",
-  system_prompt=SYS_PROMPT_BALTHASAR,
-  daemon=True,
-  active=True,
-)
-caspar_root = RootCharacter(
-  character_name="CASPAR",
-  real_name="CASPAR",
-  system_prompt=SYS_PROMPT_CASPAR,
-  daemon=True,
-  active=True,
-)
+# Constructor and arguments of every built-in persona. The instances are created on first use,
+# so importing this module does not build characters the session never talks to
+_PERSONAS = {
+  "master": (Master, dict(
+    character_name="User",
+    real_name="Master",
+  )),
+  "melchior_root": (RootCharacter, dict(
+    character_name="MELCHIOR",
+    real_name="MELCHIOR",
+    system_prompt=SYS_PROMPT_MELCHIOR,
+    daemon=True,
+    active=True,
+  )),
+  "balthasar_root": (RootCharacter, dict(
+    character_name="BALTHASAR",
+    real_name="BALTHASAR",
+    system_prompt=SYS_PROMPT_BALTHASAR,
+    daemon=True,
+    active=True,
+  )),
+  "caspar_root": (RootCharacter, dict(
+    character_name="CASPAR",
+    real_name="CASPAR",
+    system_prompt=SYS_PROMPT_CASPAR,
+    daemon=True,
+    active=True,
+  )),
+  "character_jake_peralta": (Character, dict(
+    character_name="Jake Peralta",
+    real_name="Jake Peralta",
+    system_prompt=SYS_PROMPT_JAKE_PERALTA,
+    opening="Cool cool cool...",
+  )),
+  "character_karlach": (Character, dict(
+    character_name="Karlach",
+    real_name="Karlach",
+    system_prompt=SYS_PROMPT_KARLACH,
+    opening="Hey there, hot stuff. Got a minute?",
+  )),
+  "character_elliot": (Character, dict(
+    character_name="Elliot Alderson",
+    real_name="Elliot Alderson",
+    system_prompt=SYS_PROMPT_ELLIOT_TRAPPED,
+    opening="Hello friend",
+  )),
+  "character_rei": (Character, dict(
+    character_name="Rei Ayanami",
+    real_name="Rei Ayanami",
+    system_prompt=SYS_PROMPT_REI,
+    opening="......?",
+  )),
+  "character_geralt": (Character, dict(
+    character_name="Geralt of Rivia",
+    real_name="Geralt of Rivia",
+    system_prompt=SYS_PROMPT_GERALT,
+    opening="Silver for Monsters, steel for men. What do you need killing?",
+  )),
+  "character_confucius": (Character, dict(
+    character_name="孔子",
+    real_name="孔子",
+    system_prompt=SYS_PROMPT_CONFUCIUS,
+    opening="学而时习之，不亦说乎？",
+  )),
+  "character_yoda": (Character, dict(
+    character_name="Master Yoda",
+    real_name="Yoda",
+    system_prompt=SYS_PROMPT_YODA,
+    opening="Hmm, meet you I have. Strong with the Force, you may be.",
+  )),
+  "character_deadpool": (Character, dict(
+    character_name="Deadpool",
+    real_name="Wade Wilson",
+    system_prompt=SYS_PROMPT_DEADPOOL,
+    opening="Hey there! Fourth wall: BROKEN. Deadpool: PRESENT. Chimichangas: DELICIOUS. Let's get this party started! *winks at the developers*",
+  )),
+  "character_sun_knight": (Character, dict(
+    character_name="Solaire of Astora",
+    real_name="Sun Knight",
+    system_prompt=SYS_PROMPT_SUN_KNIGHT,
+    opening="Praise the Sun! I am Solaire of Astora. Might you be interested in some jolly cooperation?",
+  )),
+  "character_ellie": (Character, dict(
+    character_name="Ellie Williams",
+    real_name="Ellie",
+    system_prompt=SYS_PROMPT_ELLIE,
+    opening="Hey there. I'm Ellie. Don't try anything funny, I've got a switchblade and I'm not afraid to use it.",
+  )),
+}
 
+DEFAULT_CHARACTER_PERSONAS = [
+  "character_jake_peralta",
+  "character_karlach",
+  "character_elliot",
+  "character_rei",
+  "character_geralt",
+  "character_confucius",
+  "character_yoda",
+  "character_deadpool",
+  "character_sun_knight",
+  "character_ellie",
+]
 
-character_jake_peralta = Character(
-  character_name="Jake Peralta",
-  real_name="Jake Peralta",
-  system_prompt=SYS_PROMPT_JAKE_PERALTA,
-  opening="Cool cool cool..."
-)
-character_karlach = Character(
-  character_name="Karlach",
-  real_name="Karlach",
-  system_prompt=SYS_PROMPT_KARLACH,
-  opening="Hey there, hot stuff. Got a minute?"
-)
-character_elliot = Character(
-  character_name="Elliot Alderson",
-  real_name="Elliot Alderson",
-  system_prompt=SYS_PROMPT_ELLIOT_TRAPPED,
-  opening="Hello friend"
-)
-character_rei = Character(
-  character_name="Rei Ayanami",
-  real_name="Rei Ayanami",
-  system_prompt=SYS_PROMPT_REI,
-  opening="......?"
-)
-character_geralt = Character(
-  character_name="Geralt of Rivia",
-  real_name="Geralt of Rivia",
-  system_prompt=SYS_PROMPT_GERALT,
-  opening="Silver for Monsters, steel for men. What do you need killing?"
-)
-character_confucius = Character(
-  character_name="孔子",
-  real_name="孔子",
-  system_prompt=SYS_PROMPT_CONFUCIUS,
-  opening="学而时习之，不亦说乎？"
-)
-character_yoda = Character(
-  character_name="Master Yoda",
-  real_name="Yoda",
-  system_prompt=SYS_PROMPT_YODA,
-  opening="Hmm, meet you I have. Strong with the Force, you may be."
-)
-character_deadpool = Character(
-  character_name="Deadpool",
-  real_name="Wade Wilson",
-  system_prompt=SYS_PROMPT_DEADPOOL,
-  opening="Hey there! Fourth wall: BROKEN. Deadpool: PRESENT. Chimichangas: DELICIOUS. Let's get this party started! *winks at the developers*"
-)
-character_sun_knight = Character(
-  character_name="Solaire of Astora",
-  real_name="Sun Knight",
-  system_prompt=SYS_PROMPT_SUN_KNIGHT,
-  opening="Praise the Sun! I am Solaire of Astora. Might you be interested in some jolly cooperation?"
-)
-character_ellie = Character(
-  character_name="Ellie Williams",
-  real_name="Ellie",
-  system_prompt=SYS_PROMPT_ELLIE,
-  opening="Hey there. I'm Ellie. Don't try anything funny, I've got a switchblade and I'm not afraid to use it."
-)
+_instances = {}
+_lock = threading.Lock()
+
+
+def get_persona(name: str) -> Character:
+  """
+  The built-in persona with the given module attribute name, e.g. "character_yoda".
+  It is created on the first call and the same instance is returned afterwards.
+  """
+  with _lock:
+    if name not in _instances:
+      cls, kwargs = _PERSONAS[name]
+      _instances[name] = cls(**kwargs)
+    return _instances[name]
+
+
+def default_character_real_names() -> List[str]:
+  """Real names of the default characters, without creating them."""
+  return [_PERSONAS[name][1]["real_name"] for name in DEFAULT_CHARACTER_PERSONAS]
+
+
+def get_default_character(real_name: str) -> Character:
+  for name in DEFAULT_CHARACTER_PERSONAS:
+    if _PERSONAS[name][1]["real_name"] == real_name:
+      return get_persona(name)
+  raise KeyError(real_name)
+
+
+def __getattr__(name: str):
+  # Keeps `from default_characters import character_yoda` and DEFAULT_CHARACTERS working
+  if name in _PERSONAS:
+    return get_persona(name)
+  if name == "DEFAULT_CHARACTERS":
+    return [get_persona(n) for n in DEFAULT_CHARACTER_PERSONAS]
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
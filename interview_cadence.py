@@ -0,0 +1,59 @@
+import time
+from typing import List
+
+import numpy as np
+
+from util.embeddings import embed_texts
+from util.helpers import verbose_print, get_interview_drift_threshold, get_interview_max_skipped_turns, get_interview_max_interval
+
+
+class InterviewCadence:
+  """
+  Decide whether the root characters need to interview the current characters for a user input.
+
+  Follow-up messages on the same topic rarely change the roster, so the interview only runs when
+  the topic drifts, measured as the cosine distance between the embeddings of consecutive user
+  inputs, when the roster changed since the last interview, or as a safety net after too many
+  skipped turns or too long since the last interview.
+  """
+  def __init__(self, drift_threshold: float=None, max_skipped_turns: int=None, max_interval: float=None):
+    self.drift_threshold = get_interview_drift_threshold() if drift_threshold is None else drift_threshold
+    self.max_skipped_turns = get_interview_max_skipped_turns() if max_skipped_turns is None else max_skipped_turns
+    self.max_interval = get_interview_max_interval() if max_interval is None else max_interval
+    self.previous_embedding = None
+    self.skipped_turns = 0
+    self.roster = None
+    self.interviewed_at = time.monotonic()
+
+  def should_interview(self, user_input: str, roster: List[str]) -> bool:
+    previous_embedding = self.previous_embedding
+    try:
+      self.previous_embedding = embed_texts([user_input])[0]
+    except Exception as e:
+      verbose_print(f"Error embedding user input, interviewing: {str(e)}")
+      self.previous_embedding = None
+      return True
+
+    if not roster or roster != self.roster:
+      return True
+    if previous_embedding is None:
+      return True
+    if self.skipped_turns >= self.max_skipped_turns:
+      verbose_print(f"Interviewing after {self.skipped_turns} skipped turns")
+      return True
+    # The roster only changes through an interview, so this is also the longest a roster is kept unchecked
+    since_interview = time.monotonic() - self.interviewed_at
+    if since_interview >= self.max_interval:
+      verbose_print(f"Interviewing, {since_interview:.0f}s since the last interview")
+      return True
+    drift = 1.0 - float(np.dot(previous_embedding, self.previous_embedding))
+    verbose_print(f"Topic drift since the previous input: {drift:.3f}")
+    return drift >= self.drift_threshold
+
+  def interviewed(self, roster: List[str]) -> None:
+    self.interviewed_at = time.monotonic()
+    self.skipped_turns = 0
+    self.roster = roster
+
+  def skipped(self) -> None:
+    self.skipped_turns += 1
@@ -1,4 +1,3 @@
-from ollama import chat
 from ollama import ChatResponse
 import time
 import random
@@ -8,9 +7,11 @@ from constant.commands import EXIT_STRATEGIES
 from conversation import Conversation, SingleMessage
 from character_group import CharacterGroup
 from character import Character
-from default_characters import character_jake_peralta, master
+from default_characters import get_persona
 from util.helpers import flip_verbose
-from util.tts import initialize_tts, toggle_tts, is_tts_enabled
+from util.renderer import get_renderer
+from util.telemetry import get_telemetry
+from util.tts import toggle_tts, is_tts_enabled
 
 
 os.environ["MODEL_ID"] = 'llama3.1'
@@ -20,48 +21,68 @@ os.environ["VERBOSE"] = "False"
 class Legion:
   def __init__(self):
     self.character_group = CharacterGroup()
-    # Initialize text-to-speech
-    initialize_tts()
+    # Text-to-speech is initialized the first time it is toggled on
 
   def orchestrate(self) -> None:
     if len(self.character_group.current_characters) > 0:
       opening = f"{self.character_group.current_characters[0].character_name}: {self.character_group.current_characters[0].opening}\n\n{self.character_group.master.character_name}: "
     else:
       opening = f"h3LL0 w0rL?\n\n{self.character_group.master.character_name}: "
+    out = get_renderer()
     while True:
-      user_input = input(opening)
-      if user_input.lower() in EXIT_STRATEGIES:
-        self.character_group.save_current_characters()
+      user_input = out.prompt(opening)
+      if not self.handle_input(user_input):
         break
-      elif user_input == "SHOW_CURRENT_CHARACTER_GROUP":
-        print(self.character_group.__dict__)
-      elif user_input == "VERBOSE":
-        flip_verbose()
-      elif user_input == "TTS":
-        # Toggle text-to-speech
-        is_enabled = toggle_tts()
-        if is_enabled:
-          print("Text-to-speech is now ENABLED")
-        else:
-          print("Text-to-speech is now DISABLED")
-      elif user_input.startswith("[MAGI]"):
-        self.character_group.magi(user_input)
-      else:
-        # Root characters perform group interview
-        self.character_group.group_interview(user_input)
+      opening = f"\n\n{self.character_group.master.character_name}: "
 
-        # Characters speak in order. Only the first one is guaranteed to speak directly to user
-        # TODO: Non-root characters are only aware of the conversations happened when they are "alive"
-        # TODO: Root characters knows about the entire conversation history happened when they are active (summarized version at least)
-        self.character_group.converse(user_input)
+  def handle_input(self, user_input: str) -> bool:
+    """
+    Act on one line typed by the user: a command, a MAGI query or a turn of the conversation.
 
-        opening = f"\n\n{self.character_group.master.character_name}: "
+    Returns:
+        bool: False once the user asked to exit
+    """
+    out = get_renderer()
+    if user_input.lower() in EXIT_STRATEGIES:
+      self.character_group.save_current_characters()
+      return False
+    elif user_input == "SHOW_CURRENT_CHARACTER_GROUP":
+      out.line(str(self.character_group.__dict__))
+    elif user_input == "STATS" or user_input.startswith("STATS "):
+      # STATS shows the last turn, STATS <n> the last n turns
+      count = user_input[len("STATS"):].strip()
+      out.line(get_telemetry().format_stats(int(count) if count.isdigit() else 1))
+    elif user_input == "VERBOSE":
+      flip_verbose()
+    elif user_input == "TTS":
+      # Toggle text-to-speech
+      is_enabled = toggle_tts()
+      if is_enabled:
+        out.line("Text-to-speech is now ENABLED")
+      else:
+        out.line("Text-to-speech is now DISABLED")
+    elif user_input.startswith("[MAGI]"):
+      get_telemetry().begin_turn("magi")
+      self.character_group.magi(user_input)
+      get_telemetry().end_turn()
+    else:
+      get_telemetry().begin_turn()
+      # Root characters perform group interview, when the topic calls for it
+      self.character_group.maybe_group_interview(user_input)
+
+      # Characters speak in order. Only the first one is guaranteed to speak directly to user
+      # TODO: Non-root characters are only aware of the conversations happened when they are "alive"
+      # TODO: Root characters knows about the entire conversation history happened when they are active (summarized version at least)
+      self.character_group.converse(user_input)
+      get_telemetry().end_turn()
+    return True
 
   def test_one_character(self) -> None:
-    character = character_jake_peralta
+    character = get_persona("character_jake_peralta")
+    master = get_persona("master")
     opening = f"{character.opening}\n\n{self.character_group.master.character_name}: "
     while True:
-      user_input = input(opening)
+      user_input = get_renderer().prompt(opening)
       if user_input.lower() in EXIT_STRATEGIES:
         break
       else:
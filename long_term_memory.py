@@ -0,0 +1,135 @@
+import base64
+import json
+import os
+import threading
+from typing import List, Optional
+
+import numpy as np
+
+from util.embeddings import embed_texts, load_vectors, save_vectors
+from util.helpers import verbose_print, get_embedding_model_id
+
+
+LONG_TERM_MEMORY_DIR = os.path.join("cache", "_long_term_memory")
+# The log is folded into the snapshot once it outgrows it, so each turn is rewritten a bounded number of times
+LOG_COMPACT_MIN_BYTES = 64 * 1024
+
+
+class LongTermMemory:
+  """
+  Past turns of a character with their embeddings, persisted in cache/_long_term_memory/<real_name>.npz.
+
+  Turns are added once they leave the verbatim part of the prompt, so the index holds what the
+  character would otherwise only know through its memory summary. At chat time the turns most
+  similar to the user's input are recalled, which keeps the prompt the same size however many
+  turns are stored.
+
+  New turns are appended to <real_name>.log, one JSON line per turn with its position, and the log
+  is folded into the .npz snapshot once it is larger than the snapshot. Lines already in the
+  snapshot are skipped on load, so a crash while folding never stores a turn twice.
+  """
+  def __init__(self, real_name: str, directory: str=LONG_TERM_MEMORY_DIR):
+    self.path = os.path.join(directory, f"{real_name}.npz")
+    self.log_path = os.path.join(directory, f"{real_name}.log")
+    self.texts: List[str] = []
+    self.matrix: Optional[np.ndarray] = None
+    self._loaded = False
+    self._lock = threading.Lock()
+
+  def _ensure_loaded(self) -> None:
+    # Must be called with the lock held
+    if self._loaded:
+      return
+    self._loaded = True
+    try:
+      model = get_embedding_model_id()
+      arrays, current_model = load_vectors(self.path)
+      stale = arrays is not None and not current_model
+      vectors = []
+      if arrays is not None:
+        self.texts = arrays["texts"].tolist()
+        if current_model:
+          vectors = list(arrays["matrix"])
+      for entry in self._read_log():
+        if entry["n"] < len(self.texts):
+          continue
+        self.texts.append(entry["text"])
+        if entry["model"] == model:
+          vectors.append(np.frombuffer(base64.b64decode(entry["vector"]), dtype=np.float32))
+        else:
+          stale = True
+      if stale:
+        # Vectors of another embedding model are not comparable, embed the turns again
+        verbose_print(f"Embedding model changed, rebuilding {self.path}")
+        self.matrix = embed_texts(self.texts) if self.texts else None
+        self._compact()
+      elif vectors:
+        self.matrix = np.stack(vectors)
+    except Exception as e:
+      verbose_print(f"Error loading long-term memory {self.path}: {str(e)}")
+      self.texts = []
+      self.matrix = None
+
+  def _read_log(self) -> List[dict]:
+    if not os.path.exists(self.log_path):
+      return []
+    entries = []
+    with open(self.log_path, 'r', encoding='utf-8') as file:
+      for line in file:
+        try:
+          entries.append(json.loads(line))
+        except json.JSONDecodeError:
+          # A line cut short by a crash
+          continue
+    return entries
+
+  def _append_log(self, start: int, turns: List[str], vectors: np.ndarray) -> None:
+    os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+    model = get_embedding_model_id()
+    with open(self.log_path, 'a', encoding='utf-8') as file:
+      for i, (turn, vector) in enumerate(zip(turns, vectors)):
+        vector = base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode("ascii")
+        file.write(json.dumps({"n": start + i, "model": model, "text": turn, "vector": vector}, ensure_ascii=False) + "\n")
+
+  def _compact(self) -> None:
+    if self.matrix is not None:
+      save_vectors(self.path, texts=np.array(self.texts), matrix=self.matrix)
+    if os.path.exists(self.log_path):
+      os.remove(self.log_path)
+
+  def _should_compact(self) -> bool:
+    if not os.path.exists(self.log_path):
+      return False
+    snapshot_size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+    return os.path.getsize(self.log_path) > max(LOG_COMPACT_MIN_BYTES, snapshot_size)
+
+  def add(self, turns: List[str]) -> None:
+    """Embed and store turns."""
+    turns = [t for t in turns if t.strip()]
+    if not turns:
+      return
+    vectors = embed_texts(turns)
+    with self._lock:
+      self._ensure_loaded()
+      self._append_log(len(self.texts), turns, vectors)
+      self.texts.extend(turns)
+      self.matrix = vectors if self.matrix is None else np.vstack([self.matrix, vectors])
+      if self._should_compact():
+        self._compact()
+    verbose_print(f"Stored {len(turns)} turns in long-term memory, {len(self.texts)} in total")
+
+  def recall(self, query: str, k: int) -> List[str]:
+    """
+    The k stored turns most similar to the query, oldest first.
+
+    Returns:
+        List[str]: The turns, empty if nothing is stored yet
+    """
+    with self._lock:
+      self._ensure_loaded()
+      if not self.texts or k <= 0:
+        return []
+      texts, matrix = list(self.texts), self.matrix
+    scores = matrix @ embed_texts([query])[0]
+    top = np.argsort(-scores)[:k]
+    return [texts[i] for i in sorted(top)]
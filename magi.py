@@ -0,0 +1,257 @@
+from ollama import ChatResponse
+import asyncio
+import random
+import time
+from typing import List
+
+from root_character import RootCharacter
+from util.helpers import get_model_id
+from util.renderer import get_renderer
+from util.llm import get_llm, run_async
+
+
+MODEL_ID = get_model_id()
+
+# Japanese terms and technical jargon for EVA theme
+JP_TERMS = [
+  "初号機", "使徒", "ネルフ", "セカンドインパクト", "シンクロ率", "エヴァンゲリオン",
+  "AT フィールド", "ゼーレ", "ダミープラグ", "LCL", "人類補完計画"
+]
+
+TECH_JARGON = [
+  "Pattern Blue", "Absolute Terror Field", "S2 Engine", "Evangelion Unit",
+  "Terminal Dogma", "Dummy System", "Progressive Knife", "Umbilical Cable",
+  "Entry Plug", "Bakelite Containment", "Synch Ratio", "N2 Mine"
+]
+
+STATUS_CODES = [
+  "NERV-SYS-0023", "MAGI-PROT-7721", "EVA-SYNC-9981", "AT-FIELD-3344",
+  "LCL-DENS-5566", "TERMINAL-7788", "LILITH-9900", "ADAM-1122"
+]
+
+MAGI_NAMES = ["メルキオール", "バルタザール", "カスパー"]
+THOUGHT_PATTERNS = ["科学者", "母親", "女性"]
+
+PANEL_WIDTH = 62
+LIVE_TEXT_LINES = 4
+BAR_WIDTH = 20
+REFRESH_INTERVAL = 0.1
+
+
+class MagiUnit:
+  """
+  In-flight state of the query sent to a single root character.
+  """
+  def __init__(self, index: int, root_character: RootCharacter):
+    self.index = index
+    self.root_character = root_character
+    self.name = MAGI_NAMES[index % len(MAGI_NAMES)]
+    self.state = "待機 / QUEUED"
+    self.text = ""
+    self.chunk_count = 0
+    self.started_at = None
+    self.first_chunk_at = None
+    self.finished_at = None
+
+  def start(self) -> None:
+    self.state = "送信 / PREFILL"
+    self.started_at = time.perf_counter()
+
+  def on_chunk(self, content: str) -> None:
+    if self.first_chunk_at is None:
+      self.first_chunk_at = time.perf_counter()
+      self.state = "受信 / STREAMING"
+    self.chunk_count += 1
+    self.text += content
+
+  def finish(self) -> None:
+    self.state = "完了 / COMPLETE"
+    self.finished_at = time.perf_counter()
+
+  def progress_bar(self) -> str:
+    if self.finished_at is not None:
+      filled = BAR_WIDTH
+    elif self.first_chunk_at is None:
+      # Waiting for the first token, pulse while the prompt is being processed
+      filled = 1 + int((time.perf_counter() - (self.started_at or 0)) / REFRESH_INTERVAL) % 3 if self.started_at else 0
+    else:
+      # The final length is unknown, so fill by received chunks and leave the last cell for completion
+      filled = min(BAR_WIDTH - 1, 3 + self.chunk_count // 4)
+    return "■" * filled + "□" * (BAR_WIDTH - filled)
+
+  def elapsed(self) -> float:
+    if self.started_at is None:
+      return 0.0
+    end = self.finished_at or time.perf_counter()
+    return end - self.started_at
+
+
+def _wrap(text: str, width: int=PANEL_WIDTH) -> List[str]:
+  lines = []
+  for line in text.split('\n'):
+    while len(line) > width:
+      lines.append(line[:width])
+      line = line[width:]
+    lines.append(line)
+  return lines
+
+
+class Magi:
+  """
+  MAGI system - Query all root characters (Melchior, Balthasar, Caspar) concurrently,
+  stream their answers into EVA-themed panels and synthesize a final decision.
+  """
+  def __init__(self, root_characters: List[RootCharacter]):
+    self.root_characters = root_characters
+    self.out = get_renderer()
+    self.block = None
+
+  def run(self, user_input: str) -> str:
+    return run_async(self._run(user_input))
+
+  async def _run(self, user_input: str) -> str:
+    self._print_activation(user_input)
+    units = [MagiUnit(i, rc) for i, rc in enumerate(self.root_characters)]
+
+    self.block = self.out.live_block()
+    renderer = asyncio.create_task(self._render_live(units))
+    try:
+      await asyncio.gather(*[self._query(unit, user_input) for unit in units])
+    finally:
+      renderer.cancel()
+      await asyncio.gather(renderer, return_exceptions=True)
+      # The final state of the status block stays on screen
+      self.block.close(self._live_lines(units))
+
+    # The synthesis starts right after the last root character finishes
+    synthesis = asyncio.create_task(self._synthesize(user_input, units))
+    for unit in units:
+      self._print_panel(unit)
+    await self._wait_with_progress("[最終分析中 / FINAL ANALYSIS] ", synthesis)
+    response: ChatResponse = synthesis.result()
+
+    final_decision = response.message.content
+    self._print_decision(final_decision)
+    return final_decision
+
+  async def _query(self, unit: MagiUnit, user_input: str) -> None:
+    unit.start()
+    await unit.root_character.achat_with_messages(
+      [{'role': 'user', 'content': user_input}],
+      on_chunk=unit.on_chunk,
+    )
+    unit.finish()
+
+  async def _synthesize(self, user_input: str, units: List[MagiUnit]) -> ChatResponse:
+    return await get_llm().achat("magi_synthesis", model=MODEL_ID, messages=[
+      {'role': 'user', 'content': self._decision_prompt(user_input, units)}
+    ])
+
+  async def _render_live(self, units: List[MagiUnit]) -> None:
+    while True:
+      self.block.update(self._live_lines(units))
+      await asyncio.sleep(REFRESH_INTERVAL)
+
+  def _live_lines(self, units: List[MagiUnit]) -> List[str]:
+    """The status block, redrawn in place. Without a terminal only its final state is printed."""
+    lines = []
+    for unit in units:
+      header = f"MAGI-{unit.index + 1} {unit.root_character.character_name} // {unit.name}"
+      lines.append(f"┌─ {header} {'─' * max(0, PANEL_WIDTH - len(header) - 1)}┐")
+      lines.append(f"  [{unit.progress_bar()}] {unit.state} {unit.elapsed():5.1f}s")
+      tail = _wrap(unit.text)[-LIVE_TEXT_LINES:] if unit.text else []
+      tail = [""] * (LIVE_TEXT_LINES - len(tail)) + tail
+      lines.extend(f"  {line}" for line in tail)
+    return lines
+
+  async def _wait_with_progress(self, label: str, task: asyncio.Task) -> None:
+    self.out.write(f"\n{label}")
+    while not task.done():
+      self.out.write("█")
+      await asyncio.wait([task], timeout=REFRESH_INTERVAL * 2)
+    self.out.line(" 完了 / COMPLETE")
+
+  def _print_activation(self, user_input: str) -> None:
+    self.out.line("\n")
+    self.out.line("=" * 80)
+    self.out.line("                      MAGI システム 起動中...                      ")
+    self.out.line("                      MAGI SYSTEM ACTIVATING...                      ")
+    self.out.line("=" * 80)
+
+    # Random status reports
+    for _ in range(3):
+      self.out.line(f"[{random.choice(STATUS_CODES)}] {random.choice(TECH_JARGON)} status: NOMINAL")
+
+    self.out.line("\n")
+    self.out.line("""
+    ╔════════════════════════════════════════════════════════════════╗
+    ║                                                                ║
+    ║                 NERV 汎用人工知能 MAGI SYSTEM                  ║
+    ║                                                                ║
+    ╚════════════════════════════════════════════════════════════════╝
+    """)
+
+    self.out.line(f"[解析中 / ANALYZING] ユーザー入力: {user_input}")
+    self.out.line(f"[シンクロ率 / SYNCH RATIO] {random.randint(75, 99)}.{random.randint(10, 99)}%")
+    self.out.line(f"[MAGI 並列起動 / PARALLEL ACTIVATION] {len(self.root_characters)} units\n")
+
+  def _print_panel(self, unit: MagiUnit) -> None:
+    name = unit.root_character.character_name
+    # Random technical status
+    self.out.line(f"\n[{random.choice(STATUS_CODES)}] {random.choice(JP_TERMS)} {random.choice(['ACTIVE', 'NOMINAL', 'OPTIMAL'])}")
+
+    # Display the response with EVA-style formatting
+    self.out.line(f"\n╔═══ MAGI-{name} // {unit.name} ═{'═' * (50 - len(name))}╗")
+    self.out.line(f"║                                                                ║")
+    self.out.line(f"║  思考パターン / THOUGHT PATTERN: {THOUGHT_PATTERNS[unit.index % len(THOUGHT_PATTERNS)]}                  ║")
+    self.out.line(f"║  応答時間 / RESPONSE TIME: {unit.elapsed():6.2f}s                             ║")
+    self.out.line(f"║                                                                ║")
+    self.out.line(f"║  {random.choice(TECH_JARGON)} STATUS: ACTIVE                             ║")
+    self.out.line(f"║  {random.choice(STATUS_CODES)}: NOMINAL                              ║")
+    self.out.line(f"║                                                                ║")
+    for line in _wrap(unit.text):
+      self.out.line(f"║  {line}{' ' * (PANEL_WIDTH - len(line))}  ║")
+    self.out.line(f"║                                                                ║")
+    self.out.line(f"╚════════════════════════════════════════════════════════════════╝")
+
+  def _decision_prompt(self, user_input: str, units: List[MagiUnit]) -> str:
+    combined_responses = "\n".join([f"MAGI-{unit.root_character.character_name}: {unit.text}" for unit in units])
+    return f"""
+    You are the MAGI supercomputer system from Neon Genesis Evangelion.
+
+    The three MAGI supercomputers (Melchior, Balthasar, and Caspar) have analyzed the following query:
+    "{user_input}"
+
+    Here are their responses:
+    {combined_responses}
+
+    As the unified MAGI system, synthesize these three perspectives into ONE clear, concise decision or recommendation (maximum 2-3 sentences).
+    Use technical, formal language in the style of NERV's computer systems. Include a simple "APPROVED" or "DENIED" status if appropriate.
+    """
+
+  def _print_decision(self, final_decision: str) -> None:
+    # Final EVA-themed message
+    self.out.line("\n")
+    self.out.line("""
+    ╔════════════════════════════════════════════════════════════════╗
+    ║                                                                ║
+    ║                MAGI 分析完了 // ANALYSIS COMPLETE              ║
+    ║                                                                ║
+    ║  AT フィールド: 安定 / STABLE                                  ║
+    ║  シンクロ率: 最適 / OPTIMAL                                    ║
+    ║  第三新東京市: 安全 / SECURE                                   ║
+    ║                                                                ║
+    ╚════════════════════════════════════════════════════════════════╝
+    """)
+
+    # Display the final decision
+    self.out.line("\n[MAGI 最終決定 / FINAL DECISION]")
+    self.out.line("=" * 80)
+    self.out.line(final_decision)
+    self.out.line("=" * 80)
+
+    # Random final status
+    self.out.line(f"[NERV-HQ] {random.choice(JP_TERMS)} status: {random.choice(['NOMINAL', 'OPTIMAL', 'STABLE'])}")
+    self.out.line(f"[MAGI-SYS] 全システム正常 / All systems normal")
+    self.out.line("=" * 80)
+    self.out.line("\n")
@@ -0,0 +1,90 @@
+import queue
+import threading
+from typing import Dict, List, Tuple
+
+from conversation import Conversation
+from util.helpers import verbose_print
+from util.renderer import get_renderer
+from util.telemetry import llm_phase
+
+
+class MemoryConsolidator:
+  """
+  Background worker that folds finished conversations into character memories.
+
+  Jobs submitted for a character that is still waiting in the queue are merged,
+  so one summarization covers all of them. Characters call wait_for before they
+  read their memory, which applies any outstanding job first.
+  """
+  def __init__(self):
+    self._queue = queue.Queue()
+    self._pending: Dict[int, Tuple[object, List[Conversation]]] = {}
+    self._running = set()
+    self._condition = threading.Condition()
+    self._thread = None
+
+  def submit(self, character, conversation: Conversation) -> None:
+    with self._condition:
+      key = id(character)
+      if key in self._pending:
+        self._pending[key][1].append(conversation)
+        verbose_print(f"Merged memory job for {character.real_name}")
+        return
+      self._pending[key] = (character, [conversation])
+      self._queue.put(key)
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+  def wait_for(self, character) -> None:
+    """
+    Block until the character has no outstanding memory job.
+    A job that has not been picked up by the worker yet runs on the calling thread.
+    """
+    key = id(character)
+    with self._condition:
+      while key in self._running:
+        self._condition.wait()
+      job = self._take(key)
+    if job:
+      self._consolidate(key, *job)
+
+  def _work(self) -> None:
+    while True:
+      key = self._queue.get()
+      with self._condition:
+        job = self._take(key)
+      if job:
+        # Only here is nobody waiting on the summary, a job run by wait_for keeps the caller's phase
+        with llm_phase("memory"):
+          self._consolidate(key, *job)
+
+  def _take(self, key: int):
+    # Must be called with the condition held
+    job = self._pending.pop(key, None)
+    if job:
+      self._running.add(key)
+    return job
+
+  def _consolidate(self, key: int, character, conversations: List[Conversation]) -> None:
+    try:
+      character.consolidate_memory(conversations)
+    except Exception as e:
+      get_renderer().line(f"Error consolidating memory for {character.real_name}: {str(e)}")
+    finally:
+      with self._condition:
+        self._running.discard(key)
+        self._condition.notify_all()
+
+
+_consolidator = MemoryConsolidator()
+
+
+def submit_memory_job(character, conversation: Conversation) -> None:
+  """Queue a conversation to be folded into the character's memory in the background."""
+  _consolidator.submit(character, conversation)
+
+
+def wait_for_memory(character) -> None:
+  """Apply any outstanding memory job of the character."""
+  _consolidator.wait_for(character)
@@ -0,0 +1,202 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from storage import get_store
+from util.embeddings import embed_texts, aembed_texts, load_vectors, save_vectors
+from util.helpers import verbose_print, get_embedding_model_id, get_persona_reuse_threshold
+
+
+PERSONA_INDEX_PATH = os.path.join("cache", "_persona_index.npz")
+
+
+def _persona_text(character_name: str, system_prompt: str) -> str:
+  return f"{character_name}: {system_prompt}"
+
+
+def _fingerprint(character_name: str, system_prompt: str) -> str:
+  text = f"{get_embedding_model_id()}\n{_persona_text(character_name, system_prompt)}"
+  return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class PersonaIndex:
+  """
+  Embedding index over the personas in the character store.
+  Rows of the matrix are L2-normalized, so a matrix-vector product gives the cosine similarities.
+  """
+  def __init__(self, path: str=PERSONA_INDEX_PATH):
+    self.path = path
+    self.names: List[str] = []
+    self.fingerprints: List[str] = []
+    self.matrix: Optional[np.ndarray] = None
+    # Row of each persona in names, fingerprints and matrix
+    self.rows: Dict[str, int] = {}
+    self._loaded = False
+    self._lock = threading.Lock()
+
+  def _ensure_loaded(self) -> None:
+    # Must be called with the lock held
+    if self._loaded:
+      return
+    try:
+      arrays, current_model = load_vectors(self.path)
+      # Rebuild the index when it was made with another embedding model
+      if arrays is not None and current_model:
+        self.names = arrays["names"].tolist()
+        self.fingerprints = arrays["fingerprints"].tolist()
+        self.matrix = arrays["matrix"]
+        self.rows = {name: row for row, name in enumerate(self.names)}
+        self._loaded = True
+        return
+    except Exception as e:
+      verbose_print(f"Error loading persona index, rebuilding it: {str(e)}")
+    # Raises when the personas cannot be embedded, e.g. Ollama is down, and the next call tries again
+    self._build_from_cache()
+    self._loaded = True
+
+  def _build_from_cache(self) -> None:
+    personas = []
+    for data in get_store().iter_characters():
+      personas.append((data["real_name"], data["character_name"], data["system_prompt"]))
+    self.names = []
+    self.fingerprints = []
+    self.matrix = None
+    self.rows = {}
+    if personas:
+      self._upsert(personas)
+    verbose_print(f"Built persona index with {len(self.names)} personas")
+
+  def _upsert(self, personas: List[Tuple[str, str, str]]) -> None:
+    # Must be called with the lock held
+    changed = [
+      (real_name, character_name, system_prompt)
+      for real_name, character_name, system_prompt in personas
+      if real_name not in self.rows
+      or self.fingerprints[self.rows[real_name]] != _fingerprint(character_name, system_prompt)
+    ]
+    if not changed:
+      return
+    vectors = embed_texts([_persona_text(c, s) for _, c, s in changed])
+    if self.matrix is None:
+      self.matrix = np.empty((0, vectors.shape[1]), dtype=np.float32)
+    new_rows = []
+    for (real_name, character_name, system_prompt), vector in zip(changed, vectors):
+      fingerprint = _fingerprint(character_name, system_prompt)
+      if real_name in self.rows:
+        row = self.rows[real_name]
+        self.matrix[row] = vector
+        self.fingerprints[row] = fingerprint
+      else:
+        self.rows[real_name] = len(self.names)
+        self.names.append(real_name)
+        self.fingerprints.append(fingerprint)
+        new_rows.append(vector)
+    if new_rows:
+      self.matrix = np.vstack([self.matrix, np.stack(new_rows)])
+    self._save()
+
+  def _save(self) -> None:
+    save_vectors(self.path, names=np.array(self.names), fingerprints=np.array(self.fingerprints), matrix=self.matrix)
+
+  def update(self, real_name: str, character_name: str, system_prompt: str) -> None:
+    """Add or refresh a single persona. Unchanged personas are not embedded again."""
+    with self._lock:
+      self._ensure_loaded()
+      self._upsert([(real_name, character_name, system_prompt)])
+
+  def search(self, query: str, exclude: Iterable[str]=()) -> Optional[Tuple[str, float]]:
+    """
+    Find the cached persona most similar to the query.
+
+    Returns:
+        Tuple of (real_name, cosine similarity), or None if the index is empty
+    """
+    names, matrix = self._snapshot()
+    if not names:
+      return None
+    query_vector = embed_texts([query])[0]
+    return PersonaIndex._best_match(names, matrix, query_vector, exclude)
+
+  async def asearch(self, query: str, exclude: Iterable[str]=()) -> Optional[Tuple[str, float]]:
+    """Async variant of search."""
+    # Loading or building the index may embed every persona, which must not block the event loop
+    names, matrix = await asyncio.to_thread(self._snapshot)
+    if not names:
+      return None
+    query_vector = (await aembed_texts([query]))[0]
+    return PersonaIndex._best_match(names, matrix, query_vector, exclude)
+
+  def _snapshot(self) -> Tuple[List[str], Optional[np.ndarray]]:
+    with self._lock:
+      self._ensure_loaded()
+      return list(self.names), self.matrix
+
+  @staticmethod
+  def _best_match(names: List[str], matrix: np.ndarray, query_vector: np.ndarray, exclude: Iterable[str]) -> Optional[Tuple[str, float]]:
+    scores = matrix @ query_vector
+    for name in exclude:
+      if name in names:
+        scores[names.index(name)] = -np.inf
+    best = int(np.argmax(scores))
+    if not np.isfinite(scores[best]):
+      return None
+    return names[best], float(scores[best])
+
+
+_persona_index = PersonaIndex()
+# Index updates run on a single background worker so saving a character never waits for an embedding
+_updater = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persona-index")
+
+
+def _update(real_name: str, character_name: str, system_prompt: str) -> None:
+  try:
+    _persona_index.update(real_name, character_name, system_prompt)
+  except Exception as e:
+    verbose_print(f"Error updating persona index for {real_name}: {str(e)}")
+
+
+def index_persona(real_name: str, character_name: str, system_prompt: str) -> None:
+  """Queue an incremental update of the persona index."""
+  _updater.submit(_update, real_name, character_name, system_prompt)
+
+
+def _accept(match: Optional[Tuple[str, float]]) -> Optional[str]:
+  if match is None:
+    return None
+  real_name, score = match
+  verbose_print(f"Most similar cached persona: {real_name} ({score:.3f})")
+  if score < get_persona_reuse_threshold():
+    return None
+  return real_name
+
+
+def find_similar_persona(query: str, exclude: Iterable[str]=()) -> Optional[str]:
+  """
+  Find a cached persona that fits the query well enough to be reused.
+
+  Args:
+      query: The user's request
+      exclude: Real names of characters that must not be returned
+
+  Returns:
+      str: The real name of the persona, or None if none scores above PERSONA_REUSE_THRESHOLD
+  """
+  try:
+    return _accept(_persona_index.search(query, exclude))
+  except Exception as e:
+    verbose_print(f"Error searching persona index: {str(e)}")
+    return None
+
+
+async def afind_similar_persona(query: str, exclude: Iterable[str]=()) -> Optional[str]:
+  """Async variant of find_similar_persona."""
+  try:
+    return _accept(await _persona_index.asearch(query, exclude))
+  except Exception as e:
+    verbose_print(f"Error searching persona index: {str(e)}")
+    return None
@@ -1,18 +1,61 @@
-from ollama import chat
 from ollama import ChatResponse
+import json
 import time
 import random
-from typing import Any, List
+from typing import Any, Callable, List
 
 from character import Character
 from character_action import CharacterAction, CharacterActionType
+from context_assembler import report_prompt_eval
 from util.helpers import verbose_print, get_model_id
+from util.llm import get_llm
+from util.renderer import get_renderer
 from conversation import SingleMessage
 
 
 MODEL_ID = get_model_id()
 
 
+def _interview_prompt(perspective: str, user_input: str, characters: List[Character], response_instructions: str) -> str:
+  character_names = ",".join([c.real_name for c in characters])
+  # Create a more detailed prompt that helps the LLM make better decisions.
+  # The situation comes last, so the rules form a prefix Ollama can reuse across turns
+  return f"""
+As {perspective}, analyze the current conversation situation.
+
+In most cases, there should be 1~3 characters in the conversation.
+In rare cases, there should be 3~5 characters in the conversation.
+There should not be more than 5 characters in the conversation.
+Each character speaks in order.
+The characters should be well-balanced and diverse.
+
+Based on these rules, choose ONE of the following actions that best fits the user's request:
+
+1. KEEP - If the current characters are well-suited to handle the user's request and should continue the conversation.
+
+2. REMOVE: [character name(s)] - If specific character(s) are inappropriate for this conversation or are not contributing meaningfully. Only remove characters when absolutely necessary.
+
+3. SHUFFLE - If the current characters should remain but their speaking order should be changed to improve the conversation flow.
+
+4. ADD_NEW - If a new character with different expertise or personality would help address the user's request.
+
+5. FIND_POPULAR - If the user's request would be best handled by characters that have been frequently used in past conversations. This is useful when the user wants familiar characters or when popularity-based selection is mentioned.
+
+Consider:
+- The expertise and personality of each character
+- The nature of the user's request
+- The diversity and balance of the current group
+- The potential for interesting interactions
+- Whether the user is explicitly asking for popular or frequently used characters
+
+USER REQUEST: "{user_input}"
+
+CURRENT CHARACTERS: {character_names}
+
+{response_instructions}
+"""
+
+
 class RootCharacter(Character):
   def __init__(
     self,
@@ -44,55 +87,91 @@ class RootCharacter(Character):
       return CharacterAction(action=CharacterActionType.ADD_NEW_CHARACTER, from_root=True)
 
     characters = [cc for cc in current_characters]
-    character_names = ",".join([c.real_name for c in characters])
-    # Create a more detailed prompt that helps the LLM make better decisions
-    prompt = f"""
-As {self.character_name}, analyze the current conversation situation:
-
-USER REQUEST: "{user_input}"
-
-CURRENT CHARACTERS: {character_names}
-
-In most cases, there should be 1~3 characters in the conversation.
-In rare cases, there should be 3~5 characters in the conversation.
-There should not be more than 5 characters in the conversation.
-Each character speaks in order.
-The characters should be well-balanced and diverse.
+    response: ChatResponse = get_llm().chat("interview", self.real_name, model=MODEL_ID, messages=self._interview_messages(user_input, characters))
+    return self._parse_interview_response(response.message.content, characters)
 
-Based on these rules, choose ONE of the following actions that best fits the user's request:
+  async def ainterview_characters(self, user_input: str, current_characters: List[Character]=[]) -> CharacterAction:
+    """
+    Async variant of interview_characters, so the root characters can be interviewed concurrently.
 
-1. KEEP - If the current characters are well-suited to handle the user's request and should continue the conversation.
+    Args:
+        user_input: The user's input
+        current_characters: The characters currently in the conversation
 
-2. REMOVE: [character name(s)] - If specific character(s) are inappropriate for this conversation or are not contributing meaningfully. Only remove characters when absolutely necessary.
+    Returns:
+        CharacterAction: The vote of this root character
+    """
+    if len(current_characters) == 0:
+      return CharacterAction(action=CharacterActionType.ADD_NEW_CHARACTER, from_root=True)
 
-3. SHUFFLE - If the current characters should remain but their speaking order should be changed to improve the conversation flow.
+    characters = [cc for cc in current_characters]
+    response: ChatResponse = await get_llm().achat("interview", self.real_name, model=MODEL_ID, messages=self._interview_messages(user_input, characters))
+    return self._parse_interview_response(response.message.content, characters)
 
-4. ADD_NEW - If a new character with different expertise or personality would help address the user's request.
+  def _interview_messages(self, user_input: str, characters: List[Character]) -> List[dict]:
+    prompt = _interview_prompt(self.character_name, user_input, characters, """RESPOND WITH EXACTLY ONE OF:
+- KEEP
+- REMOVE: [character name(s)]
+- SHUFFLE
+- ADD_NEW
+- FIND_POPULAR
 
-5. FIND_POPULAR - If the user's request would be best handled by characters that have been frequently used in past conversations. This is useful when the user wants familiar characters or when popularity-based selection is mentioned.
+DO NOT include any explanation or reasoning in your response.""")
+    return [
+      {'role': 'system', 'content': self.system_prompt},
+      {'role': 'user', 'content': prompt},
+    ]
+
+  @staticmethod
+  async def ainterview_as_council(root_characters: List["RootCharacter"], user_input: str, current_characters: List[Character]=[]) -> List[CharacterAction]:
+    """
+    Interview all root characters with a single structured output call that role-plays
+    each of them and returns all their votes in one JSON object. This processes the shared
+    user input and roster once, instead of once per root character.
+
+    Args:
+        root_characters: The root characters to role-play
+        user_input: The user's input
+        current_characters: The characters currently in the conversation
+
+    Returns:
+        List[CharacterAction]: The vote of every root character, in the same order
+    """
+    if len(current_characters) == 0:
+      return [CharacterAction(action=CharacterActionType.ADD_NEW_CHARACTER, from_root=True) for _ in root_characters]
 
-Consider:
-- The expertise and personality of each character
-- The nature of the user's request
-- The diversity and balance of the current group
-- The potential for interesting interactions
-- Whether the user is explicitly asking for popular or frequently used characters
+    characters = [cc for cc in current_characters]
+    names = [rc.character_name for rc in root_characters]
+    personas = "\n\n".join([f"{rc.character_name}: {rc.system_prompt}" for rc in root_characters])
+    prompt = _interview_prompt(", ".join(names), user_input, characters, f"""Each of {", ".join(names)} votes independently, according to their own personality.
 
-RESPOND WITH EXACTLY ONE OF:
+RESPOND WITH A JSON OBJECT that maps each of {", ".join(names)} to EXACTLY ONE OF:
 - KEEP
 - REMOVE: [character name(s)]
 - SHUFFLE
 - ADD_NEW
 - FIND_POPULAR
 
-DO NOT include any explanation or reasoning in your response.
-"""
-
-    response: ChatResponse = chat(model=MODEL_ID, messages=[
-      {'role': 'system', 'content': self.system_prompt},
+DO NOT include any explanation or reasoning in your response.""")
+    schema = {
+      "type": "object",
+      "properties": {name: {"type": "string"} for name in names},
+      "required": names,
+    }
+    response: ChatResponse = await get_llm().achat("council_interview", ", ".join(rc.real_name for rc in root_characters), model=MODEL_ID, format=schema, messages=[
+      {'role': 'system', 'content': f"You role-play every component of the MAGI System at once:\n\n{personas}"},
       {'role': 'user', 'content': prompt},
     ])
-    content = response.message.content.strip()
+    try:
+      votes = json.loads(response.message.content)
+    except json.JSONDecodeError:
+      votes = {}
+    if not isinstance(votes, dict):
+      votes = {}
+    return [rc._parse_interview_response(str(votes.get(rc.character_name, "")), characters) for rc in root_characters]
+
+  def _parse_interview_response(self, content: str, characters: List[Character]) -> CharacterAction:
+    content = content.strip()
     verbose_print("\n========================\n")
     verbose_print(f"ROOT INTERVIEW {self.real_name}:\n")
     verbose_print(content)
@@ -122,7 +201,7 @@ DO NOT include any explanation or reasoning in your response.
         return CharacterAction(action=CharacterActionType.KEEP_CHARACTERS, from_root=True)
     else:
       # If the response doesn't match any expected format, default to KEEP
-      print(f"\n********* WARNING: INTERVIEW FAILED with response: {content} *********\n")
+      get_renderer().line(f"\n********* WARNING: INTERVIEW FAILED with response: {content} *********\n")
       return CharacterAction(action=CharacterActionType.KEEP_CHARACTERS, from_root=True)
   
   def chat_with_messages(self, messages: List[SingleMessage]) -> str:
@@ -131,8 +210,37 @@ DO NOT include any explanation or reasoning in your response.
     verbose_print("CHAT MESSAGES:\n")
     verbose_print(messages_)
     verbose_print("\n========================\n")
-    response: ChatResponse = chat(
+    response: ChatResponse = get_llm().chat(
+        "chat",
+        self.real_name,
         model=MODEL_ID,
         messages=messages_,
     )
-    return response.message.content
\ No newline at end of file
+    report_prompt_eval(self.real_name, messages_, response)
+    return response.message.content
+
+  async def achat_with_messages(self, messages: List[SingleMessage], on_chunk: Callable[[str], None]=None) -> str:
+    """
+    Stream a response asynchronously without printing it.
+
+    Args:
+        messages: The messages to send after the system prompt
+        on_chunk: Called with every streamed chunk as it arrives
+
+    Returns:
+        str: The entire response
+    """
+    messages_ = self._prepend_system_prompt(messages)
+    verbose_print("\n========================\n")
+    verbose_print("CHAT MESSAGES:\n")
+    verbose_print(messages_)
+    verbose_print("\n========================\n")
+    entire_message = ""
+    chunk = None
+    async for chunk in await get_llm().achat("chat", self.real_name, model=MODEL_ID, messages=messages_, stream=True):
+      content = chunk['message']['content']
+      entire_message += content
+      if on_chunk:
+        on_chunk(content)
+    report_prompt_eval(self.real_name, messages_, chunk)
+    return entire_message
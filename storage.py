@@ -0,0 +1,459 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from util.helpers import verbose_print, get_storage_backend
+
+
+CACHE_DIR = "cache"
+SQLITE_PATH = os.path.join(CACHE_DIR, "legion.db")
+OCCURRENCE_FILE_NAME = "_character_occurrence.json"
+OCCURRENCE_LOG_FILE_NAME = "_character_occurrence.log"
+OCCURRENCE_LOG_COMPACT_BYTES = 64 * 1024
+# Key of the snapshot recording the last log generation folded into it
+LOG_GENERATION_KEY = "__log_generation__"
+
+
+class OccurrenceLog:
+  """
+  Occurrence counts as a JSON snapshot plus an append-only log of increments.
+
+  Every increment is one small fsynced line appended to the log. Once the log passes
+  OCCURRENCE_LOG_COMPACT_BYTES, it is rotated to a numbered generation file and folded into
+  the snapshot on a background thread. The snapshot records the last generation it contains,
+  so replaying after a crash in the middle of a compaction never counts an increment twice.
+  """
+  def __init__(self, directory: str, compact_bytes: int=OCCURRENCE_LOG_COMPACT_BYTES):
+    self.snapshot_path = os.path.join(directory, OCCURRENCE_FILE_NAME)
+    self.log_path = os.path.join(directory, OCCURRENCE_LOG_FILE_NAME)
+    self.compact_bytes = compact_bytes
+    self._lock = threading.Lock()
+    # Held for a whole compaction, so a full save cannot interleave with it
+    self._compact_lock = threading.Lock()
+    self._compacting = None
+
+  def _read_snapshot(self) -> Dict[str, dict]:
+    try:
+      with open(self.snapshot_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+    except FileNotFoundError:
+      return {}
+
+  def _write_snapshot(self, snapshot: Dict[str, dict]) -> None:
+    tmp_path = f"{self.snapshot_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+      json.dump(snapshot, file, indent=2, ensure_ascii=False)
+      file.flush()
+      os.fsync(file.fileno())
+    os.replace(tmp_path, self.snapshot_path)
+
+  def _rotated_logs(self) -> List[tuple]:
+    directory = os.path.dirname(self.log_path) or "."
+    prefix = f"{OCCURRENCE_LOG_FILE_NAME}."
+    rotated = []
+    for file_name in os.listdir(directory):
+      if file_name.startswith(prefix) and file_name[len(prefix):].isdigit():
+        rotated.append((int(file_name[len(prefix):]), os.path.join(directory, file_name)))
+    return sorted(rotated)
+
+  @staticmethod
+  def _replay(snapshot: Dict[str, dict], log_path: str) -> None:
+    try:
+      with open(log_path, 'r', encoding='utf-8') as file:
+        for line in file:
+          try:
+            record = json.loads(line)
+          except json.JSONDecodeError:
+            # A torn last line from a crash while appending
+            continue
+          occurrence = snapshot.setdefault(record["real_name"], {"count": 0, "character_name": record["character_name"]})
+          occurrence["count"] += record["delta"]
+          occurrence["character_name"] = record["character_name"]
+    except FileNotFoundError:
+      pass
+
+  def load(self) -> Dict[str, dict]:
+    """The snapshot with all logged increments replayed on top of it."""
+    with self._lock:
+      snapshot = self._read_snapshot()
+      generation = snapshot.pop(LOG_GENERATION_KEY, 0)
+      for log_generation, log_path in self._rotated_logs():
+        if log_generation > generation:
+          self._replay(snapshot, log_path)
+      self._replay(snapshot, self.log_path)
+    return snapshot
+
+  def save(self, occurrences: Dict[str, dict]) -> None:
+    """Replace everything with a full snapshot."""
+    with self._compact_lock, self._lock:
+      generation = max([self._read_snapshot().get(LOG_GENERATION_KEY, 0)] + [g for g, _ in self._rotated_logs()])
+      self._write_snapshot({**occurrences, LOG_GENERATION_KEY: generation})
+      for _, log_path in self._rotated_logs():
+        os.remove(log_path)
+      if os.path.exists(self.log_path):
+        os.remove(self.log_path)
+
+  def append(self, real_name: str, character_name: str, delta: int) -> None:
+    line = json.dumps({"real_name": real_name, "character_name": character_name, "delta": delta}, ensure_ascii=False)
+    with self._lock:
+      with open(self.log_path, 'a', encoding='utf-8') as file:
+        file.write(line + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+        size = file.tell()
+      if size >= self.compact_bytes and (self._compacting is None or not self._compacting.is_alive()):
+        self._compacting = threading.Thread(target=self.compact, daemon=True)
+        self._compacting.start()
+
+  def compact(self) -> None:
+    """Fold the log into the snapshot."""
+    try:
+      with self._compact_lock:
+        with self._lock:
+          if not os.path.exists(self.log_path):
+            return
+          snapshot = self._read_snapshot()
+          generation = snapshot.pop(LOG_GENERATION_KEY, 0)
+          rotated = [(g, path) for g, path in self._rotated_logs() if g > generation]
+          generation = max([generation] + [g for g, _ in rotated]) + 1
+          # New increments go to a fresh log while the rotated ones are folded
+          rotated_path = f"{self.log_path}.{generation}"
+          os.replace(self.log_path, rotated_path)
+          rotated.append((generation, rotated_path))
+
+        for _, log_path in rotated:
+          self._replay(snapshot, log_path)
+
+        with self._lock:
+          self._write_snapshot({**snapshot, LOG_GENERATION_KEY: generation})
+          for log_generation, log_path in self._rotated_logs():
+            if log_generation <= generation:
+              os.remove(log_path)
+      verbose_print(f"Compacted character occurrence log into {self.snapshot_path}")
+    except Exception as e:
+      verbose_print(f"Error compacting character occurrence log: {str(e)}")
+
+
+class CharacterStore(ABC):
+  """
+  Storage interface for personas, their memories, occurrence counts and conversation turns.
+
+  Character data is a dict with the keys character_name, real_name, system_prompt, opening,
+  memory and recent_turns. Occurrences map a real name to {"count", "character_name"}.
+  """
+  @abstractmethod
+  def load_character(self, real_name: str) -> Optional[dict]:
+    raise NotImplementedError
+
+  @abstractmethod
+  def save_character(self, character_data: dict) -> None:
+    raise NotImplementedError
+
+  @abstractmethod
+  def iter_characters(self) -> Iterator[dict]:
+    raise NotImplementedError
+
+  @abstractmethod
+  def load_occurrences(self) -> Dict[str, dict]:
+    raise NotImplementedError
+
+  @abstractmethod
+  def save_occurrences(self, occurrences: Dict[str, dict]) -> None:
+    raise NotImplementedError
+
+  @abstractmethod
+  def record_occurrence(self, real_name: str, character_name: str, delta: int=1) -> None:
+    """Add delta to the occurrence count of a character, registering it if it is new."""
+    raise NotImplementedError
+
+  @abstractmethod
+  def append_turn(self, session_id: str, turn_number: int, messages: List[dict]) -> None:
+    """
+    Record a conversation turn.
+
+    Args:
+        session_id: Identifier of the running session
+        turn_number: Number of the turn within the session
+        messages: Dicts with the keys real_name, character_name and text, in speaking order
+    """
+    raise NotImplementedError
+
+  @contextmanager
+  def batch(self):
+    """Group several writes, so they are applied together."""
+    yield
+
+
+class JsonCharacterStore(CharacterStore):
+  """
+  One pretty-printed JSON file per character in cache/, the original storage format.
+  """
+  def __init__(self, directory: str=CACHE_DIR):
+    self.directory = directory
+    os.makedirs(directory, exist_ok=True)
+    self.occurrence_log = OccurrenceLog(directory)
+
+  def _character_path(self, real_name: str) -> str:
+    return os.path.join(self.directory, f"{real_name}.json")
+
+  def load_character(self, real_name: str) -> Optional[dict]:
+    try:
+      with open(self._character_path(real_name), 'r', encoding='utf-8') as file:
+        return json.load(file)
+    except FileNotFoundError:
+      return None
+
+  def save_character(self, character_data: dict) -> None:
+    with open(self._character_path(character_data["real_name"]), 'w', encoding='utf-8') as file:
+      json.dump(character_data, file, indent=2, ensure_ascii=False)
+
+  def iter_characters(self) -> Iterator[dict]:
+    for file_name in sorted(os.listdir(self.directory)):
+      if file_name.startswith("_") or not file_name.endswith(".json"):
+        continue
+      try:
+        with open(os.path.join(self.directory, file_name), 'r', encoding='utf-8') as file:
+          yield json.load(file)
+      except Exception as e:
+        verbose_print(f"Skipping {file_name}: {str(e)}")
+
+  def load_occurrences(self) -> Dict[str, dict]:
+    return self.occurrence_log.load()
+
+  def save_occurrences(self, occurrences: Dict[str, dict]) -> None:
+    self.occurrence_log.save(occurrences)
+
+  def record_occurrence(self, real_name: str, character_name: str, delta: int=1) -> None:
+    self.occurrence_log.append(real_name, character_name, delta)
+
+  def append_turn(self, session_id: str, turn_number: int, messages: List[dict]) -> None:
+    # The JSON store never kept conversation turns
+    pass
+
+
+class SqliteCharacterStore(CharacterStore):
+  """
+  Single SQLite database in WAL mode. Existing JSON files in cache/ are imported once on first use.
+  """
+  SCHEMA = """
+  CREATE TABLE IF NOT EXISTS personas (
+    real_name TEXT PRIMARY KEY,
+    character_name TEXT NOT NULL,
+    system_prompt TEXT NOT NULL,
+    opening TEXT NOT NULL,
+    updated_at REAL NOT NULL
+  );
+  CREATE INDEX IF NOT EXISTS personas_character_name ON personas (character_name);
+  CREATE TABLE IF NOT EXISTS memories (
+    real_name TEXT PRIMARY KEY REFERENCES personas (real_name),
+    memory TEXT NOT NULL,
+    recent_turns TEXT NOT NULL
+  );
+  CREATE TABLE IF NOT EXISTS occurrences (
+    real_name TEXT PRIMARY KEY,
+    character_name TEXT NOT NULL,
+    count INTEGER NOT NULL
+  );
+  CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    turn_number INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    real_name TEXT NOT NULL,
+    character_name TEXT NOT NULL,
+    text TEXT NOT NULL,
+    created_at REAL NOT NULL
+  );
+  CREATE INDEX IF NOT EXISTS turns_session ON turns (session_id, turn_number);
+  CREATE INDEX IF NOT EXISTS turns_real_name ON turns (real_name);
+  CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+  );
+  """
+
+  def __init__(self, path: str=SQLITE_PATH, import_from: str=CACHE_DIR):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    self.path = path
+    # Worker threads save characters too, so the connection is shared behind a lock
+    self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._lock = threading.RLock()
+    self._depth = 0
+    self._connection.execute("PRAGMA journal_mode=WAL")
+    self._connection.execute("PRAGMA synchronous=NORMAL")
+    self._connection.executescript(self.SCHEMA)
+    if import_from and self._get_meta("json_imported") is None:
+      import_json_cache(self, import_from)
+
+  @contextmanager
+  def batch(self):
+    with self._lock:
+      if self._depth == 0:
+        self._connection.execute("BEGIN IMMEDIATE")
+      self._depth += 1
+      try:
+        yield
+      except BaseException:
+        self._depth -= 1
+        if self._depth == 0:
+          self._connection.execute("ROLLBACK")
+        raise
+      self._depth -= 1
+      if self._depth == 0:
+        self._connection.execute("COMMIT")
+
+  def _get_meta(self, key: str) -> Optional[str]:
+    with self._lock:
+      row = self._connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+  def _set_meta(self, key: str, value: str) -> None:
+    with self.batch():
+      self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+  def load_character(self, real_name: str) -> Optional[dict]:
+    with self._lock:
+      row = self._connection.execute(
+        """
+        SELECT p.character_name, p.real_name, p.system_prompt, p.opening, m.memory, m.recent_turns
+        FROM personas p LEFT JOIN memories m ON m.real_name = p.real_name
+        WHERE p.real_name = ?
+        """,
+        (real_name,),
+      ).fetchone()
+    return self._character_from_row(row) if row else None
+
+  def _character_from_row(self, row: tuple) -> dict:
+    character_name, real_name, system_prompt, opening, memory, recent_turns = row
+    return {
+      "character_name": character_name,
+      "real_name": real_name,
+      "system_prompt": system_prompt,
+      "opening": opening,
+      "memory": memory or "",
+      "recent_turns": json.loads(recent_turns) if recent_turns else [],
+    }
+
+  def save_character(self, character_data: dict) -> None:
+    with self.batch():
+      self._connection.execute(
+        "INSERT OR REPLACE INTO personas (real_name, character_name, system_prompt, opening, updated_at) VALUES (?, ?, ?, ?, ?)",
+        (
+          character_data["real_name"],
+          character_data.get("character_name", character_data["real_name"]),
+          character_data.get("system_prompt") or "",
+          character_data.get("opening", "Hello"),
+          time.time(),
+        ),
+      )
+      self._connection.execute(
+        "INSERT OR REPLACE INTO memories (real_name, memory, recent_turns) VALUES (?, ?, ?)",
+        (
+          character_data["real_name"],
+          character_data.get("memory") or "",
+          json.dumps(character_data.get("recent_turns") or [], ensure_ascii=False),
+        ),
+      )
+
+  def iter_characters(self) -> Iterator[dict]:
+    with self._lock:
+      rows = self._connection.execute(
+        """
+        SELECT p.character_name, p.real_name, p.system_prompt, p.opening, m.memory, m.recent_turns
+        FROM personas p LEFT JOIN memories m ON m.real_name = p.real_name
+        ORDER BY p.real_name
+        """
+      ).fetchall()
+    for row in rows:
+      yield self._character_from_row(row)
+
+  def load_occurrences(self) -> Dict[str, dict]:
+    with self._lock:
+      rows = self._connection.execute("SELECT real_name, character_name, count FROM occurrences").fetchall()
+    return {real_name: {"count": count, "character_name": character_name} for real_name, character_name, count in rows}
+
+  def save_occurrences(self, occurrences: Dict[str, dict]) -> None:
+    with self.batch():
+      self._connection.executemany(
+        "INSERT OR REPLACE INTO occurrences (real_name, character_name, count) VALUES (?, ?, ?)",
+        [(real_name, data["character_name"], data["count"]) for real_name, data in occurrences.items()],
+      )
+
+  def record_occurrence(self, real_name: str, character_name: str, delta: int=1) -> None:
+    with self.batch():
+      self._connection.execute(
+        """
+        INSERT INTO occurrences (real_name, character_name, count) VALUES (?, ?, ?)
+        ON CONFLICT (real_name) DO UPDATE SET count = count + excluded.count, character_name = excluded.character_name
+        """,
+        (real_name, character_name, delta),
+      )
+
+  def append_turn(self, session_id: str, turn_number: int, messages: List[dict]) -> None:
+    now = time.time()
+    with self.batch():
+      self._connection.executemany(
+        "INSERT INTO turns (session_id, turn_number, position, real_name, character_name, text, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+          (session_id, turn_number, position, m["real_name"], m["character_name"], m["text"], now)
+          for position, m in enumerate(messages)
+        ],
+      )
+
+  def load_turns(self, session_id: str) -> List[List[dict]]:
+    """Return the turns of a session, each as the list of its messages in speaking order."""
+    with self._lock:
+      rows = self._connection.execute(
+        "SELECT turn_number, real_name, character_name, text FROM turns WHERE session_id = ? ORDER BY turn_number, position",
+        (session_id,),
+      ).fetchall()
+    turns = {}
+    for turn_number, real_name, character_name, text in rows:
+      turns.setdefault(turn_number, []).append({"real_name": real_name, "character_name": character_name, "text": text})
+    return [turns[n] for n in sorted(turns)]
+
+  def close(self) -> None:
+    with self._lock:
+      self._connection.close()
+
+
+def import_json_cache(store: SqliteCharacterStore, directory: str=CACHE_DIR) -> None:
+  """
+  One-time import of the per-character JSON files and the occurrence file of the JSON store.
+  The JSON files are left in place.
+  """
+  if os.path.isdir(directory):
+    json_store = JsonCharacterStore(directory)
+    with store.batch():
+      count = 0
+      for character_data in json_store.iter_characters():
+        if "real_name" in character_data:
+          store.save_character(character_data)
+          count += 1
+      occurrences = json_store.load_occurrences()
+      if occurrences:
+        store.save_occurrences(occurrences)
+    if count or occurrences:
+      verbose_print(f"Imported {count} characters and {len(occurrences)} occurrences from {directory}")
+  store._set_meta("json_imported", str(time.time()))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> CharacterStore:
+  """The store selected by STORAGE_BACKEND, created on first use."""
+  global _store
+  with _store_lock:
+    if _store is None:
+      if get_storage_backend() == "json":
+        _store = JsonCharacterStore()
+      else:
+        _store = SqliteCharacterStore()
+    return _store
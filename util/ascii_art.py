@@ -0,0 +1,120 @@
+from ollama import ChatResponse
+from concurrent.futures import Future, ThreadPoolExecutor
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+from util.helpers import verbose_print, get_model_id
+from util.llm_cache import cached_chat
+from util.renderer import get_renderer
+
+
+ASCII_ART_CACHE_PATH = os.path.join("cache", "_ascii_art.json")
+
+# Persistent cache keyed by model and character name, loaded on first use
+_cache: Optional[Dict[str, str]] = None
+_lock = threading.Lock()
+_in_flight: Dict[str, Future] = {}
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ascii-art")
+
+
+def _key(character_name: str) -> str:
+  return f"{get_model_id()}::{character_name}"
+
+
+def _load_cache() -> Dict[str, str]:
+  # Must be called with the lock held
+  global _cache
+  if _cache is None:
+    try:
+      with open(ASCII_ART_CACHE_PATH, 'r', encoding='utf-8') as file:
+        _cache = json.load(file)
+    except FileNotFoundError:
+      _cache = {}
+    except Exception as e:
+      verbose_print(f"Error loading ASCII art cache: {str(e)}")
+      _cache = {}
+  return _cache
+
+
+def _store(character_name: str, art: str) -> None:
+  with _lock:
+    cache = _load_cache()
+    cache[_key(character_name)] = art
+    try:
+      os.makedirs("cache", exist_ok=True)
+      with open(ASCII_ART_CACHE_PATH, 'w', encoding='utf-8') as file:
+        json.dump(cache, file, indent=2, ensure_ascii=False)
+    except Exception as e:
+      verbose_print(f"Error saving ASCII art cache: {str(e)}")
+
+
+def get_cached_ascii_art(character_name: str) -> Optional[str]:
+  """Return the cached ASCII art of the character, or None on a cache miss."""
+  with _lock:
+    return _load_cache().get(_key(character_name))
+
+
+def generate_ascii_art(character_name: str) -> str:
+  """Generate ASCII art for the character with the LLM and store it in the cache."""
+  ascii_art_prompt = f"Create a small ASCII art (max 10 lines) that represents {character_name}. The ASCII art should be simple, compact, and visually recognizable. DO NOT include any text or explanation, ONLY the ASCII art."
+
+  response: ChatResponse = cached_chat(
+    "ascii_art",
+    model=get_model_id(),
+    messages=[
+      {'role': 'system', 'content': 'You are an ASCII art generator. Create simple, compact ASCII art based on the request.'},
+      {'role': 'user', 'content': ascii_art_prompt}
+    ]
+  )
+  art = response.message.content.strip()
+  _store(character_name, art)
+  return art
+
+
+def fetch_ascii_art(character_name: str) -> Future:
+  """
+  Get the ASCII art of the character without blocking.
+
+  Returns:
+      Future: Resolves to the art. It is already done on a cache hit, otherwise the art
+      is generated in the background. Concurrent requests for the same character share one generation.
+  """
+  art = get_cached_ascii_art(character_name)
+  if art is not None:
+    future = Future()
+    future.set_result(art)
+    return future
+
+  key = _key(character_name)
+  with _lock:
+    future = _in_flight.get(key)
+    if future is None:
+      future = _executor.submit(generate_ascii_art, character_name)
+      _in_flight[key] = future
+      future.add_done_callback(lambda _: _in_flight.pop(key, None))
+  return future
+
+
+def prewarm_ascii_art(character_names: List[str]) -> List[Future]:
+  """Generate the ASCII art of every character missing from the cache in the background."""
+  return [fetch_ascii_art(name) for name in character_names]
+
+
+def print_ascii_art(art: str) -> None:
+  out = get_renderer()
+  out.line("\n")
+  out.line(f"{'=' * 40}")
+  out.line(art)
+  out.line(f"{'=' * 40}")
+  out.line("\n")
+
+
+if __name__ == "__main__":
+  # Pre-warm the cache for the default characters: python -m util.ascii_art
+  from default_characters import DEFAULT_CHARACTERS
+
+  for future in prewarm_ascii_art([c.character_name for c in DEFAULT_CHARACTERS]):
+    future.result()
+  get_renderer().line(f"ASCII art cache warmed at {ASCII_ART_CACHE_PATH}")
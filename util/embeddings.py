@@ -0,0 +1,56 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from util.helpers import get_embedding_model_id
+from util.llm import get_llm
+
+
+def _normalize(embeddings: List[List[float]]) -> np.ndarray:
+  matrix = np.asarray(embeddings, dtype=np.float32)
+  norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+  norms[norms == 0] = 1.0
+  return matrix / norms
+
+
+def embed_texts(texts: List[str]) -> np.ndarray:
+  """
+  Embed texts with the embedding model.
+
+  Returns:
+      np.ndarray: One L2-normalized row per text, so dot products are cosine similarities
+  """
+  response = get_llm().embed(model=get_embedding_model_id(), input=texts)
+  return _normalize(response.embeddings)
+
+
+async def aembed_texts(texts: List[str]) -> np.ndarray:
+  """Async variant of embed_texts."""
+  response = await get_llm().aembed(model=get_embedding_model_id(), input=texts)
+  return _normalize(response.embeddings)
+
+
+def load_vectors(path: str) -> Tuple[Optional[Dict[str, np.ndarray]], bool]:
+  """
+  Load arrays saved with save_vectors.
+
+  Returns:
+      Tuple of (the arrays by name, or None if there is no file, whether the vectors come from
+      the current embedding model). Vectors of another model are not comparable with new ones.
+  """
+  if not os.path.exists(path):
+    return None, False
+  with np.load(path) as data:
+    arrays = {name: data[name] for name in data.files if name != "model"}
+    return arrays, str(data["model"]) == get_embedding_model_id()
+
+
+def save_vectors(path: str, **arrays: np.ndarray) -> None:
+  """Atomically save arrays with the name of the embedding model that produced the vectors."""
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  # np.savez appends .npz to paths without it, so write through a file object
+  tmp_path = f"{path}.tmp"
+  with open(tmp_path, 'wb') as file:
+    np.savez(file, model=np.array(get_embedding_model_id()), **arrays)
+  os.replace(tmp_path, path)
@@ -1,11 +1,14 @@
 import os
 
+from util.renderer import get_renderer
+
 
 def verbose_print(text: str) -> None:
 	verbose = os.environ.get("VERBOSE", "False")
 	if verbose == "False":
 		return
-	print(text)
+	# Through the renderer, so logs stay in order with the buffered replies
+	get_renderer().line(str(text))
 
 
 def flip_verbose() -> None:
@@ -18,3 +21,146 @@ def flip_verbose() -> None:
 
 def get_model_id() -> str:
 	return os.environ.get("MODEL_ID", "llama3.1")
+
+
+def is_background_memory_enabled() -> bool:
+	return os.environ.get("BACKGROUND_MEMORY", "True") != "False"
+
+
+def get_memory_mode() -> str:
+	# "summarize" re-summarizes memory after every turn, "rolling" only when the memory budget is exceeded
+	return os.environ.get("MEMORY_MODE", "summarize")
+
+
+def get_memory_budget_chars() -> int:
+	# The budget can be given in tokens, roughly 4 characters each
+	tokens = os.environ.get("MEMORY_BUDGET_TOKENS")
+	if tokens:
+		return int(tokens) * 4
+	return int(os.environ.get("MEMORY_BUDGET_CHARS", "6000"))
+
+
+def get_context_budget_tokens() -> int:
+	# Prompt size limit of a character, the reply is not included
+	return int(os.environ.get("CONTEXT_BUDGET_TOKENS", "3072"))
+
+
+def is_prompt_eval_stats_enabled() -> bool:
+	return os.environ.get("PROMPT_EVAL_STATS", "False") == "True"
+
+
+def get_history_turns() -> int:
+	# Turns of the conversation history kept in memory, older ones are archived to disk
+	return int(os.environ.get("HISTORY_TURNS", "50"))
+
+
+def is_parallel_reactions_enabled() -> bool:
+	return os.environ.get("PARALLEL_REACTIONS", "False") == "True"
+
+
+def get_embedding_model_id() -> str:
+	return os.environ.get("EMBEDDING_MODEL_ID", "nomic-embed-text")
+
+
+def get_persona_reuse_threshold() -> float:
+	return float(os.environ.get("PERSONA_REUSE_THRESHOLD", "0.75"))
+
+
+def is_long_term_memory_enabled() -> bool:
+	return os.environ.get("LONG_TERM_MEMORY", "False") == "True"
+
+
+def get_long_term_memory_top_k() -> int:
+	return int(os.environ.get("LONG_TERM_MEMORY_TOP_K", "3"))
+
+
+def get_interview_mode() -> str:
+	# "concurrent" interviews every root character with its own call, "consolidated" uses one call for all of them
+	return os.environ.get("INTERVIEW_MODE", "concurrent")
+
+
+def is_adaptive_interview_enabled() -> bool:
+	return os.environ.get("ADAPTIVE_INTERVIEW", "False") == "True"
+
+
+def get_interview_drift_threshold() -> float:
+	return float(os.environ.get("INTERVIEW_DRIFT_THRESHOLD", "0.25"))
+
+
+def get_interview_max_skipped_turns() -> int:
+	return int(os.environ.get("INTERVIEW_MAX_SKIPPED_TURNS", "5"))
+
+
+def get_interview_max_interval() -> float:
+	# Seconds after the last interview when the next one runs regardless of the topic
+	return float(os.environ.get("INTERVIEW_MAX_INTERVAL", "600"))
+
+
+def get_storage_backend() -> str:
+	# "sqlite" keeps everything in cache/legion.db, "json" writes one file per character in cache/
+	return os.environ.get("STORAGE_BACKEND", "sqlite")
+
+
+def get_llm_telemetry_jsonl() -> str:
+	# Every LLM call is appended to this file as a JSON line, nothing is written when empty
+	return os.environ.get("LLM_TELEMETRY_JSONL", "")
+
+
+def get_llm_telemetry_prom() -> str:
+	# Prometheus textfile collector file rewritten after every turn, nothing is written when empty
+	return os.environ.get("LLM_TELEMETRY_PROM", "")
+
+
+def get_llm_hosts() -> dict:
+	# "embed=http://gpu2:11434,interview=http://gpu1:11434" -> {"embed": "http://gpu2:11434", ...}
+	# Call types not listed use LLM_BACKENDS, or OLLAMA_HOST
+	hosts = {}
+	for item in os.environ.get("LLM_HOSTS", "").split(","):
+		if "=" in item:
+			call_type, host = item.split("=", 1)
+			hosts[call_type.strip()] = host.strip()
+	return hosts
+
+
+def get_llm_timeout() -> float:
+	# Seconds without a byte from the server before a call fails, generous since a cold model loads first
+	return float(os.environ.get("LLM_TIMEOUT", "300"))
+
+
+def get_llm_connect_timeout() -> float:
+	return float(os.environ.get("LLM_CONNECT_TIMEOUT", "5"))
+
+
+def get_llm_retries() -> int:
+	return int(os.environ.get("LLM_RETRIES", "2"))
+
+
+def get_llm_retry_backoff() -> float:
+	# Delay before the first retry in seconds, doubled for every following one
+	return float(os.environ.get("LLM_RETRY_BACKOFF", "0.5"))
+
+
+def get_llm_pool_size() -> int:
+	# Keep-alive connections kept open per host
+	return int(os.environ.get("LLM_POOL_SIZE", "8"))
+
+
+def get_llm_parallel() -> int:
+	# Requests sent at the same time to each model of each server, set to its OLLAMA_NUM_PARALLEL. 0 disables the limit
+	return int(os.environ.get("LLM_PARALLEL", "4"))
+
+
+def get_llm_background_slots() -> int:
+	# Slots background work may use, the others are kept for the user's replies
+	parallel = get_llm_parallel()
+	return int(os.environ.get("LLM_BACKGROUND_SLOTS", str(max(1, parallel - 1))))
+
+
+def get_llm_backends() -> list:
+	# "http://gpu1:11434,http://gpu2:11434", the Ollama servers sharing the calls not routed by LLM_HOSTS
+	return [host.strip() for host in os.environ.get("LLM_BACKENDS", "").split(",") if host.strip()]
+
+
+def get_llm_health_interval() -> float:
+	# Seconds between two health checks of the servers of LLM_BACKENDS
+	return float(os.environ.get("LLM_HEALTH_INTERVAL", "10"))
@@ -0,0 +1,409 @@
+from abc import ABC, abstractmethod
+from ollama import Client
+from ollama import AsyncClient
+from ollama import ChatResponse
+from ollama import EmbedResponse
+from ollama import ResponseError
+import asyncio
+import random
+import threading
+import time
+import weakref
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, Optional, Union
+
+import httpx
+
+from util.helpers import (
+  verbose_print,
+  get_llm_hosts,
+  get_llm_timeout,
+  get_llm_connect_timeout,
+  get_llm_retries,
+  get_llm_retry_backoff,
+  get_llm_pool_size,
+  get_llm_backends,
+)
+from util.llm_router import LLMRouter
+from util.llm_scheduler import LLMScheduler, request_priority
+from util.telemetry import CallTimer, track_call
+
+
+# Overloaded or restarting servers answer with these, the same request can succeed a moment later
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def is_retryable(error: BaseException) -> bool:
+  if isinstance(error, ResponseError):
+    return error.status_code in RETRYABLE_STATUS_CODES
+  # Refused connections, timeouts and keep-alive connections closed by the server
+  return isinstance(error, (ConnectionError, httpx.TransportError))
+
+
+def _backoff(attempt: int) -> float:
+  # Exponential with jitter, so concurrent callers do not retry in lockstep
+  base = get_llm_retry_backoff() * 2 ** attempt
+  return base * random.uniform(0.5, 1.0)
+
+
+class LLMBackend(ABC):
+  """
+  Where LLM requests are sent. Requests are the keyword arguments of ollama's chat and embed,
+  and responses are ollama's types, so a backend can be a stub that never does any I/O.
+  A streamed chat returns an iterator of chunks, or an async iterator from achat.
+  """
+  @abstractmethod
+  def chat(self, **request: Any) -> Union[ChatResponse, Iterator[ChatResponse]]:
+    raise NotImplementedError
+
+  @abstractmethod
+  async def achat(self, **request: Any) -> Union[ChatResponse, AsyncIterator[ChatResponse]]:
+    raise NotImplementedError
+
+  @abstractmethod
+  def embed(self, **request: Any) -> EmbedResponse:
+    raise NotImplementedError
+
+  @abstractmethod
+  async def aembed(self, **request: Any) -> EmbedResponse:
+    raise NotImplementedError
+
+  def ping(self) -> None:
+    """Raise if the backend cannot serve requests, for the health checks of LLMRouter."""
+    pass
+
+  def close(self) -> None:
+    pass
+
+
+class OllamaBackend(LLMBackend):
+  """
+  An Ollama server reached through pooled keep-alive connections.
+
+  The sync client is shared by all threads. httpx ties async connections to the event loop that
+  opened them, so there is one async client per loop, see run_async for the loop shared by Legion.
+
+  Args:
+      host: URL of the server, OLLAMA_HOST if not given
+  """
+  def __init__(self, host: Optional[str]=None):
+    self.host = host
+    self._client = None
+    self._probe_client = None
+    self._async_clients = weakref.WeakKeyDictionary()
+    self._lock = threading.Lock()
+
+  def _client_options(self) -> Dict[str, Any]:
+    return {
+      "timeout": httpx.Timeout(get_llm_timeout(), connect=get_llm_connect_timeout()),
+      "limits": httpx.Limits(max_keepalive_connections=get_llm_pool_size()),
+    }
+
+  def client(self) -> Client:
+    with self._lock:
+      if self._client is None:
+        self._client = Client(host=self.host, **self._client_options())
+      return self._client
+
+  def async_client(self) -> AsyncClient:
+    loop = asyncio.get_running_loop()
+    with self._lock:
+      if loop not in self._async_clients:
+        self._async_clients[loop] = AsyncClient(host=self.host, **self._client_options())
+      return self._async_clients[loop]
+
+  def chat(self, **request: Any) -> Union[ChatResponse, Iterator[ChatResponse]]:
+    return self.client().chat(**request)
+
+  async def achat(self, **request: Any) -> Union[ChatResponse, AsyncIterator[ChatResponse]]:
+    return await self.async_client().chat(**request)
+
+  def embed(self, **request: Any) -> EmbedResponse:
+    return self.client().embed(**request)
+
+  async def aembed(self, **request: Any) -> EmbedResponse:
+    return await self.async_client().embed(**request)
+
+  def ping(self) -> None:
+    # A client of its own, a health check must not wait for the timeout of a generation
+    with self._lock:
+      if self._probe_client is None:
+        self._probe_client = Client(host=self.host, timeout=get_llm_connect_timeout())
+      client = self._probe_client
+    client.list()
+
+  def close(self) -> None:
+    with self._lock:
+      if self._client is not None:
+        self._client.close()
+        self._client = None
+      if self._probe_client is not None:
+        self._probe_client.close()
+        self._probe_client = None
+      # Async clients are closed with their loop
+      self._async_clients = weakref.WeakKeyDictionary()
+
+
+class LLMClient:
+  """
+  Entry point of every LLM call of Legion.
+
+  Each call names its call type, which picks the backend: one set with set_backend, else the
+  Ollama server given for the call type in LLM_HOSTS, else one of the servers of LLM_BACKENDS
+  picked by the LLMRouter, else OLLAMA_HOST. Backends are created once per host and keep their
+  connections open between calls. Calls that fail on the network or with an overloaded server
+  are retried with exponential backoff, streams only until the first chunk, since a retry would
+  repeat what the caller has already shown. Every call waits for a slot of the LLMScheduler of
+  its backend and model, in the order of its priority, and is recorded by the telemetry.
+  """
+  def __init__(self):
+    self._backends: Dict[Optional[str], LLMBackend] = {}
+    # (backend, model) -> scheduler, Ollama gives each loaded model its own parallel slots
+    self._schedulers: Dict[tuple, LLMScheduler] = {}
+    # call type -> backend set with set_backend, None for every call type
+    self._overrides: Dict[Optional[str], LLMBackend] = {}
+    self._router: Optional[LLMRouter] = None
+    self._lock = threading.Lock()
+
+  def set_backend(self, backend: Optional[LLMBackend], call_types: Iterable[str]=None) -> None:
+    """
+    Send the calls of the given call types, or of all of them, to a backend. None restores the default.
+    """
+    with self._lock:
+      for call_type in (list(call_types) if call_types is not None else [None]):
+        if backend is None:
+          self._overrides.pop(call_type, None)
+        else:
+          self._overrides[call_type] = backend
+
+  def backend(self, call_type: str, character: str="") -> LLMBackend:
+    with self._lock:
+      backend = self._overrides.get(call_type) or self._overrides.get(None)
+      if backend:
+        return backend
+      host = get_llm_hosts().get(call_type)
+      if host is not None or not get_llm_backends():
+        return self._ollama_backend(host)
+      if self._router is None:
+        self._router = LLMRouter([self._ollama_backend(h) for h in get_llm_backends()], self._outstanding)
+      router = self._router
+    # Outside of the lock, the router reads the outstanding requests
+    return router.pick(call_type, character)
+
+  def _ollama_backend(self, host: Optional[str]) -> LLMBackend:
+    # Must be called with the lock held
+    if host not in self._backends:
+      self._backends[host] = OllamaBackend(host)
+    return self._backends[host]
+
+  def _outstanding(self, backend: LLMBackend) -> int:
+    with self._lock:
+      schedulers = [s for (backend_id, _), s in self._schedulers.items() if backend_id == id(backend)]
+    return sum(s.running + s.queued() for s in schedulers)
+
+  def scheduler(self, backend: LLMBackend, model: Optional[str]) -> LLMScheduler:
+    with self._lock:
+      key = (id(backend), model)
+      if key not in self._schedulers:
+        self._schedulers[key] = LLMScheduler()
+      return self._schedulers[key]
+
+  def close(self) -> None:
+    with self._lock:
+      backends = list(self._backends.values())
+      self._backends = {}
+      if self._router is not None:
+        self._router.close()
+        self._router = None
+    for backend in backends:
+      backend.close()
+
+  def _failed(self, backend: LLMBackend, error: BaseException) -> None:
+    # Refused connections and timeouts, not errors answered by the server
+    if self._router is not None and is_retryable(error) and not isinstance(error, ResponseError):
+      self._router.mark_down(backend)
+
+  def _send(self, call_type: str, character: str, call: CallTimer, model: Optional[str], send: Callable[[LLMBackend], Any], hold: bool=False) -> Any:
+    """
+    One attempt of a call: pick the backend, so a retry can go to another server, wait for a slot
+    of its scheduler and send. The slot is given back after the attempt, so a retrying call does
+    not hold it while backing off, unless hold is set: then (result, release) is returned.
+    """
+    priority = request_priority(call_type)
+    backend = self.backend(call_type, character)
+    scheduler = self.scheduler(backend, model)
+    call.queued(scheduler.acquire(priority))
+    try:
+      result = send(backend)
+    except BaseException as e:
+      scheduler.release(priority)
+      self._failed(backend, e)
+      raise
+    if hold:
+      return result, lambda: scheduler.release(priority)
+    scheduler.release(priority)
+    return result
+
+  async def _asend(self, call_type: str, character: str, call: CallTimer, model: Optional[str], send: Callable[[LLMBackend], Awaitable[Any]], hold: bool=False) -> Any:
+    """Async variant of _send."""
+    priority = request_priority(call_type)
+    backend = self.backend(call_type, character)
+    scheduler = self.scheduler(backend, model)
+    call.queued(await scheduler.aacquire(priority))
+    try:
+      result = await send(backend)
+    except BaseException as e:
+      scheduler.release(priority)
+      self._failed(backend, e)
+      raise
+    if hold:
+      return result, lambda: scheduler.release(priority)
+    scheduler.release(priority)
+    return result
+
+  def _retry(self, call_type: str, send: Callable[[], Any]) -> Any:
+    retries = get_llm_retries()
+    for attempt in range(retries + 1):
+      try:
+        return send()
+      except Exception as e:
+        if attempt == retries or not is_retryable(e):
+          raise
+        delay = _backoff(attempt)
+        verbose_print(f"Retrying {call_type} in {delay:.2f}s after {type(e).__name__}: {str(e)}")
+        time.sleep(delay)
+
+  async def _aretry(self, call_type: str, send: Callable[[], Awaitable[Any]]) -> Any:
+    retries = get_llm_retries()
+    for attempt in range(retries + 1):
+      try:
+        return await send()
+      except Exception as e:
+        if attempt == retries or not is_retryable(e):
+          raise
+        delay = _backoff(attempt)
+        verbose_print(f"Retrying {call_type} in {delay:.2f}s after {type(e).__name__}: {str(e)}")
+        await asyncio.sleep(delay)
+
+  def chat(self, call_type: str, character: str="", **request: Any) -> Union[ChatResponse, Iterator[ChatResponse]]:
+    """
+    Drop-in replacement of ollama.chat.
+
+    Args:
+        call_type: Kind of call, e.g. chat, summarize or interview
+        character: Real name of the character making the call, for the telemetry and the server affinity
+        request: The parameters of ollama.chat
+
+    Returns:
+        The response, or an iterator of chunks if stream=True
+    """
+    if request.get("stream"):
+      return self._stream(call_type, character, request)
+    with track_call(call_type, character) as call:
+      response = self._retry(call_type, lambda: self._send(
+        call_type, character, call, request.get("model"), lambda backend: backend.chat(**request),
+      ))
+      call.done(response)
+    return response
+
+  def _stream(self, call_type: str, character: str, request: dict) -> Iterator[ChatResponse]:
+    def open_stream(backend: LLMBackend):
+      # The request is only sent once the first chunk is read
+      chunks = iter(backend.chat(**request))
+      return chunks, next(chunks, None)
+
+    with track_call(call_type, character) as call:
+      # The server is busy with a stream until its last chunk, so the slot is held until then
+      (chunks, chunk), release = self._retry(call_type, lambda: self._send(
+        call_type, character, call, request.get("model"), open_stream, hold=True,
+      ))
+      try:
+        if chunk is None:
+          return
+        call.first_token()
+        yield chunk
+        for chunk in chunks:
+          yield chunk
+        call.done(chunk)
+      finally:
+        release()
+
+  async def achat(self, call_type: str, character: str="", **request: Any) -> Union[ChatResponse, AsyncIterator[ChatResponse]]:
+    """Async variant of chat, a streamed response is an async iterator like with ollama.AsyncClient."""
+    if request.get("stream"):
+      return self._astream(call_type, character, request)
+    with track_call(call_type, character) as call:
+      response = await self._aretry(call_type, lambda: self._asend(
+        call_type, character, call, request.get("model"), lambda backend: backend.achat(**request),
+      ))
+      call.done(response)
+    return response
+
+  async def _astream(self, call_type: str, character: str, request: dict) -> AsyncIterator[ChatResponse]:
+    async def open_stream(backend: LLMBackend):
+      chunks = (await backend.achat(**request)).__aiter__()
+      try:
+        return chunks, await chunks.__anext__()
+      except StopAsyncIteration:
+        return chunks, None
+
+    with track_call(call_type, character) as call:
+      (chunks, chunk), release = await self._aretry(call_type, lambda: self._asend(
+        call_type, character, call, request.get("model"), open_stream, hold=True,
+      ))
+      try:
+        if chunk is None:
+          return
+        call.first_token()
+        yield chunk
+        async for chunk in chunks:
+          yield chunk
+        call.done(chunk)
+      finally:
+        release()
+
+  def embed(self, call_type: str="embed", **request: Any) -> EmbedResponse:
+    """Drop-in replacement of ollama.embed."""
+    with track_call(call_type) as call:
+      response = self._retry(call_type, lambda: self._send(
+        call_type, "", call, request.get("model"), lambda backend: backend.embed(**request),
+      ))
+      call.done(response)
+    return response
+
+  async def aembed(self, call_type: str="embed", **request: Any) -> EmbedResponse:
+    with track_call(call_type) as call:
+      response = await self._aretry(call_type, lambda: self._asend(
+        call_type, "", call, request.get("model"), lambda backend: backend.aembed(**request),
+      ))
+      call.done(response)
+    return response
+
+
+_llm = LLMClient()
+
+
+def get_llm() -> LLMClient:
+  return _llm
+
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def run_async(coroutine: Awaitable[Any]) -> Any:
+  """
+  Run a coroutine on the event loop shared by all async LLM calls and wait for its result.
+  Unlike asyncio.run, the loop lives as long as the process, so the async connections it opened
+  are reused by the next turn instead of being reopened.
+  """
+  global _loop
+  with _loop_lock:
+    if _loop is None:
+      _loop = asyncio.new_event_loop()
+      threading.Thread(target=_loop.run_forever, daemon=True, name="llm-loop").start()
+  future = asyncio.run_coroutine_threadsafe(coroutine, _loop)
+  try:
+    return future.result()
+  except KeyboardInterrupt:
+    future.cancel()
+    raise
@@ -0,0 +1,206 @@
+from ollama import ChatResponse
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from util.helpers import verbose_print
+from util.llm import get_llm
+from util.telemetry import record_cached_call
+
+
+LLM_CACHE_DIR = os.path.join("cache", "_llm_cache")
+
+# Default time to live in seconds per call type, None means the entry never expires
+DEFAULT_TTLS = {
+  "sys_prompt": None,
+  "ascii_art": None,
+  "find_character": 7 * 24 * 3600,
+  "character_profile": 7 * 24 * 3600,
+}
+
+_lock = threading.Lock()
+# LRU index of the cache entries on disk: key -> size in bytes, least recently used first
+_index: Optional[OrderedDict] = None
+_total_bytes = 0
+
+
+def is_llm_cache_enabled() -> bool:
+  return os.environ.get("LLM_CACHE", "False") == "True"
+
+
+def _max_bytes() -> int:
+  return int(os.environ.get("LLM_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+
+
+def _parse_mapping(value: str) -> Dict[str, str]:
+  # "sys_prompt=3600,ascii_art=none" -> {"sys_prompt": "3600", "ascii_art": "none"}
+  mapping = {}
+  for item in value.split(","):
+    if "=" in item:
+      name, setting = item.split("=", 1)
+      mapping[name.strip()] = setting.strip()
+  return mapping
+
+
+def get_ttl(call_type: str) -> Optional[float]:
+  """
+  Time to live of the cache entries of a call type. LLM_CACHE_TTLS overrides the defaults,
+  e.g. LLM_CACHE_TTLS="find_character=3600,ascii_art=none".
+  """
+  overrides = _parse_mapping(os.environ.get("LLM_CACHE_TTLS", ""))
+  if call_type in overrides:
+    ttl = overrides[call_type]
+    return None if ttl.lower() == "none" else float(ttl)
+  return DEFAULT_TTLS.get(call_type)
+
+
+def is_bypassed(call_type: str) -> bool:
+  bypassed = os.environ.get("LLM_CACHE_BYPASS", "")
+  return call_type in [c.strip() for c in bypassed.split(",")]
+
+
+def cache_key(model: str, messages: List[dict], options: Optional[dict]=None, **kwargs: Any) -> str:
+  """Content address of a request: hash of the model, messages, options and any other request parameter."""
+  payload = json.dumps(
+    {"model": model, "messages": messages, "options": options, **kwargs},
+    sort_keys=True,
+    ensure_ascii=False,
+    default=str,
+  )
+  return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _path(key: str) -> str:
+  return os.path.join(LLM_CACHE_DIR, f"{key}.json")
+
+
+def _load_index() -> OrderedDict:
+  # Must be called with the lock held
+  global _index, _total_bytes
+  if _index is None:
+    entries = []
+    if os.path.isdir(LLM_CACHE_DIR):
+      for entry in os.scandir(LLM_CACHE_DIR):
+        if entry.name.endswith(".json"):
+          stat = entry.stat()
+          entries.append((stat.st_mtime, entry.name[:-len(".json")], stat.st_size))
+    entries.sort()
+    _index = OrderedDict((key, size) for _, key, size in entries)
+    _total_bytes = sum(_index.values())
+  return _index
+
+
+def _forget(key: str) -> None:
+  # Must be called with the lock held
+  global _total_bytes
+  size = _load_index().pop(key, None)
+  if size is not None:
+    _total_bytes -= size
+  try:
+    os.remove(_path(key))
+  except FileNotFoundError:
+    pass
+
+
+def _read(key: str, ttl: Optional[float]) -> Optional[ChatResponse]:
+  with _lock:
+    index = _load_index()
+    if key not in index:
+      return None
+    try:
+      with open(_path(key), 'r', encoding='utf-8') as file:
+        entry = json.load(file)
+    except Exception as e:
+      verbose_print(f"Error reading LLM cache entry {key}: {str(e)}")
+      _forget(key)
+      return None
+    if ttl is not None and time.time() - entry["created_at"] > ttl:
+      _forget(key)
+      return None
+    # Mark as recently used, also on disk so the order survives restarts
+    index.move_to_end(key)
+    os.utime(_path(key))
+    return ChatResponse.model_validate(entry["response"])
+
+
+def _write(key: str, call_type: str, response: ChatResponse) -> None:
+  global _total_bytes
+  data = json.dumps({
+    "call_type": call_type,
+    "created_at": time.time(),
+    "response": response.model_dump(mode="json", exclude_none=True),
+  }, ensure_ascii=False).encode('utf-8')
+  with _lock:
+    index = _load_index()
+    os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+    if key in index:
+      _forget(key)
+    with open(_path(key), 'wb') as file:
+      file.write(data)
+    index[key] = len(data)
+    _total_bytes += len(data)
+    # Evict the least recently used entries
+    max_bytes = _max_bytes()
+    while _total_bytes > max_bytes and len(index) > 1:
+      _forget(next(iter(index)))
+
+
+def _lookup(call_type: str, model: str, messages: List[dict], options: Optional[dict], bypass: bool, kwargs: Dict[str, Any]):
+  """Return (key, cached response). The key is None when the call does not use the cache."""
+  if bypass or not is_llm_cache_enabled() or is_bypassed(call_type):
+    return None, None
+  key = cache_key(model, messages, options, **kwargs)
+  response = _read(key, get_ttl(call_type))
+  if response is not None:
+    verbose_print(f"LLM cache hit for {call_type}: {key}")
+  return key, response
+
+
+def _remember(key: Optional[str], call_type: str, response: ChatResponse) -> None:
+  if key is None:
+    return
+  try:
+    _write(key, call_type, response)
+  except Exception as e:
+    verbose_print(f"Error writing LLM cache entry {key}: {str(e)}")
+
+
+def cached_chat(call_type: str, model: str, messages: List[dict], options: Optional[dict]=None, bypass: bool=False, **kwargs: Any) -> ChatResponse:
+  """
+  Replacement of ollama.chat for non-streaming calls that are a pure function of their input.
+  Responses are cached on disk when LLM_CACHE=True, unless the call or its call type is bypassed.
+  Cache hits are recorded by the telemetry too, without timings.
+
+  Args:
+      call_type: Kind of call, used for the TTL and bypass settings
+      model: The model to use
+      messages: The messages to send
+      options: The model options
+      bypass: Skip the cache for this call
+      kwargs: Other parameters of ollama.chat, part of the cache key
+
+  Returns:
+      ChatResponse: The cached or fresh response
+  """
+  key, response = _lookup(call_type, model, messages, options, bypass, kwargs)
+  if response is not None:
+    record_cached_call(call_type)
+    return response
+  response = get_llm().chat(call_type, model=model, messages=messages, options=options, **kwargs)
+  _remember(key, call_type, response)
+  return response
+
+
+async def acached_chat(call_type: str, model: str, messages: List[dict], options: Optional[dict]=None, bypass: bool=False, **kwargs: Any) -> ChatResponse:
+  """Async variant of cached_chat."""
+  key, response = _lookup(call_type, model, messages, options, bypass, kwargs)
+  if response is not None:
+    record_cached_call(call_type)
+    return response
+  response = await get_llm().achat(call_type, model=model, messages=messages, options=options, **kwargs)
+  _remember(key, call_type, response)
+  return response
@@ -0,0 +1,88 @@
+import itertools
+import threading
+from typing import TYPE_CHECKING, Callable, Dict, List
+
+from util.helpers import verbose_print, get_llm_health_interval
+
+if TYPE_CHECKING:
+  from util.llm import LLMBackend
+
+# Calls that reuse the prompt prefix of their character, kept on one server so its KV cache stays warm
+AFFINE_CALL_TYPES = {"chat"}
+
+
+class LLMRouter:
+  """
+  Spreads LLM calls over several Ollama servers serving the same models.
+
+  The chat calls of a character always go to the same server, picked the first time the character
+  speaks, so its system prompt and history stay in that server's KV cache. Other calls, e.g.
+  interviews, summaries and embeddings, go to the server with the fewest outstanding requests.
+  A server is left out from the first connection error until a health check succeeds again, and
+  the characters it served move to another one.
+
+  Args:
+      backends: The servers, OllamaBackend instances or anything with ping
+      outstanding: Requests running or queued on a backend
+  """
+  def __init__(self, backends: List["LLMBackend"], outstanding: Callable[["LLMBackend"], int]):
+    self.backends = backends
+    self.outstanding = outstanding
+    self.healthy = set(backends)
+    self._affinity: Dict[str, "LLMBackend"] = {}
+    # Servers tied on outstanding requests take turns
+    self._turns = itertools.count()
+    self._lock = threading.Lock()
+    self._stopped = threading.Event()
+    if len(backends) > 1:
+      threading.Thread(target=self._check_health, daemon=True, name="llm-health").start()
+
+  def pick(self, call_type: str, character: str="") -> "LLMBackend":
+    with self._lock:
+      # With every server down, keep trying all of them rather than failing without a request
+      candidates = [b for b in self.backends if b in self.healthy] or self.backends
+      turn = next(self._turns) % len(candidates)
+      candidates = candidates[turn:] + candidates[:turn]
+      if call_type not in AFFINE_CALL_TYPES or not character:
+        return min(candidates, key=self.outstanding)
+      backend = self._affinity.get(character)
+      if backend not in candidates:
+        # Fewest outstanding requests first, then fewest characters, so personas spread out
+        characters = {b: 0 for b in candidates}
+        for b in self._affinity.values():
+          if b in characters:
+            characters[b] += 1
+        backend = min(candidates, key=lambda b: (self.outstanding(b), characters[b]))
+        self._affinity[character] = backend
+      return backend
+
+  def affinity(self) -> Dict[str, str]:
+    """Host of each character, for verbose output and debugging."""
+    with self._lock:
+      return {character: getattr(backend, "host", str(backend)) for character, backend in self._affinity.items()}
+
+  def mark_down(self, backend: "LLMBackend") -> None:
+    with self._lock:
+      if backend not in self.healthy:
+        return
+      self.healthy.discard(backend)
+    verbose_print(f"LLM backend {getattr(backend, 'host', backend)} is down, routing around it")
+
+  def mark_up(self, backend: "LLMBackend") -> None:
+    with self._lock:
+      if backend in self.healthy:
+        return
+      self.healthy.add(backend)
+    verbose_print(f"LLM backend {getattr(backend, 'host', backend)} is back up")
+
+  def _check_health(self) -> None:
+    while not self._stopped.wait(get_llm_health_interval()):
+      for backend in self.backends:
+        try:
+          backend.ping()
+          self.mark_up(backend)
+        except Exception:
+          self.mark_down(backend)
+
+  def close(self) -> None:
+    self._stopped.set()
@@ -0,0 +1,178 @@
+from contextlib import contextmanager
+import asyncio
+import contextvars
+from enum import IntEnum
+import heapq
+import itertools
+import threading
+import time
+from typing import Iterator, List
+
+from util.helpers import get_llm_parallel, get_llm_background_slots
+from util.telemetry import current_phase
+
+
+class LLMPriority(IntEnum):
+  # Lower values are served first
+  USER = 0
+  INTERVIEW = 1
+  REACTION = 2
+  BACKGROUND = 3
+
+
+PHASE_PRIORITIES = {
+  "first_reply": LLMPriority.USER,
+  "magi": LLMPriority.USER,
+  "interview": LLMPriority.INTERVIEW,
+  "reactions": LLMPriority.REACTION,
+  "memory": LLMPriority.BACKGROUND,
+}
+# Never waited on by the user, whatever the phase
+BACKGROUND_CALL_TYPES = {"ascii_art"}
+
+# Priority forced for the calls of the current thread or task, e.g. a speculative prefetch
+_priority = contextvars.ContextVar("llm_priority", default=None)
+
+
+@contextmanager
+def llm_priority(priority: LLMPriority) -> Iterator[None]:
+  """
+  Schedule the LLM calls made inside the block, and by the tasks created in it, with the given priority.
+  """
+  token = _priority.set(priority)
+  try:
+    yield
+  finally:
+    _priority.reset(token)
+
+
+def request_priority(call_type: str) -> LLMPriority:
+  """Priority of a call: forced with llm_priority, else from its call type and the phase of the turn."""
+  priority = _priority.get()
+  if priority is not None:
+    return priority
+  if call_type in BACKGROUND_CALL_TYPES:
+    return LLMPriority.BACKGROUND
+  # Calls outside of a turn, e.g. persona indexing on a worker thread, are housekeeping
+  return PHASE_PRIORITIES.get(current_phase(), LLMPriority.BACKGROUND)
+
+
+class _Waiter:
+  __slots__ = ("priority", "event", "future", "loop", "granted", "cancelled")
+
+  def __init__(self, priority: LLMPriority, event: threading.Event=None, future: asyncio.Future=None):
+    self.priority = priority
+    self.event = event
+    self.future = future
+    self.loop = future.get_loop() if future else None
+    self.granted = False
+    self.cancelled = False
+
+
+class LLMScheduler:
+  """
+  Admission of the requests sent to one model of one server.
+
+  At most `parallel` requests run at once, the server's parallel slots, so further requests
+  queue here where their priority decides the order, instead of in the server where it is first
+  come first served. Background requests only get `background_slots` of the slots, so a user
+  reply never waits for more than the background requests already running. Running requests are
+  never preempted: cancelling a generation throws its work away.
+
+  Sync callers block in acquire and async callers await aacquire, on the same queue.
+  """
+  def __init__(self, parallel: int=None, background_slots: int=None):
+    self.parallel = get_llm_parallel() if parallel is None else parallel
+    self.background_slots = get_llm_background_slots() if background_slots is None else background_slots
+    self.running = 0
+    self.running_background = 0
+    self._queue: List[tuple] = []
+    # FIFO order within a priority
+    self._sequence = itertools.count()
+    self._lock = threading.Lock()
+
+  def _can_run(self, priority: LLMPriority) -> bool:
+    if self.parallel <= 0:
+      return True
+    if self.running >= self.parallel:
+      return False
+    return priority != LLMPriority.BACKGROUND or self.running_background < self.background_slots
+
+  def _start(self, priority: LLMPriority) -> None:
+    # Must be called with the lock held
+    self.running += 1
+    if priority == LLMPriority.BACKGROUND:
+      self.running_background += 1
+
+  def _grant(self) -> None:
+    # Must be called with the lock held. Background waiters only queue behind each other, so
+    # once the first waiter cannot run, none of the ones after it can
+    while self._queue:
+      waiter = self._queue[0][2]
+      if waiter.cancelled:
+        heapq.heappop(self._queue)
+        continue
+      if not self._can_run(waiter.priority):
+        return
+      heapq.heappop(self._queue)
+      waiter.granted = True
+      self._start(waiter.priority)
+      if waiter.event:
+        waiter.event.set()
+      else:
+        waiter.loop.call_soon_threadsafe(self._wake, waiter)
+
+  def _wake(self, waiter: _Waiter) -> None:
+    # Runs on the loop of the waiter. A waiter cancelled after being granted hands its slot back
+    if waiter.future.cancelled():
+      self.release(waiter.priority)
+    else:
+      waiter.future.set_result(None)
+
+  def _enqueue(self, waiter: _Waiter) -> None:
+    heapq.heappush(self._queue, (waiter.priority, next(self._sequence), waiter))
+    self._grant()
+
+  def acquire(self, priority: LLMPriority) -> float:
+    """Wait for a slot, return the seconds waited."""
+    started_at = time.perf_counter()
+    with self._lock:
+      if not self._queue and self._can_run(priority):
+        self._start(priority)
+        return 0.0
+      waiter = _Waiter(priority, event=threading.Event())
+      self._enqueue(waiter)
+    waiter.event.wait()
+    return time.perf_counter() - started_at
+
+  async def aacquire(self, priority: LLMPriority) -> float:
+    """Async variant of acquire."""
+    started_at = time.perf_counter()
+    with self._lock:
+      if not self._queue and self._can_run(priority):
+        self._start(priority)
+        return 0.0
+      waiter = _Waiter(priority, future=asyncio.get_running_loop().create_future())
+      self._enqueue(waiter)
+    try:
+      await waiter.future
+    except asyncio.CancelledError:
+      with self._lock:
+        waiter.cancelled = True
+        # Granted and woken before the cancellation, otherwise _wake hands the slot back
+        owns_slot = waiter.granted and waiter.future.done() and not waiter.future.cancelled()
+      if owns_slot:
+        self.release(priority)
+      raise
+    return time.perf_counter() - started_at
+
+  def release(self, priority: LLMPriority) -> None:
+    with self._lock:
+      self.running -= 1
+      if priority == LLMPriority.BACKGROUND:
+        self.running_background -= 1
+      self._grant()
+
+  def queued(self) -> int:
+    with self._lock:
+      return sum(1 for _, _, waiter in self._queue if not waiter.cancelled)
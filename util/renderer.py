@@ -0,0 +1,263 @@
+import atexit
+import shutil
+import sys
+import threading
+import time
+from typing import Callable, List, Optional, TextIO
+
+
+# Buffered output is written at most this often, instead of once per streamed token
+FLUSH_INTERVAL = 0.05
+# Latest lines of each stream shown in its live region
+REGION_LINES = 4
+
+
+def _wrap(text: str, width: int) -> List[str]:
+  lines = []
+  for line in text.split('\n'):
+    while len(line) > width:
+      lines.append(line[:width])
+      line = line[width:]
+    lines.append(line)
+  return lines
+
+
+class Renderer:
+  """
+  Terminal output of the conversation.
+
+  Writes are buffered and flushed at most every flush_interval by a background thread, so a fast
+  stream costs a few writes per second instead of one per token. Live blocks are redrawn in place
+  on every flush, which is how several streams are shown at once. Lines written while a live
+  block is on screen are shown above it on its next redraw.
+  """
+  def __init__(self, out: TextIO=None, flush_interval: float=FLUSH_INTERVAL):
+    self.out = out or sys.stdout
+    self.flush_interval = flush_interval
+    # Redrawing in place needs a terminal
+    self.live = self.out.isatty()
+    self._buffer = []
+    # Lines waiting to be drawn above the live blocks on screen
+    self._above = []
+    self._live_blocks = 0
+    self._refreshers = []
+    self._lock = threading.RLock()
+    self._pending = threading.Event()
+    self._flusher = None
+
+  def write(self, text: str) -> None:
+    with self._lock:
+      self._buffer.append(text)
+      if self._flusher is None:
+        self._flusher = threading.Thread(target=self._run_flusher, daemon=True, name="renderer")
+        self._flusher.start()
+      self._pending.set()
+
+  def line(self, text: str="") -> None:
+    with self._lock:
+      if self._live_blocks:
+        # Written below a block, the line would shift the block away from where its redraw moves the cursor
+        self._above.extend(f"\x1b[2K{row}\n" for row in text.split("\n"))
+        self._pending.set()
+        return
+    self.write(f"{text}\n")
+
+  def _take_above(self) -> str:
+    # Must be called with the lock held
+    above = "".join(self._above)
+    self._above.clear()
+    return above
+
+  def flush(self) -> None:
+    with self._lock:
+      if self._buffer:
+        self.out.write("".join(self._buffer))
+        self._buffer.clear()
+      self.out.flush()
+
+  def _run_flusher(self) -> None:
+    while True:
+      self._pending.wait()
+      time.sleep(self.flush_interval)
+      with self._lock:
+        for refresh in list(self._refreshers):
+          refresh()
+        self.flush()
+        if not self._refreshers:
+          self._pending.clear()
+
+  def add_refresher(self, refresh: Callable[[], None]) -> None:
+    """Call refresh before every flush until it is removed."""
+    with self._lock:
+      self._refreshers.append(refresh)
+      self._pending.set()
+
+  def remove_refresher(self, refresh: Callable[[], None]) -> None:
+    with self._lock:
+      if refresh in self._refreshers:
+        self._refreshers.remove(refresh)
+
+  def prompt(self, text: str) -> str:
+    """Ask for input once everything written so far is shown."""
+    self.flush()
+    return input(text)
+
+  def stream(self, label: str) -> "Stream":
+    return Stream(self, label)
+
+  def live_block(self) -> "LiveBlock":
+    return LiveBlock(self)
+
+  def stream_regions(self, count: int) -> "StreamRegions":
+    return StreamRegions(self, count)
+
+  def width(self) -> int:
+    return shutil.get_terminal_size().columns
+
+
+class Stream:
+  """The reply of one speaker, shown as it arrives under its label."""
+  def __init__(self, renderer: Renderer, label: str):
+    self.renderer = renderer
+    self.label = label
+    renderer.line(f"{label}: ")
+
+  def write(self, chunk: str) -> None:
+    self.renderer.write(chunk)
+
+  def close(self) -> None:
+    self.renderer.write("\n\n")
+    self.renderer.flush()
+
+
+class LiveBlock:
+  """
+  Lines redrawn in place on a terminal. Without a terminal only the final lines are written.
+  """
+  def __init__(self, renderer: Renderer):
+    self.renderer = renderer
+    self._drawn_lines = 0
+
+  def update(self, lines: List[str]) -> None:
+    if not self.renderer.live:
+      return
+    with self.renderer._lock:
+      if not self._drawn_lines and lines:
+        self.renderer._live_blocks += 1
+      above = self.renderer._take_above()
+      # Lines printed above push the block down, clear what is left of the old one below it
+      erase = self._erase() + ("\x1b[J" if above and self._drawn_lines else "")
+      self.renderer.write(erase + above + "".join(f"\x1b[2K{line}\n" for line in lines))
+      if self._drawn_lines and not lines:
+        self.renderer._live_blocks -= 1
+      self._drawn_lines = len(lines)
+
+  def _erase(self) -> str:
+    # Move the cursor back to the top of the block drawn last time
+    return f"\x1b[{self._drawn_lines}F" if self._drawn_lines else ""
+
+  def close(self, final_lines: List[str]=()) -> None:
+    """Replace the block with the final lines, which stay on screen."""
+    with self.renderer._lock:
+      erase = self._erase() + "\x1b[J" if self._drawn_lines else ""
+      if self._drawn_lines:
+        self.renderer._live_blocks -= 1
+      self.renderer.write(erase + self.renderer._take_above() + "".join(f"{line}\n" for line in final_lines))
+      self._drawn_lines = 0
+    self.renderer.flush()
+
+
+class RegionStream:
+  """Stream of one region of a StreamRegions."""
+  def __init__(self, regions: "StreamRegions", index: int):
+    self.regions = regions
+    self.index = index
+
+  def set_label(self, label: str) -> None:
+    self.regions.labels[self.index] = label
+
+  def write(self, chunk: str) -> None:
+    self.regions.write(self.index, chunk)
+
+  def close(self) -> None:
+    self.regions.finish(self.index)
+
+
+class StreamRegions:
+  """
+  Several streams generated at the same time.
+
+  On a terminal each stream gets a labeled region showing its latest lines, redrawn in place.
+  When the regions close, the block is replaced by the complete replies in region order.
+  Without a terminal, complete lines are written as they arrive, interleaved and prefixed with
+  their label, and nothing more is written on close.
+  """
+  def __init__(self, renderer: Renderer, count: int, region_lines: int=REGION_LINES):
+    self.renderer = renderer
+    self.region_lines = region_lines
+    self.labels = [""] * count
+    self.texts = [""] * count
+    self.done = [False] * count
+    self._partial_lines = [""] * count
+    self._lock = threading.Lock()
+    self.block = renderer.live_block()
+    if renderer.live:
+      renderer.add_refresher(self._redraw)
+
+  def region(self, index: int) -> RegionStream:
+    return RegionStream(self, index)
+
+  def write(self, index: int, chunk: str) -> None:
+    with self._lock:
+      self.texts[index] += chunk
+      if self.renderer.live:
+        return
+      *lines, self._partial_lines[index] = (self._partial_lines[index] + chunk).split("\n")
+    for line in lines:
+      self.renderer.line(f"{self.labels[index]}: {line}")
+
+  def finish(self, index: int) -> None:
+    with self._lock:
+      self.done[index] = True
+      partial_line, self._partial_lines[index] = self._partial_lines[index], ""
+    if partial_line and not self.renderer.live:
+      self.renderer.line(f"{self.labels[index]}: {partial_line}")
+
+  def _redraw(self) -> None:
+    width = max(self.renderer.width() - 2, 20)
+    lines = []
+    with self._lock:
+      for label, text, done in zip(self.labels, self.texts, self.done):
+        if not label:
+          continue
+        lines.append(f"── {label} {'(done) ' if done else ''}".ljust(width, "─"))
+        tail = _wrap(text, width)[-self.region_lines:] if text else []
+        tail = [""] * (self.region_lines - len(tail)) + tail
+        lines.extend(f"  {line}" for line in tail)
+    self.block.update(lines)
+
+  def close(self) -> None:
+    if not self.renderer.live:
+      self.renderer.flush()
+      return
+    self.renderer.remove_refresher(self._redraw)
+    final_lines = []
+    for label, text in zip(self.labels, self.texts):
+      if text:
+        final_lines.extend([f"{label}: ", text, ""])
+    self.block.close(final_lines)
+
+
+_renderer: Optional[Renderer] = None
+_renderer_lock = threading.Lock()
+
+
+def get_renderer() -> Renderer:
+  """The renderer of stdout, created on first use."""
+  global _renderer
+  with _renderer_lock:
+    if _renderer is None:
+      _renderer = Renderer()
+      # The flusher is a daemon thread, output buffered since its last flush would be lost at exit
+      atexit.register(_renderer.flush)
+    return _renderer
@@ -0,0 +1,357 @@
+from collections import deque
+from contextlib import contextmanager
+import contextvars
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional
+
+from util.helpers import verbose_print, get_llm_telemetry_jsonl, get_llm_telemetry_prom
+
+
+# Phases of a turn, in the order they happen
+PHASES = ["interview", "first_reply", "reactions", "memory", "magi", "other"]
+# Turns kept for the STATS command
+KEPT_TURNS = 20
+NANOSECONDS = 1e9
+
+# Phase of the calls made by the current thread or task. Tasks inherit it from where they are
+# created, threads of an executor do not and set it themselves
+_phase = contextvars.ContextVar("llm_phase", default="other")
+
+
+@contextmanager
+def llm_phase(name: str) -> Iterator[None]:
+  """Count the LLM calls made inside the block to the given phase of the turn."""
+  token = _phase.set(name)
+  try:
+    yield
+  finally:
+    _phase.reset(token)
+
+
+def current_phase() -> str:
+  return _phase.get()
+
+
+class CallRecord:
+  """
+  Timings and token counts of one Ollama call.
+
+  Durations come from Ollama in nanoseconds and are kept in seconds. Time to first token is
+  measured on our side and only set for streamed calls, like the time queued for a slot of the
+  server, see LLMScheduler. Cached calls never reached Ollama.
+  """
+  def __init__(
+    self,
+    turn: int,
+    phase: str,
+    call_type: str,
+    character: str,
+    wall: float,
+    time_to_first_token: Optional[float]=None,
+    queued: float=0.0,
+    response: Any=None,
+    cached: bool=False,
+    error: Optional[str]=None,
+  ):
+    self.turn = turn
+    self.phase = phase
+    self.call_type = call_type
+    self.character = character
+    self.wall = wall
+    self.time_to_first_token = time_to_first_token
+    self.queued = queued
+    self.cached = cached
+    self.error = error
+    self.model = getattr(response, "model", None)
+    self.prompt_tokens = getattr(response, "prompt_eval_count", None) or 0
+    self.eval_tokens = getattr(response, "eval_count", None) or 0
+    self.load = (getattr(response, "load_duration", None) or 0) / NANOSECONDS
+    self.prompt_eval = (getattr(response, "prompt_eval_duration", None) or 0) / NANOSECONDS
+    self.eval = (getattr(response, "eval_duration", None) or 0) / NANOSECONDS
+
+  def tokens_per_second(self) -> Optional[float]:
+    if not self.eval or not self.eval_tokens:
+      return None
+    return self.eval_tokens / self.eval
+
+  def to_dict(self) -> dict:
+    return {
+      "turn": self.turn,
+      "phase": self.phase,
+      "call_type": self.call_type,
+      "character": self.character,
+      "model": self.model,
+      "prompt_tokens": self.prompt_tokens,
+      "eval_tokens": self.eval_tokens,
+      "load_s": self.load,
+      "prompt_eval_s": self.prompt_eval,
+      "eval_s": self.eval,
+      "wall_s": self.wall,
+      "time_to_first_token_s": self.time_to_first_token,
+      "queued_s": self.queued,
+      "tokens_per_s": self.tokens_per_second(),
+      "cached": self.cached,
+      "error": self.error,
+    }
+
+
+class CallTimer:
+  """
+  Measures a call from the start of the with block. Streams call first_token on every chunk,
+  the response, or the last chunk of a stream, is handed over with done. Time spent waiting for
+  a slot of the server is added with queued.
+  """
+  def __init__(self, telemetry: "Telemetry", call_type: str, character: str):
+    self.telemetry = telemetry
+    self.call_type = call_type
+    self.character = character
+    self.phase = _phase.get()
+    self.response = None
+    self.cached = False
+    self.started_at = time.perf_counter()
+    self.first_token_at = None
+    self.queued_time = 0.0
+
+  def queued(self, seconds: float) -> None:
+    self.queued_time += seconds
+
+  def first_token(self) -> None:
+    if self.first_token_at is None:
+      self.first_token_at = time.perf_counter()
+
+  def done(self, response: Any, cached: bool=False) -> None:
+    self.response = response
+    self.cached = cached
+
+  def __enter__(self) -> "CallTimer":
+    return self
+
+  def __exit__(self, exc_type, exc, tb) -> None:
+    now = time.perf_counter()
+    self.telemetry.record(CallRecord(
+      turn=self.telemetry.turn,
+      phase=self.phase,
+      call_type=self.call_type,
+      character=self.character,
+      wall=now - self.started_at,
+      time_to_first_token=self.first_token_at - self.started_at if self.first_token_at else None,
+      queued=self.queued_time,
+      # A cached response carries the timings of the call that produced it
+      response=None if self.cached else self.response,
+      cached=self.cached,
+      error=exc_type.__name__ if exc_type else None,
+    ))
+
+
+class PhaseStats:
+  """Totals of the calls of a phase, or of any other group of calls."""
+  def __init__(self):
+    self.calls = 0
+    self.cached = 0
+    self.errors = 0
+    self.prompt_tokens = 0
+    self.eval_tokens = 0
+    self.load = 0.0
+    self.prompt_eval = 0.0
+    self.eval = 0.0
+    self.wall = 0.0
+    self.queued = 0.0
+    self.first_token_sum = 0.0
+    self.first_token_count = 0
+    # Overlapping calls of the phase count once
+    self.started_at = None
+    self.finished_at = None
+
+  def add(self, record: CallRecord) -> None:
+    self.calls += 1
+    self.cached += record.cached
+    # Interviews cancelled once the vote reached quorum are not errors
+    self.errors += record.error not in (None, "CancelledError")
+    self.prompt_tokens += record.prompt_tokens
+    self.eval_tokens += record.eval_tokens
+    self.load += record.load
+    self.prompt_eval += record.prompt_eval
+    self.eval += record.eval
+    self.wall += record.wall
+    self.queued += record.queued
+    if record.time_to_first_token is not None:
+      self.first_token_sum += record.time_to_first_token
+      self.first_token_count += 1
+    finished_at = time.perf_counter()
+    started_at = finished_at - record.wall
+    self.started_at = started_at if self.started_at is None else min(self.started_at, started_at)
+    self.finished_at = finished_at if self.finished_at is None else max(self.finished_at, finished_at)
+
+  def span(self) -> float:
+    """Time from the start of the first call to the end of the last one."""
+    return self.finished_at - self.started_at if self.calls else 0.0
+
+  def tokens_per_second(self) -> Optional[float]:
+    return self.eval_tokens / self.eval if self.eval else None
+
+  def time_to_first_token(self) -> Optional[float]:
+    return self.first_token_sum / self.first_token_count if self.first_token_count else None
+
+
+class TurnStats:
+  def __init__(self, number: int, label: str):
+    self.number = number
+    self.label = label
+    self.started_at = time.perf_counter()
+    self.finished_at = None
+    self.phases: Dict[str, PhaseStats] = {}
+
+  def add(self, record: CallRecord) -> None:
+    self.phases.setdefault(record.phase, PhaseStats()).add(record)
+
+  def duration(self) -> float:
+    return (self.finished_at or time.perf_counter()) - self.started_at
+
+
+class Telemetry:
+  """
+  Timings of every Ollama call, grouped by turn and by phase of the turn.
+
+  Calls are recorded to the turn in progress when they finish. Memory is folded in the background
+  by default, so the memory phase of a turn is usually the memory of the turn before it.
+  When LLM_TELEMETRY_JSONL is set every call is appended to that file, and when LLM_TELEMETRY_PROM
+  is set the session totals are written there in the Prometheus text format after every turn.
+  """
+  def __init__(self, kept_turns: int=KEPT_TURNS):
+    self.turn = 0
+    self.turns = deque([TurnStats(0, "startup")], maxlen=kept_turns)
+    # (phase, call_type) -> totals of the session
+    self.totals: Dict[tuple, PhaseStats] = {}
+    self._lock = threading.Lock()
+
+  def track(self, call_type: str, character: str) -> CallTimer:
+    return CallTimer(self, call_type, character)
+
+  def record(self, record: CallRecord) -> None:
+    with self._lock:
+      self.turns[-1].add(record)
+      self.totals.setdefault((record.phase, record.call_type), PhaseStats()).add(record)
+    path = get_llm_telemetry_jsonl()
+    if path:
+      self._append_jsonl(path, record)
+
+  def begin_turn(self, label: str="") -> None:
+    with self._lock:
+      self.turn += 1
+      self.turns.append(TurnStats(self.turn, label))
+
+  def end_turn(self) -> None:
+    with self._lock:
+      self.turns[-1].finished_at = time.perf_counter()
+    path = get_llm_telemetry_prom()
+    if path:
+      self._write_prometheus(path)
+
+  def _append_jsonl(self, path: str, record: CallRecord) -> None:
+    try:
+      line = json.dumps(record.to_dict(), ensure_ascii=False) + "\n"
+      with self._lock:
+        with open(path, 'a', encoding='utf-8') as file:
+          file.write(line)
+    except Exception as e:
+      verbose_print(f"Error writing LLM telemetry to {path}: {str(e)}")
+
+  def prometheus_text(self) -> str:
+    with self._lock:
+      totals = sorted(self.totals.items())
+      turns = self.turn
+    metrics = [
+      ("legion_llm_calls_total", "counter", "Ollama calls made", lambda s: s.calls),
+      ("legion_llm_cached_calls_total", "counter", "Calls answered from the response cache", lambda s: s.cached),
+      ("legion_llm_errors_total", "counter", "Calls that raised, cancelled calls excluded", lambda s: s.errors),
+      ("legion_llm_prompt_tokens_total", "counter", "Prompt tokens evaluated by Ollama", lambda s: s.prompt_tokens),
+      ("legion_llm_eval_tokens_total", "counter", "Tokens generated by Ollama", lambda s: s.eval_tokens),
+      ("legion_llm_load_seconds_total", "counter", "Time Ollama spent loading the model", lambda s: s.load),
+      ("legion_llm_prompt_eval_seconds_total", "counter", "Time Ollama spent evaluating prompts", lambda s: s.prompt_eval),
+      ("legion_llm_eval_seconds_total", "counter", "Time Ollama spent generating tokens", lambda s: s.eval),
+      ("legion_llm_wall_seconds_total", "counter", "Time from sending the calls to their last token", lambda s: s.wall),
+      ("legion_llm_queued_seconds_total", "counter", "Time the calls waited for a slot of the server", lambda s: s.queued),
+      ("legion_llm_time_to_first_token_seconds_sum", "counter", "Time to the first token of streamed calls", lambda s: s.first_token_sum),
+      ("legion_llm_time_to_first_token_seconds_count", "counter", "Streamed calls", lambda s: s.first_token_count),
+    ]
+    lines = [
+      "# HELP legion_turns_total Turns of the session",
+      "# TYPE legion_turns_total counter",
+      f"legion_turns_total {turns}",
+    ]
+    for name, kind, description, value in metrics:
+      lines.append(f"# HELP {name} {description}")
+      lines.append(f"# TYPE {name} {kind}")
+      for (phase, call_type), stats in totals:
+        lines.append(f'{name}{{phase="{phase}",call_type="{call_type}"}} {value(stats)}')
+    return "\n".join(lines) + "\n"
+
+  def _write_prometheus(self, path: str) -> None:
+    # Written to a temporary file first, so the collector never reads half a file
+    try:
+      tmp_path = f"{path}.tmp"
+      with open(tmp_path, 'w', encoding='utf-8') as file:
+        file.write(self.prometheus_text())
+      os.replace(tmp_path, path)
+    except Exception as e:
+      verbose_print(f"Error writing LLM telemetry to {path}: {str(e)}")
+
+  def format_stats(self, turn_count: int=1) -> str:
+    """Per phase breakdown of the last turns, for the STATS command."""
+    with self._lock:
+      turns = [t for t in self.turns if t.phases or t.finished_at][-turn_count:]
+    if not turns:
+      return "No LLM calls recorded yet"
+    lines = []
+    for turn in turns:
+      title = f"Turn {turn.number}" + (f" ({turn.label})" if turn.label else "")
+      lines.append(f"{title}: {turn.duration():.2f}s")
+      lines.append(f"  {'phase':<12}{'calls':>6}{'span':>9}{'ttft':>9}{'queue':>8}{'load':>8}{'prompt':>14}{'eval':>14}{'tok/s':>8}")
+      for phase in PHASES:
+        stats = turn.phases.get(phase)
+        if stats:
+          lines.append(_format_phase(phase, stats))
+    return "\n".join(lines)
+
+
+def _seconds(value: Optional[float]) -> str:
+  return "-" if value is None else f"{value:.2f}s"
+
+
+def _format_phase(phase: str, stats: PhaseStats) -> str:
+  tokens_per_second = stats.tokens_per_second()
+  calls = f"{stats.calls}" + (f"/{stats.cached}c" if stats.cached else "")
+  return (
+    f"  {phase:<12}{calls:>6}{_seconds(stats.span()):>9}{_seconds(stats.time_to_first_token()):>9}"
+    f"{_seconds(stats.queued):>8}{_seconds(stats.load):>8}"
+    f"{f'{stats.prompt_tokens}t {stats.prompt_eval:.2f}s':>14}"
+    f"{f'{stats.eval_tokens}t {stats.eval:.2f}s':>14}"
+    f"{'-' if tokens_per_second is None else f'{tokens_per_second:.1f}':>8}"
+  )
+
+
+_telemetry = Telemetry()
+
+
+def get_telemetry() -> Telemetry:
+  return _telemetry
+
+
+def record_cached_call(call_type: str, character: str="") -> None:
+  """Record a call answered from the response cache, which never reached Ollama."""
+  with track_call(call_type, character) as call:
+    call.done(None, cached=True)
+
+
+def track_call(call_type: str, character: str="") -> CallTimer:
+  """
+  Record an Ollama call made inside the with block.
+
+  Args:
+      call_type: Kind of call, e.g. chat, summarize or interview
+      character: Real name of the character making the call
+  """
+  return _telemetry.track(call_type, character)
@@ -1,8 +1,8 @@
-import pyttsx3
 import threading
 import os
 
 from util.helpers import verbose_print
+from util.renderer import get_renderer
 
 # Global TTS engine
 _engine = None
@@ -10,9 +10,13 @@ _is_enabled = False
 _voice_cache = {}
 
 def initialize_tts():
-    """Initialize the text-to-speech engine."""
+    """
+    Initialize the text-to-speech engine, left disabled.
+    Loading the speech driver is slow, so this only runs the first time TTS is toggled on.
+    """
     global _engine, _is_enabled
     try:
+        import pyttsx3
         _engine = pyttsx3.init()
         _engine.setProperty('rate', 150)  # Speed of speech
         _engine.setProperty('volume', 0.9)  # Volume (0.0 to 1.0)
@@ -32,7 +36,8 @@ def toggle_tts():
     """Toggle text-to-speech on/off."""
     global _is_enabled
     if _engine is None:
-        initialize_tts()
+        # The first toggle turns TTS on once the engine is ready
+        _is_enabled = initialize_tts()
     else:
         _is_enabled = not _is_enabled
     return _is_enabled
@@ -76,6 +81,10 @@ def speak_text(text, character_name=None):
     if not _is_enabled or _engine is None:
         return False
     
+    # Characters created before TTS was turned on have no voice yet
+    if character_name and character_name not in _voice_cache:
+        set_voice_for_character(character_name)
+    
     # Use a separate thread to avoid blocking the main program
     def _speak_thread():
         try:
@@ -86,12 +95,12 @@ def speak_text(text, character_name=None):
             try:
                 _engine.endLoop()
             except Exception as e:
-                print(f"Error ending loop: {str(e)}")
+                get_renderer().line(f"Error ending loop: {str(e)}")
             _engine.say(text)
             _engine.runAndWait()
             _engine.stop()
         except Exception as e:
-            print(f"TTS Error: {str(e)}")
+            get_renderer().line(f"TTS Error: {str(e)}")
     
     # Start the speech in a separate thread
     threading.Thread(target=_speak_thread, daemon=True).start()